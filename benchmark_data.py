@@ -0,0 +1,89 @@
+"""
+Benchmark training data loading throughput in images/sec.
+"""
+
+import argparse
+from timeit import default_timer as timer
+
+import numpy as np
+
+from train import data_generator, get_anchors
+from yolo3.loader import ParallelDataGenerator
+from yolo3.shards import pack_shards
+
+parser = argparse.ArgumentParser(description='Training data loader benchmark.')
+parser.add_argument('annotation_path', help='Path to annotation file, e.g. train.txt')
+parser.add_argument('--anchors_path', default='model_data/yolo_anchors.txt',
+    help='path to anchor definitions, default model_data/yolo_anchors.txt')
+parser.add_argument('--num_classes', type=int, default=80, help='number of classes, default 80')
+parser.add_argument('--batch_size', type=int, default=32, help='batch size, default 32')
+parser.add_argument('--steps', type=int, default=20, help='batches to time per loader, default 20')
+parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, 8],
+    help='worker counts to time the parallel loader with, default 2 4 8')
+parser.add_argument('--prefetch', type=int, default=4, help='prefetch depth, default 4')
+parser.add_argument('--shard_dir', default=None,
+    help='also pack the images into shards there and time reading them against random files')
+
+
+def time_loader(name, generator, batch_size, steps):
+    next(generator) # exclude start-up from the measurement
+    start = timer()
+    for _ in range(steps):
+        next(generator)
+    images_per_sec = steps * batch_size / (timer() - start)
+    print('{:<24} {:8.1f} images/sec'.format(name, images_per_sec))
+    return images_per_sec
+
+
+def time_reads(name, records, steps):
+    '''time reading the encoded bytes of steps images, without decoding them'''
+    start = timer()
+    num_bytes = 0
+    for _ in range(steps):
+        image_file = next(records)[0]
+        if isinstance(image_file, str):
+            with open(image_file, 'rb') as f:
+                num_bytes += len(f.read())
+        else:
+            num_bytes += len(image_file.getbuffer())
+    elapsed = timer() - start
+    print('{:<24} {:8.1f} images/sec {:8.1f} MB/sec'.format(
+        name, steps / elapsed, num_bytes / elapsed / 2**20))
+
+
+def random_files(lines):
+    while True:
+        for i in np.random.permutation(len(lines)):
+            yield lines[i].split()[0], None
+
+
+def _main(args):
+    with open(args.annotation_path) as f:
+        lines = f.readlines()
+    anchors = get_anchors(args.anchors_path)
+    input_shape = (416,416)
+
+    baseline = time_loader('data_generator', data_generator(
+        lines, args.batch_size, input_shape, anchors, args.num_classes),
+        args.batch_size, args.steps)
+    for workers in args.workers:
+        with ParallelDataGenerator(lines, args.batch_size, input_shape, anchors, args.num_classes,
+                                   workers=workers, prefetch=args.prefetch) as generator:
+            images_per_sec = time_loader('parallel, {} workers'.format(workers), generator,
+                                         args.batch_size, args.steps)
+        print('{:<24} {:8.2f}x'.format('', images_per_sec / baseline))
+
+    if args.shard_dir:
+        shards = pack_shards(lines, args.shard_dir)
+        # drop the page cache between these to see cold or network storage
+        steps = min(len(lines), args.steps * args.batch_size)
+        time_reads('random files', random_files(lines), steps)
+        time_reads('shards', shards.records(), steps)
+        images_per_sec = time_loader('data_generator, shards', data_generator(
+            shards, args.batch_size, input_shape, anchors, args.num_classes),
+            args.batch_size, args.steps)
+        print('{:<24} {:8.2f}x'.format('', images_per_sec / baseline))
+
+
+if __name__ == '__main__':
+    _main(parser.parse_args())
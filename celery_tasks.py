@@ -3,6 +3,7 @@ import urllib.request
 
 import arrow
 from celery import Celery
+from celery.signals import worker_process_init
 from eyewitness.config import (
     BBOX,
     RAW_IMAGE_PATH,
@@ -14,7 +15,7 @@ from eyewitness.result_handler.db_writer import BboxPeeweeDbWriter
 from peewee import SqliteDatabase
 from bistiming import Stopwatch
 
-from naive_detector import YoloV3DetectorWrapper
+from naive_detector import YoloV3DetectorWrapper, parse_image_shapes
 from detector_with_flask import (
     raw_image_url_handler, image_url_handler, line_detection_result_filter)
 from line_detection_result_handler import LineAnnotationSender
@@ -36,6 +37,8 @@ model_config = {
     'classes': os.environ.get('classes', YOLO.get_defaults("classes_path")),
     'gpu_num': os.environ.get('gpu_num', YOLO.get_defaults("gpu_num")),
 }
+if os.environ.get('warmup_shapes'):
+    model_config['warmup_shapes'] = parse_image_shapes(os.environ['warmup_shapes'])
 threshold = os.environ.get('threshold', 0.7)
 # initialize a global detector first
 GLOBAL_OBJECT_DETECTOR = YoloV3DetectorWrapper(model_config, threshold=threshold)
@@ -63,6 +66,19 @@ DETECTION_RESULT_FILTERS.append(FeedbackBboxDeNoiseFilter(
     DATABASE, detection_threshold=threshold))
 
 
+@worker_process_init.connect
+def warmup_detector(**kwargs):
+    """build and warm up the model when the worker process starts, not on the first task"""
+    with Stopwatch('Building and warming up detector'):
+        GLOBAL_OBJECT_DETECTOR.build()
+
+
+@celery.task(name='detector_status')
+def detector_status():
+    return {'ready': GLOBAL_OBJECT_DETECTOR.is_ready,
+            'warmup_time': GLOBAL_OBJECT_DETECTOR.warmup_time}
+
+
 def generate_image_url(channel):
     return "https://upload.wikimedia.org/wikipedia/commons/2/25/5566_and_Daily_Air_B-55507_20050820.jpg"  # noqa
 
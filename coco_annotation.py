@@ -1,52 +1,212 @@
+"""
+Convert COCO instance annotations to a train.txt style list, streaming the json files.
+"""
+
+import argparse
+import array
 import json
-from collections import defaultdict
-
-name_box_id = defaultdict(list)
-id_name = dict()
-f = open(
-    "mscoco2017/annotations/instances_train2017.json",
-    encoding='utf-8')
-data = json.load(f)
-
-annotations = data['annotations']
-for ant in annotations:
-    id = ant['image_id']
-    name = 'mscoco2017/train2017/%012d.jpg' % id
-    cat = ant['category_id']
-
-    if cat >= 1 and cat <= 11:
-        cat = cat - 1
-    elif cat >= 13 and cat <= 25:
-        cat = cat - 2
-    elif cat >= 27 and cat <= 28:
-        cat = cat - 3
-    elif cat >= 31 and cat <= 44:
-        cat = cat - 5
-    elif cat >= 46 and cat <= 65:
-        cat = cat - 6
-    elif cat == 67:
-        cat = cat - 7
-    elif cat == 70:
-        cat = cat - 9
-    elif cat >= 72 and cat <= 82:
-        cat = cat - 10
-    elif cat >= 84 and cat <= 90:
-        cat = cat - 11
-
-    name_box_id[name].append([ant['bbox'], cat])
-
-f = open('train.txt', 'w')
-for key in name_box_id.keys():
-    f.write(key)
-    box_infos = name_box_id[key]
-    for info in box_infos:
-        x_min = int(info[0][0])
-        y_min = int(info[0][1])
-        x_max = x_min + int(info[0][2])
-        y_max = y_min + int(info[0][3])
-
-        box_info = " %d,%d,%d,%d,%d" % (
-            x_min, y_min, x_max, y_max, int(info[1]))
-        f.write(box_info)
-    f.write('\n')
-f.close()
+import os
+import re
+import resource
+
+import numpy as np
+
+from yolo3.annotation import save_annotations
+
+parser = argparse.ArgumentParser(description='COCO annotations to train.txt converter.')
+parser.add_argument('annotation_paths', nargs='*',
+    default=['mscoco2017/annotations/instances_train2017.json'],
+    help='COCO instances json files, all written to one list, '
+         'default mscoco2017/annotations/instances_train2017.json')
+parser.add_argument('--image_dirs', nargs='+', default=None,
+    help='image directory of each json file, '
+         'default mscoco2017/<split> from instances_<split>.json')
+parser.add_argument('--classes_path', default=None,
+    help='keep only these category names, in this order, e.g. model_data/coco_classes.txt; '
+         'default all categories by id')
+parser.add_argument('-o', '--output', default='train.txt', help='output list, default train.txt')
+parser.add_argument('--index', default=False, action='store_true',
+    help='also write the compiled annotation index to <output>.idx')
+parser.add_argument('--chunk_size', type=int, default=1 << 20,
+    help='characters read from the json files at a time, default 1M')
+
+_NON_SPACE = re.compile(r'\S')
+
+
+class _JSONStream(object):
+    '''Tokens and values of a json file, read chunk by chunk.'''
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        self.eof = not chunk
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def next_char(self):
+        '''consume and return the next character that is not whitespace'''
+        while True:
+            match = _NON_SPACE.search(self.buf, self.pos)
+            if match:
+                self.pos = match.end()
+                return match.group()
+            self.pos = len(self.buf)
+            self._fill()
+            if self.eof:
+                raise ValueError('unexpected end of json')
+
+    def expect(self, char):
+        found = self.next_char()
+        if found != char:
+            raise ValueError('expected {!r} in json, found {!r}'.format(char, found))
+
+    def peek(self):
+        char = self.next_char()
+        self.pos -= 1
+        return char
+
+    def decode(self):
+        '''decode the next value, reading on while it runs past the buffer'''
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer may go on in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def iter_json_object(path, chunk_size=1 << 20):
+    '''yield (key, item) for every item of the top-level arrays of a json object file and
+    (key, value) for its other top-level values, holding about chunk_size characters'''
+    with open(path, encoding='utf-8') as f:
+        stream = _JSONStream(f, chunk_size)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.decode()
+            stream.expect(':')
+            if stream.peek() == '[':
+                stream.expect('[')
+                if stream.peek() == ']':
+                    stream.expect(']')
+                else:
+                    while True:
+                        yield key, stream.decode()
+                        if stream.next_char() == ']':
+                            break
+            else:
+                yield key, stream.decode()
+            if stream.next_char() == '}':
+                break
+
+
+def read_instances(path, chunk_size=1 << 20):
+    '''the image ids, (x, y, w, h) boxes and category ids of all annotations, plus the categories
+
+    Kept in typed arrays of 8 bytes a number, instead of a dict per annotation.
+    '''
+    image_ids = array.array('q')
+    category_ids = array.array('q')
+    boxes = array.array('d')
+    categories = []
+    for key, item in iter_json_object(path, chunk_size):
+        if key == 'annotations':
+            image_ids.append(item['image_id'])
+            category_ids.append(item['category_id'])
+            boxes.extend(item['bbox'])
+        elif key == 'categories':
+            categories.append(item)
+    return (np.frombuffer(image_ids, dtype='int64'),
+            np.frombuffer(boxes, dtype='float64').reshape(-1, 4),
+            np.frombuffer(category_ids, dtype='int64'), categories)
+
+
+def category_lookup(categories, class_names=None):
+    '''array mapping COCO category ids to class ids, -1 for categories left out
+
+    By default all categories in id order, which is 0-79 for the 80 COCO classes.
+    '''
+    if class_names is None:
+        category_ids = sorted(category['id'] for category in categories)
+    else:
+        ids_by_name = {category['name']: category['id'] for category in categories}
+        missing = [name for name in class_names if name not in ids_by_name]
+        assert not missing, 'classes not in the annotations: {}'.format(', '.join(missing))
+        category_ids = [ids_by_name[name] for name in class_names]
+    lookup = np.full(max(category['id'] for category in categories) + 1, -1, dtype='int64')
+    lookup[category_ids] = np.arange(len(category_ids))
+    return lookup
+
+
+def convert(path, image_dir, class_names=None, chunk_size=1 << 20):
+    '''yield (image path, (n, 5) int boxes) in the order the images first appear'''
+    image_ids, boxes, category_ids, categories = read_instances(path, chunk_size)
+    classes = category_lookup(categories, class_names)[category_ids]
+    keep = classes >= 0
+    image_ids, boxes, classes = image_ids[keep], boxes[keep], classes[keep]
+
+    # truncate like int(), x_max and y_max from the truncated width and height
+    boxes = boxes.astype('int64')
+    boxes = np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:], classes[:, None]], axis=1)
+    unique_ids, first, inverse = np.unique(image_ids, return_index=True, return_inverse=True)
+    image_order = np.argsort(first)
+    rank = np.empty_like(image_order)
+    rank[image_order] = np.arange(len(image_order))
+    order = np.argsort(rank[inverse], kind='stable')
+    counts = np.bincount(inverse, minlength=len(unique_ids))[image_order]
+    starts = np.concatenate([[0], np.cumsum(counts)])
+    boxes = boxes[order]
+    for i, image_id in enumerate(unique_ids[image_order]):
+        yield os.path.join(image_dir, '%012d.jpg' % image_id), boxes[starts[i]:starts[i+1]]
+
+
+def _main(args):
+    image_dirs = args.image_dirs or [os.path.join('mscoco2017', re.sub(
+        r'^instances_', '', os.path.splitext(os.path.basename(path))[0]))
+        for path in args.annotation_paths]
+    assert len(image_dirs) == len(args.annotation_paths), 'give one image directory per json file'
+    class_names = None
+    if args.classes_path:
+        with open(args.classes_path) as f:
+            class_names = [c.strip() for c in f.readlines() if c.strip()]
+
+    paths, counts, index_boxes = [], [], []
+    with open(args.output, 'w') as f:
+        for path, image_dir in zip(args.annotation_paths, image_dirs):
+            num_images = 0
+            for image_path, boxes in convert(path, image_dir, class_names, args.chunk_size):
+                f.write(image_path)
+                for box in boxes.tolist():
+                    f.write(" %d,%d,%d,%d,%d" % tuple(box))
+                f.write('\n')
+                num_images += 1
+                if args.index:
+                    paths.append(image_path.encode('utf8'))
+                    counts.append(len(boxes))
+                    index_boxes.append(boxes)
+            print('{}: {} images from {}'.format(args.output, num_images, path))
+    if args.index:
+        save_annotations(args.output + '.idx', paths, counts,
+                         np.concatenate(index_boxes) if index_boxes else np.zeros((0, 5)))
+        print('Compiled index {}.idx'.format(args.output))
+    # ru_maxrss is in kilobytes on Linux
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('Peak memory {:.1f} MB'.format(peak_kb / 1024))
+
+
+if __name__ == '__main__':
+    _main(parser.parse_args())
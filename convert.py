@@ -20,6 +20,8 @@ from keras.models import Model
 from keras.regularizers import l2
 from keras.utils.vis_utils import plot_model as plot
 
+from yolo3.weights import model_weights, save_flat_weights
+
 
 parser = argparse.ArgumentParser(description='Darknet To Keras Converter.')
 parser.add_argument('config_path', help='Path to Darknet cfg file.')
@@ -35,6 +37,11 @@ parser.add_argument(
     '--weights_only',
     help='Save as Keras weights file instead of model file.',
     action='store_true')
+parser.add_argument(
+    '-f',
+    '--flat',
+    choices=['float32', 'float16'],
+    help='Also save a memory-mappable flat weight file next to the output.')
 
 def unique_config_sections(config_file):
     """Convert all config sections to have unique names.
@@ -244,6 +251,9 @@ def _main(args):
     else:
         model.save('{}'.format(output_path))
         print('Saved Keras model to {}'.format(output_path))
+    if args.flat:
+        save_flat_weights(model_weights(model), '{}.flat'.format(output_root), args.flat)
+        print('Saved flat {} weights to {}.flat'.format(args.flat, output_root))
 
     # Check to see if all weights have been read.
     remaining_weights = len(weights_file.read()) / 4
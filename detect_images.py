@@ -0,0 +1,209 @@
+"""
+Detect objects in many images, writing one JSON line per image.
+
+Resumes where an interrupted run stopped, from the checkpoint file next to the output.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+from collections import deque
+from itertools import islice
+from timeit import default_timer as timer
+
+import numpy as np
+from PIL import Image
+
+from yolo import YOLO, draw_detections
+from yolo3.annotation import save_annotations
+from yolo3.utils import draft_image, letterbox_image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def list_images(input_path):
+    '''image paths of a directory tree in sorted order, or the first column of a list file'''
+    if os.path.isdir(input_path):
+        for root, dirs, files in os.walk(input_path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.join(root, name)
+    else:
+        # also takes train.txt style annotation files
+        with open(input_path) as f:
+            for line in f:
+                if line.strip():
+                    yield line.split()[0]
+
+
+def load_image(path, model_image_size):
+    '''decode and letterbox one image in a worker
+
+    Returns uint8 data, which keeps the transfer to the main process small.
+    '''
+    try:
+        image = Image.open(path)
+        image_shape = [image.height, image.width]
+        h, w = model_image_size
+        scale = min(w/image.width, h/image.height)
+        draft_image(image, (int(image.width*scale), int(image.height*scale)))
+        image_data = np.asarray(letterbox_image(image.convert('RGB'), (w, h)))
+        return path, image_data, image_shape, None
+    except (OSError, ValueError) as e:
+        return path, None, None, str(e)
+
+
+def draw_image(path, result, class_names, colors, output_path):
+    image = Image.open(path).convert('RGB')
+    draw_detections(image, *result, class_names, colors).save(output_path)
+
+
+def prefetch(pool, function, items, depth):
+    '''pool.imap that keeps at most depth results ahead of the consumer'''
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(function, item))
+        if len(pending) >= depth:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def detection_record(path, image_shape, result, class_names):
+    out_boxes, out_scores, out_classes = result
+    return {
+        'path': path,
+        'height': image_shape[0],
+        'width': image_shape[1],
+        'boxes': np.round(out_boxes, 2).tolist(), # top, left, bottom, right
+        'scores': np.round(out_scores, 4).tolist(),
+        'classes': [class_names[c] for c in out_classes],
+    }
+
+
+def write_index(jsonl_path, class_names):
+    '''compile the detections into an annotation index, with their scores in scores.npy'''
+    class_ids = {name: i for i, name in enumerate(class_names)}
+    paths, counts, boxes, scores = [], [], [], []
+    with open(jsonl_path) as f:
+        for line in f:
+            record = json.loads(line)
+            if 'error' in record:
+                continue
+            paths.append(record['path'].encode('utf8'))
+            counts.append(len(record['boxes']))
+            for (top, left, bottom, right), cls in zip(record['boxes'], record['classes']):
+                boxes.append([round(left), round(top), round(right), round(bottom),
+                              class_ids[cls]])
+            scores.extend(record['scores'])
+    index = save_annotations(jsonl_path + '.idx', paths, counts, np.array(boxes).reshape(-1, 5))
+    np.save(os.path.join(index.path, 'scores.npy'), np.array(scores, dtype='float32'))
+    return index
+
+
+def write_checkpoint(output, checkpoint_path, done):
+    '''flush the output and atomically record how many inputs it holds and where it ends'''
+    output.flush()
+    os.fsync(output.fileno())
+    with open(checkpoint_path + '.tmp', 'w') as f:
+        json.dump({'done': done, 'offset': output.tell()}, f)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+
+def _main(args):
+    output_path = args.output
+    checkpoint_path = output_path + '.ckpt'
+    done, offset = 0, 0
+    if os.path.isfile(checkpoint_path) and os.path.isfile(output_path) and not args.restart:
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        done, offset = checkpoint['done'], checkpoint['offset']
+        print('Resuming after {} images.'.format(done))
+    with open(output_path, 'a') as f:
+        # drop lines written after the last checkpoint, they are detected again
+        f.truncate(offset)
+    if args.draw_dir:
+        os.makedirs(args.draw_dir, exist_ok=True)
+
+    # fork the workers before TensorFlow starts its threads
+    pool = multiprocessing.Pool(args.workers)
+    yolo = YOLO(**{k: v for k, v in vars(args).items() if k in YOLO._defaults},
+                warmup_batch_sizes=(1, args.batch_size))
+    paths = islice(list_images(args.input), done, None)
+    start = timer()
+    num_images = 0
+    with pool, open(output_path, 'a') as output:
+        loaded = prefetch(pool, load_image, ((path, yolo.model_image_size) for path in paths),
+                          depth=4*args.batch_size)
+        drawings = deque()
+        batch = list(islice(loaded, args.batch_size))
+        while batch:
+            ok = [item for item in batch if item[3] is None]
+            results = iter(yolo.run_batch(np.stack([item[1] for item in ok]),
+                                          [item[2] for item in ok]) if ok else [])
+            for path, image_data, image_shape, error in batch:
+                if error is not None:
+                    output.write(json.dumps({'path': path, 'error': error}) + '\n')
+                else:
+                    result = next(results)
+                    record = detection_record(path, image_shape, result, yolo.class_names)
+                    output.write(json.dumps(record) + '\n')
+                    if args.draw_dir:
+                        # named by input position, which is also the output line
+                        draw_path = os.path.join(args.draw_dir, '{:08d}.jpg'.format(done))
+                        drawings.append(pool.apply_async(draw_image, (
+                            path, result, yolo.class_names, yolo.colors, draw_path)))
+                        while len(drawings) > 4*args.batch_size:
+                            drawings.popleft().get()
+                done += 1
+            num_images += len(batch)
+
+            if num_images % args.checkpoint_every < len(batch):
+                # a checkpoint skips its images on resume, so their drawings must be done
+                while drawings:
+                    drawings.popleft().get()
+                write_checkpoint(output, checkpoint_path, done)
+                print('{} images, {:.1f} images/sec'.format(done, num_images / (timer() - start)))
+            batch = list(islice(loaded, args.batch_size))
+        for drawing in drawings:
+            drawing.get()
+        write_checkpoint(output, checkpoint_path, done)
+    print('Detected objects in {} images, {:.1f} images/sec.'.format(
+        num_images, num_images / max(timer() - start, 1e-9)))
+
+    if args.index:
+        index = write_index(output_path, yolo.class_names)
+        print('Compiled index {}'.format(index.path))
+    yolo.close_session()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Bulk object detection over an image directory or list.')
+    parser.add_argument('input',
+        help='image directory, walked recursively, or a file listing image paths')
+    parser.add_argument('-o', '--output', default='detections.jsonl',
+        help='JSON lines output, default detections.jsonl')
+    parser.add_argument('--model_path', default=YOLO.get_defaults('model_path'),
+        help='path to model weight file, default ' + YOLO.get_defaults('model_path'))
+    parser.add_argument('--anchors_path', default=YOLO.get_defaults('anchors_path'),
+        help='path to anchor definitions, default ' + YOLO.get_defaults('anchors_path'))
+    parser.add_argument('--classes_path', default=YOLO.get_defaults('classes_path'),
+        help='path to class definitions, default ' + YOLO.get_defaults('classes_path'))
+    parser.add_argument('--score', type=float, default=YOLO.get_defaults('score'),
+        help='score threshold, default ' + str(YOLO.get_defaults('score')))
+    parser.add_argument('--batch_size', type=int, default=8,
+        help='images per network run, default 8')
+    parser.add_argument('--workers', type=int, default=None,
+        help='processes decoding images, default cpu count')
+    parser.add_argument('--draw_dir', default=None,
+        help='also save images with the boxes drawn there')
+    parser.add_argument('--index', default=False, action='store_true',
+        help='also compile the detections into an annotation index at <output>.idx')
+    parser.add_argument('--checkpoint_every', type=int, default=1024,
+        help='images between progress checkpoints, default 1024')
+    parser.add_argument('--restart', default=False, action='store_true',
+        help='ignore the checkpoint and start from the first image')
+    _main(parser.parse_args())
@@ -7,9 +7,10 @@ from eyewitness.flask_server import BboxObjectDetectionFlaskWrapper
 from eyewitness.config import BBOX
 from eyewitness.detection_result_filter import FeedbackBboxDeNoiseFilter
 from eyewitness.result_handler.db_writer import BboxPeeweeDbWriter
+from flask import jsonify
 from peewee import SqliteDatabase
 
-from naive_detector import YoloV3DetectorWrapper
+from naive_detector import YoloV3DetectorWrapper, parse_image_shapes
 from yolo import YOLO
 from line_detection_result_handler import LineAnnotationSender
 from facebook_detection_result_handler import FaceBookAnnoationSender
@@ -39,6 +40,11 @@ parser.add_argument(
     help='Number of GPU to use, default: ' + str(YOLO.get_defaults("gpu_num"))
 )
 
+parser.add_argument(
+    '--warmup_shapes', type=parse_image_shapes,
+    help='input shapes HxW,HxW to warm up before serving, default: model_image_size'
+)
+
 parser.add_argument(
     '--db_path', type=str, default='::memory::',
     help='the path used to store detection result records'
@@ -90,8 +96,10 @@ if __name__ == '__main__':
     logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
     args = parser.parse_args()
     detection_threshold = 0.7
-    # object detector
+    # object detector, built and warmed up before the server starts accepting requests
     object_detector = YoloV3DetectorWrapper(args, threshold=detection_threshold)
+    object_detector.build()
+    logging.info('detector ready, warm-up took %.2fs', object_detector.warmup_time)
 
     # detection result handlers
     result_handlers = []
@@ -143,5 +151,9 @@ if __name__ == '__main__':
         database=database, drawn_image_dir=args.drawn_image_dir,
         detection_result_filters=denoise_filters)
 
+    @flask_wrapper.app.route('/ready')
+    def ready():
+        return jsonify(ready=object_detector.is_ready, warmup_time=object_detector.warmup_time)
+
     params = {'host': args.detector_host, 'port': args.detector_port, 'threaded': False}
     flask_wrapper.app.run(**params)
@@ -0,0 +1,149 @@
+"""
+Evaluate a model on an annotation file, detecting once into a prediction cache.
+
+AP at other iou thresholds, PR curves and score threshold sweeps are then computed from
+the cache without running the network again.
+"""
+
+import argparse
+import json
+import multiprocessing
+from timeit import default_timer as timer
+
+import numpy as np
+
+from detect_images import load_image, prefetch
+from yolo import YOLO
+from yolo3.annotation import open_annotations
+from yolo3.evaluation import DetectionEvaluator, PredictionCache, prediction_key
+
+parser = argparse.ArgumentParser(
+    description='mAP of a model on an annotation file, e.g. 2007_test.txt.')
+parser.add_argument('annotation_path',
+    help='annotation file or compiled index of the evaluated images')
+parser.add_argument('--model_path', default=YOLO.get_defaults('model_path'),
+    help='path to model weight file, default ' + YOLO.get_defaults('model_path'))
+parser.add_argument('--anchors_path', default=YOLO.get_defaults('anchors_path'),
+    help='path to anchor definitions, default ' + YOLO.get_defaults('anchors_path'))
+parser.add_argument('--classes_path', default=YOLO.get_defaults('classes_path'),
+    help='path to class definitions, default ' + YOLO.get_defaults('classes_path'))
+parser.add_argument('--detections', default=None,
+    help='evaluate this detect_images.py output instead of running the model')
+parser.add_argument('--cache_dir', default='prediction_cache',
+    help='prediction cache, default prediction_cache')
+parser.add_argument('--cache_score', type=float, default=0.001,
+    help='score threshold of the cached detections, default 0.001')
+parser.add_argument('--iou', type=float, nargs='+', default=[0.5],
+    help='iou thresholds, default 0.5')
+parser.add_argument('--metric', choices=['voc07', 'area'], default='voc07',
+    help='11 point AP of VOC2007 or the area under the curve of later VOC, default voc07')
+parser.add_argument('--sweep', type=float, nargs='*', default=None,
+    help='also report precision and recall keeping the detections above these scores')
+parser.add_argument('--pr_curves', default=None,
+    help='save the PR curves of every class to this npz')
+parser.add_argument('--batch_size', type=int, default=8,
+    help='images per network run, default 8')
+parser.add_argument('--workers', type=int, default=None,
+    help='processes decoding images, default cpu count')
+
+
+def detect(yolo, annotations, batch_size, pool):
+    '''image position, box, score and class arrays of the detections on every image'''
+    images, boxes, scores, classes = [], [], [], []
+    items = ((path, yolo.model_image_size) for path in annotations.image_paths())
+    loaded = prefetch(pool, load_image, items, depth=4*batch_size)
+    batch = []
+    for i, (path, image_data, image_shape, error) in enumerate(loaded):
+        if error is not None:
+            raise IOError('{}: {}'.format(path, error))
+        batch.append((i, image_data, image_shape))
+        if len(batch) == batch_size or i == len(annotations) - 1:
+            results = yolo.run_batch(np.stack([item[1] for item in batch]),
+                                     [item[2] for item in batch])
+            for (j, _, _), (out_boxes, out_scores, out_classes) in zip(batch, results):
+                images.append(np.full(len(out_boxes), j))
+                # top, left, bottom, right to the x_min, y_min, x_max, y_max of the annotations
+                boxes.append(np.asarray(out_boxes).reshape(-1, 4)[:, [1, 0, 3, 2]])
+                scores.append(out_scores)
+                classes.append(out_classes)
+            batch = []
+    empty = [np.zeros(0, dtype='int64')]
+    return (np.concatenate(images + empty), np.concatenate(boxes + [np.zeros((0, 4))]),
+            np.concatenate(scores + empty), np.concatenate(classes + empty))
+
+
+def read_detections(jsonl_path, annotations, class_names):
+    '''detections of a detect_images.py output, for the images in the annotations'''
+    positions = {path: i for i, path in enumerate(annotations.image_paths())}
+    class_ids = {name: i for i, name in enumerate(class_names)}
+    images, boxes, scores, classes = [], [], [], []
+    with open(jsonl_path) as f:
+        for line in f:
+            record = json.loads(line)
+            i = positions.get(record['path'])
+            if i is None or 'error' in record:
+                continue
+            images.extend([i] * len(record['boxes']))
+            boxes.extend([left, top, right, bottom]
+                         for top, left, bottom, right in record['boxes'])
+            scores.extend(record['scores'])
+            classes.extend(class_ids[c] for c in record['classes'])
+    return images, boxes, scores, classes
+
+
+def _main(args):
+    annotations = open_annotations(args.annotation_path)
+    with open(args.classes_path) as f:
+        class_names = [c.strip() for c in f.readlines()]
+
+    source = args.detections or args.model_path
+    predictions = PredictionCache(args.cache_dir, prediction_key(
+        source, annotations, YOLO.get_defaults('model_image_size'), args.cache_score))
+    if predictions.complete:
+        print('Using {} cached detections from {}'.format(len(predictions), predictions.path))
+    elif args.detections:
+        detections = read_detections(args.detections, annotations, class_names)
+        predictions.save(*detections, source=source)
+    else:
+        # fork the workers before TensorFlow starts its threads
+        pool = multiprocessing.Pool(args.workers)
+        yolo = YOLO(model_path=args.model_path, anchors_path=args.anchors_path,
+                    classes_path=args.classes_path, score=args.cache_score,
+                    warmup_batch_sizes=(1, args.batch_size))
+        start = timer()
+        with pool:
+            detections = detect(yolo, annotations, args.batch_size, pool)
+        predictions.save(*detections, source=source, score=args.cache_score)
+        print('Detected on {} images in {:.1f}s, cached in {}'.format(
+            len(annotations), timer() - start, predictions.path))
+        yolo.close_session()
+
+    start = timer()
+    evaluator = DetectionEvaluator(annotations, predictions, len(class_names), args.iou)
+    ap = evaluator.average_precision(args.metric)
+    print('Evaluated in {:.2f}s'.format(timer() - start))
+    print('{:>20} '.format('iou') + ' '.join('{:>6.2f}'.format(t) for t in args.iou))
+    for c, name in enumerate(class_names):
+        if evaluator.num_positives[c]:
+            print('{:>20} '.format(name) + ' '.join('{:>6.4f}'.format(v) for v in ap[:, c]))
+    print('{:>20} '.format('mAP') + ' '.join('{:>6.4f}'.format(v) for v in np.nanmean(ap, axis=1)))
+
+    if args.sweep:
+        precision, recall = evaluator.threshold_sweep(args.sweep)
+        present = evaluator.num_positives > 0
+        for t, iou in enumerate(args.iou):
+            for s, score in enumerate(args.sweep):
+                print('iou {:.2f} score {:.3f}: mean precision {:.4f}, mean recall {:.4f}'.format(
+                    iou, score, precision[t, present, s].mean(), recall[t, present, s].mean()))
+    if args.pr_curves:
+        curves = {}
+        for c, name in enumerate(class_names):
+            recall, precision, scores = evaluator.pr_curve(c)
+            curves[name + '/recall'] = recall
+            curves[name + '/precision'] = precision
+            curves[name + '/score'] = scores
+        np.savez(args.pr_curves, iou=np.array(args.iou), **curves)
+
+
+if __name__ == '__main__':
+    _main(parser.parse_args())
@@ -0,0 +1,29 @@
+"""
+Convert a Keras .h5 model or weights file into a memory-mappable flat weight file.
+"""
+
+import argparse
+import os
+
+from yolo3.weights import read_h5_weights, save_flat_weights
+
+parser = argparse.ArgumentParser(description='Keras .h5 to flat weight file converter.')
+parser.add_argument('h5_path', help='Path to Keras .h5 model or weights file.')
+parser.add_argument('flat_path', help='Path to output .flat weight file.')
+parser.add_argument(
+    '--dtype', choices=['float32', 'float16'], default='float32',
+    help='Storage type of the weights, default float32')
+
+
+def _main(args):
+    h5_path = os.path.expanduser(args.h5_path)
+    flat_path = os.path.expanduser(args.flat_path)
+    assert h5_path.endswith('.h5'), '{} is not a .h5 file'.format(h5_path)
+    assert flat_path.endswith('.flat'), 'output path {} is not a .flat file'.format(flat_path)
+    weights = read_h5_weights(h5_path)
+    save_flat_weights(weights, flat_path, args.dtype)
+    print('Saved {} layers of {} to {}'.format(len(weights), h5_path, flat_path))
+
+
+if __name__ == '__main__':
+    _main(parser.parse_args())
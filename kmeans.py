@@ -1,47 +1,57 @@
-import numpy as np
+import argparse
+import multiprocessing
+from timeit import default_timer as timer
 
+import numpy as np
 
-class YOLO_Kmeans:
+from yolo3.annotation import open_annotations
 
-    def __init__(self, cluster_number, filename):
-        self.cluster_number = cluster_number
-        self.filename = "2012_train.txt"
 
-    def iou(self, boxes, clusters):  # 1 box -> k clusters
-        n = boxes.shape[0]
-        k = self.cluster_number
+_boxes = None
 
-        box_area = boxes[:, 0] * boxes[:, 1]
-        box_area = box_area.repeat(k)
-        box_area = np.reshape(box_area, (n, k))
 
-        cluster_area = clusters[:, 0] * clusters[:, 1]
-        cluster_area = np.tile(cluster_area, [1, n])
-        cluster_area = np.reshape(cluster_area, (n, k))
+def _set_boxes(boxes):
+    # handed to each pool worker once, rather than with every restart
+    global _boxes
+    _boxes = boxes
 
-        box_w_matrix = np.reshape(boxes[:, 0].repeat(k), (n, k))
-        cluster_w_matrix = np.reshape(np.tile(clusters[:, 0], (1, n)), (n, k))
-        min_w_matrix = np.minimum(cluster_w_matrix, box_w_matrix)
 
-        box_h_matrix = np.reshape(boxes[:, 1].repeat(k), (n, k))
-        cluster_h_matrix = np.reshape(np.tile(clusters[:, 1], (1, n)), (n, k))
-        min_h_matrix = np.minimum(cluster_h_matrix, box_h_matrix)
-        inter_area = np.multiply(min_w_matrix, min_h_matrix)
+class YOLO_Kmeans:
 
-        result = inter_area / (box_area + cluster_area - inter_area)
-        return result
+    def __init__(self, cluster_number, filename, restarts=8, batch_size=8192,
+                 iterations=200, sample_size=None, workers=None):
+        self.cluster_number = cluster_number
+        self.filename = filename
+        self.restarts = restarts
+        self.batch_size = batch_size
+        self.iterations = iterations
+        self.sample_size = sample_size
+        self.workers = workers
+
+    def iou(self, boxes, clusters):  # n boxes -> k clusters
+        boxes = np.asarray(boxes, dtype='float64')
+        clusters = np.asarray(clusters, dtype='float64')
+        inter_area = np.minimum(boxes[:, None, 0], clusters[None, :, 0]) * \
+            np.minimum(boxes[:, None, 1], clusters[None, :, 1])
+        box_area = boxes[:, 0] * boxes[:, 1]
+        cluster_area = clusters[:, 0] * clusters[:, 1]
+        return inter_area / (box_area[:, None] + cluster_area[None, :] - inter_area)
 
-    def avg_iou(self, boxes, clusters):
-        accuracy = np.mean([np.max(self.iou(boxes, clusters), axis=1)])
-        return accuracy
+    def avg_iou(self, boxes, clusters, chunk_size=1 << 20):
+        # in chunks, so tens of millions of boxes need no (n, k) matrix
+        total = 0.
+        for start in range(0, len(boxes), chunk_size):
+            total += np.sum(np.max(self.iou(boxes[start:start+chunk_size], clusters), axis=1))
+        return total / len(boxes)
 
-    def kmeans(self, boxes, k, dist=np.median):
+    def kmeans(self, boxes, k, dist=np.median, clusters=None):
         box_number = boxes.shape[0]
         distances = np.empty((box_number, k))
         last_nearest = np.zeros((box_number,))
-        np.random.seed()
-        clusters = boxes[np.random.choice(
-            box_number, k, replace=False)]  # init k clusters
+        if clusters is None:
+            np.random.seed()
+            clusters = boxes[np.random.choice(
+                box_number, k, replace=False)]  # init k clusters
         while True:
 
             distances = 1 - self.iou(boxes, clusters)
@@ -57,6 +67,65 @@ class YOLO_Kmeans:
 
         return clusters
 
+    def kmeans_plus_plus(self, boxes, k, rng):
+        # each next center is drawn with probability proportional to its squared 1 - IoU
+        clusters = [boxes[rng.randint(len(boxes))]]
+        distances = 1 - self.iou(boxes, clusters)[:, 0]
+        for _ in range(1, k):
+            weights = np.square(distances)
+            if weights.sum() == 0:
+                weights[:] = 1  # fewer distinct boxes than clusters
+            clusters.append(boxes[rng.choice(len(boxes), p=weights / weights.sum())])
+            distances = np.minimum(distances, 1 - self.iou(boxes, clusters[-1:])[:, 0])
+        return np.array(clusters, dtype='float64')
+
+    def minibatch_kmeans(self, boxes, k, seed, tol=1e-4):
+        # mini-batch k-means (Sculley 2010) with 1 - IoU as distance: every center moves
+        # toward the mean of its batch members with a step of 1 / (boxes it has seen)
+        rng = np.random.RandomState(seed)
+        batch_size = min(self.batch_size, len(boxes))
+        clusters = self.kmeans_plus_plus(boxes[rng.randint(len(boxes), size=batch_size)], k, rng)
+        counts = np.zeros(k)
+        for _ in range(self.iterations):
+            batch = boxes[rng.randint(len(boxes), size=batch_size)]
+            nearest = np.argmax(self.iou(batch, clusters), axis=1)
+            batch_counts = np.bincount(nearest, minlength=k)
+            sums = np.stack([np.bincount(nearest, weights=batch[:, i], minlength=k)
+                             for i in range(2)], axis=1)
+            counts += batch_counts
+            seen = batch_counts > 0
+            eta = batch_counts[seen] / counts[seen]
+            new_clusters = clusters.copy()
+            batch_means = sums[seen] / batch_counts[seen, None]
+            new_clusters[seen] += eta[:, None] * (batch_means - clusters[seen])
+            shift = np.max(np.abs(new_clusters - clusters) / clusters)
+            clusters = new_clusters
+            if shift < tol:
+                break
+        return clusters
+
+    def _restart(self, seed):
+        clusters = self.minibatch_kmeans(_boxes, self.cluster_number, seed)
+        # polish with the full median k-means on a sample, which every restart is scored on
+        rng = np.random.RandomState(0)
+        sample = _boxes[rng.randint(len(_boxes), size=min(len(_boxes), 100000))]
+        clusters = self.kmeans(sample, self.cluster_number, clusters=clusters)
+        return self.avg_iou(sample, clusters), clusters
+
+    def cluster(self, boxes):
+        # best of self.restarts mini-batch k-means runs, in parallel processes
+        if self.sample_size and len(boxes) > self.sample_size:
+            boxes = boxes[np.random.choice(len(boxes), self.sample_size, replace=False)]
+        seeds = np.random.randint(2**31, size=self.restarts)
+        if self.workers == 0 or self.restarts == 1:
+            _set_boxes(boxes)
+            results = [self._restart(seed) for seed in seeds]
+        else:
+            with multiprocessing.Pool(self.workers, initializer=_set_boxes,
+                                      initargs=(boxes,)) as pool:
+                results = pool.map(self._restart, seeds)
+        return max(results, key=lambda result: result[0])[1]
+
     def result2txt(self, data):
         f = open("yolo_anchors.txt", 'w')
         row = np.shape(data)[0]
@@ -69,24 +138,12 @@ class YOLO_Kmeans:
         f.close()
 
     def txt2boxes(self):
-        f = open(self.filename, 'r')
-        dataSet = []
-        for line in f:
-            infos = line.split(" ")
-            length = len(infos)
-            for i in range(1, length):
-                width = int(infos[i].split(",")[2]) - \
-                    int(infos[i].split(",")[0])
-                height = int(infos[i].split(",")[3]) - \
-                    int(infos[i].split(",")[1])
-                dataSet.append([width, height])
-        result = np.array(dataSet)
-        f.close()
-        return result
+        # parsed once into filename.idx, later runs read the compiled box table
+        return open_annotations(self.filename).box_sizes()
 
     def txt2clusters(self):
         all_boxes = self.txt2boxes()
-        result = self.kmeans(all_boxes, k=self.cluster_number)
+        result = self.cluster(all_boxes)
         result = result[np.lexsort(result.T[0, None])]
         self.result2txt(result)
         print("K anchors:\n {}".format(result))
@@ -94,8 +151,44 @@ class YOLO_Kmeans:
             self.avg_iou(all_boxes, result) * 100))
 
 
+def benchmark(cluster_number, sizes, restarts=8, workers=None):
+    # synthetic box sets, log-normal sizes around a few typical shapes
+    rng = np.random.RandomState(0)
+    kmeans = YOLO_Kmeans(cluster_number, None, restarts=restarts, workers=workers)
+    for n in sizes:
+        shapes = np.array([[30, 40], [60, 120], [120, 80], [200, 300], [350, 250]])
+        boxes = shapes[rng.randint(len(shapes), size=n)] * rng.lognormal(0, 0.35, size=(n, 2))
+        boxes = np.maximum(1, boxes).astype('int64')
+        for name, run, max_n in [('kmeans', lambda: kmeans.kmeans(boxes, cluster_number), 10**6),
+                                 ('mini-batch, restarts', lambda: kmeans.cluster(boxes), None)]:
+            if max_n and n > max_n:
+                print('{:>10} boxes {:<22} skipped, too slow'.format(n, name))
+                continue
+            start = timer()
+            clusters = run()
+            print('{:>10} boxes {:<22} {:8.2f} s, avg IoU {:.2f}%'.format(
+                n, name, timer() - start, kmeans.avg_iou(boxes, clusters) * 100))
+
+
 if __name__ == "__main__":
-    cluster_number = 9
-    filename = "2012_train.txt"
-    kmeans = YOLO_Kmeans(cluster_number, filename)
-    kmeans.txt2clusters()
+    parser = argparse.ArgumentParser(description='Cluster annotation boxes into YOLO anchors.')
+    parser.add_argument('filename', nargs='?', default='2012_train.txt',
+        help='annotation file or compiled index, default 2012_train.txt')
+    parser.add_argument('--clusters', type=int, default=9, help='number of anchors, default 9')
+    parser.add_argument('--restarts', type=int, default=8,
+        help='k-means runs to keep the best of, default 8')
+    parser.add_argument('--workers', type=int, default=None,
+        help='processes for the restarts, default cpu count, 0 for none')
+    parser.add_argument('--sample', type=int, default=None,
+        help='cluster a random sample of this many boxes, default all')
+    parser.add_argument('--benchmark', type=int, nargs='*', default=None,
+        help='time synthetic sets of these many boxes instead, e.g. 10000 100000 1000000')
+    args = parser.parse_args()
+
+    if args.benchmark is not None:
+        benchmark(args.clusters, args.benchmark or [10**4, 10**5, 10**6], args.restarts,
+                  args.workers)
+    else:
+        kmeans = YOLO_Kmeans(args.clusters, args.filename, restarts=args.restarts,
+                             sample_size=args.sample, workers=args.workers)
+        kmeans.txt2clusters()
@@ -1,6 +1,7 @@
 import argparse
 
 import arrow
+import PIL.Image
 
 from eyewitness.detection_utils import DetectionResult
 from eyewitness.config import BoundedBoxObject
@@ -37,6 +38,11 @@ parser.add_argument(
 )
 
 
+def parse_image_shapes(shapes_str):
+    """parse warm-up shapes given as 'HxW,HxW', e.g. '416x416,608x608'"""
+    return [tuple(int(i) for i in shape.split('x')) for shape in shapes_str.split(',') if shape]
+
+
 class YoloV3DetectorWrapper(ObjectDetector):
     def __init__(self, model_config, threshold=0.5):
         self.model_config = model_config
@@ -52,7 +58,16 @@ class YoloV3DetectorWrapper(ObjectDetector):
     def detect(self, image_obj) -> DetectionResult:
         if self.core_model is None:
             self.build()
-        (out_boxes, out_scores, out_classes) = self.core_model.predict(image_obj.pil_image_obj)
+        raw_image_path = getattr(image_obj, 'raw_image_path', None)
+        if raw_image_path:
+            # a private, not yet decoded copy can be drafted at reduced resolution, while
+            # image_obj.pil_image_obj is left untouched, full size for drawing the boxes
+            # later; the copy is the only decode of the request and closes its file
+            with PIL.Image.open(raw_image_path) as image:
+                (out_boxes, out_scores, out_classes) = self.core_model.predict(image, draft=True)
+        else:
+            (out_boxes, out_scores, out_classes) = self.core_model.predict(
+                image_obj.pil_image_obj)
         detected_objects = []
         for bbox, score, label_class in zip(out_boxes, out_scores, out_classes):
             label = self.core_model.class_names[label_class]
@@ -67,6 +82,15 @@ class YoloV3DetectorWrapper(ObjectDetector):
         detection_result = DetectionResult(image_dict)
         return detection_result
 
+    @property
+    def is_ready(self):
+        """whether the model is built and warmed up"""
+        return self.core_model is not None and self.core_model.ready
+
+    @property
+    def warmup_time(self):
+        return self.core_model.warmup_time if self.core_model is not None else None
+
     @property
     def valid_labels(self):
         return set(self.core_model.class_names)
@@ -0,0 +1,147 @@
+"""preprocess_true_boxes against the per-box loop it replaced."""
+
+import numpy as np
+import pytest
+
+from yolo3.model import preprocess_true_boxes
+
+YOLO_ANCHORS = np.array([[10, 13], [16, 30], [33, 23], [30, 61], [62, 45], [59, 119],
+                         [116, 90], [156, 198], [373, 326]], dtype='float64')
+TINY_ANCHORS = np.array([[10, 14], [23, 27], [37, 58], [81, 82], [135, 169], [344, 319]],
+                        dtype='float64')
+
+
+def loop_preprocess_true_boxes(true_boxes, input_shape, anchors, num_classes):
+    '''the original implementation, one image, box and layer at a time'''
+    num_layers = len(anchors)//3
+    anchor_mask = [[6,7,8], [3,4,5], [0,1,2]] if num_layers==3 else [[3,4,5], [1,2,3]]
+
+    true_boxes = np.array(true_boxes, dtype='float32')
+    input_shape = np.array(input_shape, dtype='int32')
+    boxes_xy = (true_boxes[..., 0:2] + true_boxes[..., 2:4]) // 2
+    boxes_wh = true_boxes[..., 2:4] - true_boxes[..., 0:2]
+    true_boxes[..., 0:2] = boxes_xy/input_shape[::-1]
+    true_boxes[..., 2:4] = boxes_wh/input_shape[::-1]
+
+    m = true_boxes.shape[0]
+    grid_shapes = [input_shape//{0:32, 1:16, 2:8}[l] for l in range(num_layers)]
+    y_true = [np.zeros((m,grid_shapes[l][0],grid_shapes[l][1],len(anchor_mask[l]),5+num_classes),
+        dtype='float32') for l in range(num_layers)]
+
+    anchors = np.expand_dims(anchors, 0)
+    anchor_maxes = anchors / 2.
+    anchor_mins = -anchor_maxes
+    valid_mask = boxes_wh[..., 0]>0
+
+    for b in range(m):
+        wh = boxes_wh[b, valid_mask[b]]
+        if len(wh)==0: continue
+        wh = np.expand_dims(wh, -2)
+        box_maxes = wh / 2.
+        box_mins = -box_maxes
+
+        intersect_mins = np.maximum(box_mins, anchor_mins)
+        intersect_maxes = np.minimum(box_maxes, anchor_maxes)
+        intersect_wh = np.maximum(intersect_maxes - intersect_mins, 0.)
+        intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
+        box_area = wh[..., 0] * wh[..., 1]
+        anchor_area = anchors[..., 0] * anchors[..., 1]
+        iou = intersect_area / (box_area + anchor_area - intersect_area)
+
+        best_anchor = np.argmax(iou, axis=-1)
+
+        for t, n in enumerate(best_anchor):
+            for l in range(num_layers):
+                if n in anchor_mask[l]:
+                    i = np.floor(true_boxes[b,t,0]*grid_shapes[l][1]).astype('int32')
+                    j = np.floor(true_boxes[b,t,1]*grid_shapes[l][0]).astype('int32')
+                    k = anchor_mask[l].index(n)
+                    c = true_boxes[b,t, 4].astype('int32')
+                    y_true[l][b, j, i, k, 0:4] = true_boxes[b,t, 0:4]
+                    y_true[l][b, j, i, k, 4] = 1
+                    y_true[l][b, j, i, k, 5+c] = 1
+
+    return y_true
+
+
+def random_boxes(rng, m, max_boxes, input_shape, num_classes, crowded=False):
+    '''integer boxes like get_random_data makes, zero padded at the end of every image
+
+    Crowded boxes all lie around one point, so many of them share a cell and anchor.
+    Some boxes reach past the input, with their centers still inside it.
+    '''
+    h, w = input_shape
+    true_boxes = np.zeros((m, max_boxes, 5), dtype='float32')
+    # always an image without boxes and one with max_boxes
+    counts = np.concatenate([[0, max_boxes], rng.randint(0, max_boxes + 1, m - 2)])
+    for b, n in enumerate(counts):
+        if crowded:
+            center = np.array([rng.randint(16, w - 16), rng.randint(16, h - 16)])
+            xy = center + rng.randint(-12, 13, (n, 2))
+            wh = rng.randint(8, 120, (n, 2))
+        else:
+            xy = np.stack([rng.randint(0, w, n), rng.randint(0, h, n)], axis=-1)
+            wh = rng.randint(2, max(h, w), (n, 2))
+        mins = xy - wh//2
+        maxes = mins + wh
+        true_boxes[b, :n, 0:2] = mins
+        true_boxes[b, :n, 2:4] = maxes
+        true_boxes[b, :n, 4] = rng.randint(0, num_classes, n)
+    return true_boxes
+
+
+@pytest.mark.parametrize('anchors', [YOLO_ANCHORS, TINY_ANCHORS], ids=['yolo', 'tiny'])
+@pytest.mark.parametrize('crowded', [False, True], ids=['spread', 'crowded'])
+def test_matches_loop(anchors, crowded):
+    rng = np.random.RandomState(10101)
+    num_classes = 7
+    for trial in range(50):
+        input_shape = [(416, 416), (320, 608), (608, 320)][trial % 3]
+        true_boxes = random_boxes(rng, 6, 20, input_shape, num_classes, crowded)
+        expected = loop_preprocess_true_boxes(true_boxes, input_shape, anchors, num_classes)
+        y_true = preprocess_true_boxes(true_boxes, input_shape, anchors, num_classes)
+        assert len(y_true) == len(expected)
+        for layer, expected_layer in zip(y_true, expected):
+            assert layer.dtype == expected_layer.dtype
+            np.testing.assert_array_equal(layer, expected_layer)
+
+
+def test_shared_cell():
+    # same cell and anchor: coordinates of the last box, class flags of both
+    true_boxes = np.zeros((1, 4, 5), dtype='float32')
+    true_boxes[0, 0] = [100, 100, 140, 140, 1]
+    true_boxes[0, 1] = [101, 101, 141, 141, 3]
+    y_true = preprocess_true_boxes(true_boxes, (416, 416), YOLO_ANCHORS, 5)
+    expected = loop_preprocess_true_boxes(true_boxes, (416, 416), YOLO_ANCHORS, 5)
+    for layer, expected_layer in zip(y_true, expected):
+        np.testing.assert_array_equal(layer, expected_layer)
+    cells = np.concatenate([layer[layer[..., 4] > 0] for layer in y_true])
+    assert len(cells) == 1
+    np.testing.assert_array_equal(cells[0, 5:], [0, 1, 0, 1, 0])
+    np.testing.assert_allclose(cells[0, 0:2], [121/416, 121/416])
+
+
+def test_cell_border():
+    # centers on the last row and column of every layer, and exactly on cell borders
+    true_boxes = np.zeros((1, 4, 5), dtype='float32')
+    true_boxes[0, 0] = [400, 400, 416, 416, 0]
+    true_boxes[0, 1] = [300, 300, 531, 531, 1]
+    true_boxes[0, 2] = [0, 0, 64, 64, 2]
+    true_boxes[0, 3] = [96, 16, 160, 48, 3]
+    y_true = preprocess_true_boxes(true_boxes, (416, 416), YOLO_ANCHORS, 4)
+    expected = loop_preprocess_true_boxes(true_boxes, (416, 416), YOLO_ANCHORS, 4)
+    for layer, expected_layer in zip(y_true, expected):
+        np.testing.assert_array_equal(layer, expected_layer)
+
+
+def test_center_outside_grid():
+    true_boxes = np.zeros((1, 2, 5), dtype='float32')
+    true_boxes[0, 0] = [420, 20, 460, 60, 0]
+    with pytest.raises(IndexError):
+        loop_preprocess_true_boxes(true_boxes, (416, 416), YOLO_ANCHORS, 1)
+    with pytest.raises(IndexError):
+        preprocess_true_boxes(true_boxes, (416, 416), YOLO_ANCHORS, 1)
+    # the loop wrapped negative cells around to the other side, now they raise as well
+    true_boxes[0, 0] = [-60, 20, -20, 60, 0]
+    with pytest.raises(IndexError):
+        preprocess_true_boxes(true_boxes, (416, 416), YOLO_ANCHORS, 1)
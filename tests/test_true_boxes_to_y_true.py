@@ -0,0 +1,70 @@
+"""true_boxes_to_y_true against preprocess_true_boxes, which it builds in the graph."""
+
+import numpy as np
+import pytest
+from keras import backend as K
+
+from yolo3.model import preprocess_true_boxes, true_boxes_to_y_true
+
+YOLO_ANCHORS = np.array([[10, 13], [16, 30], [33, 23], [30, 61], [62, 45], [59, 119],
+                         [116, 90], [156, 198], [373, 326]], dtype='float32')
+TINY_ANCHORS = np.array([[10, 14], [23, 27], [37, 58], [81, 82], [135, 169], [344, 319]],
+                        dtype='float32')
+
+
+def random_boxes(rng, counts, input_shape, num_classes, crowded=False, max_boxes=20):
+    '''integer boxes like get_random_data makes, zero padded at the end of every image
+
+    Crowded boxes all lie around one point, so many of them share a cell and anchor.
+    '''
+    h, w = input_shape
+    true_boxes = np.zeros((len(counts), max_boxes, 5), dtype='float32')
+    for b, n in enumerate(counts):
+        if crowded:
+            center = np.array([rng.randint(16, w - 16), rng.randint(16, h - 16)])
+            xy = center + rng.randint(-12, 13, (n, 2))
+            wh = rng.randint(8, 120, (n, 2))
+        else:
+            xy = np.stack([rng.randint(0, w, n), rng.randint(0, h, n)], axis=-1)
+            wh = rng.randint(2, max(h, w), (n, 2))
+        true_boxes[b, :n, 0:2] = xy - wh//2
+        true_boxes[b, :n, 2:4] = xy - wh//2 + wh
+        true_boxes[b, :n, 4] = rng.randint(0, num_classes, n)
+    return true_boxes
+
+
+def check_matches(true_boxes, input_shape, anchors, num_classes):
+    expected = preprocess_true_boxes(true_boxes, input_shape, anchors, num_classes)
+    y_true = K.get_session().run(true_boxes_to_y_true(
+        K.constant(true_boxes), input_shape, anchors, num_classes))
+    assert len(y_true) == len(expected)
+    for layer, expected_layer in zip(y_true, expected):
+        assert layer.shape == expected_layer.shape
+        np.testing.assert_array_equal(layer, expected_layer)
+
+
+@pytest.mark.parametrize('anchors', [YOLO_ANCHORS, TINY_ANCHORS], ids=['yolo', 'tiny'])
+@pytest.mark.parametrize('crowded', [False, True], ids=['spread', 'crowded'])
+def test_matches_preprocess_true_boxes(anchors, crowded):
+    rng = np.random.RandomState(10101)
+    num_classes = 7
+    for trial in range(10):
+        input_shape = [(416, 416), (320, 608), (608, 320)][trial % 3]
+        counts = np.concatenate([[0, 20], rng.randint(0, 21, 4)])
+        true_boxes = random_boxes(rng, counts, input_shape, num_classes, crowded)
+        check_matches(true_boxes, input_shape, anchors, num_classes)
+
+
+@pytest.mark.parametrize('anchors', [YOLO_ANCHORS, TINY_ANCHORS], ids=['yolo', 'tiny'])
+def test_no_boxes(anchors):
+    true_boxes = np.zeros((3, 20, 5), dtype='float32')
+    check_matches(true_boxes, (416, 416), anchors, 4)
+
+
+def test_shared_cell():
+    # same cell and anchor: coordinates of the last box, class flags of both
+    true_boxes = np.zeros((1, 4, 5), dtype='float32')
+    true_boxes[0, 0] = [100, 100, 140, 140, 1]
+    true_boxes[0, 1] = [101, 101, 141, 141, 3]
+    true_boxes[0, 2] = [102, 102, 142, 142, 1]
+    check_matches(true_boxes, (416, 416), YOLO_ANCHORS, 5)
@@ -0,0 +1,101 @@
+"""yolo_loss against the per-image while_loop ignore mask it replaced."""
+
+import numpy as np
+import pytest
+import tensorflow as tf
+from keras import backend as K
+
+from yolo3.model import box_iou, preprocess_true_boxes, yolo_head, yolo_loss
+
+YOLO_ANCHORS = np.array([[10, 13], [16, 30], [33, 23], [30, 61], [62, 45], [59, 119],
+                         [116, 90], [156, 198], [373, 326]], dtype='float32')
+TINY_ANCHORS = np.array([[10, 14], [23, 27], [37, 58], [81, 82], [135, 169], [344, 319]],
+                        dtype='float32')
+
+
+def while_loop_yolo_loss(args, anchors, num_classes, ignore_thresh=.5):
+    '''the original yolo_loss, finding the ignore mask one image at a time'''
+    num_layers = len(anchors)//3
+    yolo_outputs = args[:num_layers]
+    y_true = args[num_layers:]
+    anchor_mask = [[6,7,8], [3,4,5], [0,1,2]] if num_layers==3 else [[3,4,5], [1,2,3]]
+    input_shape = K.cast(K.shape(yolo_outputs[0])[1:3] * 32, K.dtype(y_true[0]))
+    grid_shapes = [K.cast(K.shape(yolo_outputs[l])[1:3], K.dtype(y_true[0]))
+                   for l in range(num_layers)]
+    loss = 0
+    m = K.shape(yolo_outputs[0])[0]
+    mf = K.cast(m, K.dtype(yolo_outputs[0]))
+
+    for l in range(num_layers):
+        object_mask = y_true[l][..., 4:5]
+        true_class_probs = y_true[l][..., 5:]
+
+        grid, raw_pred, pred_xy, pred_wh = yolo_head(yolo_outputs[l],
+             anchors[anchor_mask[l]], num_classes, input_shape, calc_loss=True)
+        pred_box = K.concatenate([pred_xy, pred_wh])
+
+        raw_true_xy = y_true[l][..., :2]*grid_shapes[l][::-1] - grid
+        raw_true_wh = K.log(y_true[l][..., 2:4] / anchors[anchor_mask[l]] * input_shape[::-1])
+        raw_true_wh = K.switch(object_mask, raw_true_wh, K.zeros_like(raw_true_wh))
+        box_loss_scale = 2 - y_true[l][...,2:3]*y_true[l][...,3:4]
+
+        ignore_mask = tf.TensorArray(K.dtype(y_true[0]), size=1, dynamic_size=True)
+        object_mask_bool = K.cast(object_mask, 'bool')
+        def loop_body(b, ignore_mask):
+            true_box = tf.boolean_mask(y_true[l][b,...,0:4], object_mask_bool[b,...,0])
+            iou = box_iou(pred_box[b], true_box)
+            best_iou = K.max(iou, axis=-1)
+            ignore_mask = ignore_mask.write(b, K.cast(best_iou<ignore_thresh, K.dtype(true_box)))
+            return b+1, ignore_mask
+        _, ignore_mask = tf.while_loop(lambda b,*args: b<m, loop_body, [0, ignore_mask])
+        ignore_mask = ignore_mask.stack()
+        ignore_mask = K.expand_dims(ignore_mask, -1)
+
+        xy_loss = object_mask * box_loss_scale * K.binary_crossentropy(
+            raw_true_xy, raw_pred[...,0:2], from_logits=True)
+        wh_loss = object_mask * box_loss_scale * 0.5 * K.square(raw_true_wh-raw_pred[...,2:4])
+        confidence_loss = object_mask * K.binary_crossentropy(
+            object_mask, raw_pred[...,4:5], from_logits=True) + (1-object_mask) * \
+            K.binary_crossentropy(object_mask, raw_pred[...,4:5], from_logits=True) * ignore_mask
+        class_loss = object_mask * K.binary_crossentropy(
+            true_class_probs, raw_pred[...,5:], from_logits=True)
+
+        loss += (K.sum(xy_loss) + K.sum(wh_loss) + K.sum(confidence_loss) + K.sum(class_loss)) / mf
+    return loss
+
+
+def random_batch(rng, anchors, num_classes, counts, input_shape=(416, 416), max_boxes=20):
+    '''network outputs and preprocess_true_boxes targets for images with counts boxes
+
+    Raw outputs near zero give boxes of about anchor size in every cell, so part of the
+    predictions overlap a true box by more than the ignore threshold and part do not.
+    '''
+    h, w = input_shape
+    true_boxes = np.zeros((len(counts), max_boxes, 5), dtype='float32')
+    for b, n in enumerate(counts):
+        xy = np.stack([rng.randint(0, w, n), rng.randint(0, h, n)], axis=-1)
+        wh = rng.randint(4, min(h, w)//2, (n, 2))
+        true_boxes[b, :n, 0:2] = np.maximum(xy - wh//2, 0)
+        true_boxes[b, :n, 2:4] = np.minimum(xy - wh//2 + wh, [w, h])
+        true_boxes[b, :n, 4] = rng.randint(0, num_classes, n)
+    y_true = preprocess_true_boxes(true_boxes, input_shape, anchors, num_classes)
+    num_anchors = len(anchors)//len(y_true)
+    yolo_outputs = [rng.normal(0, 1.5, layer.shape[:3] + (num_anchors*(num_classes+5),))
+                    .astype('float32') for layer in y_true]
+    return yolo_outputs, y_true
+
+
+@pytest.mark.parametrize('anchors', [YOLO_ANCHORS, TINY_ANCHORS], ids=['yolo', 'tiny'])
+@pytest.mark.parametrize('ignore_thresh', [0.1, 0.5])
+@pytest.mark.parametrize('counts', [[0, 20, 3, 11], [0, 0], [20, 20], [1]],
+                         ids=['mixed', 'no_boxes', 'max_boxes', 'single'])
+def test_matches_while_loop(anchors, ignore_thresh, counts):
+    rng = np.random.RandomState(10101)
+    num_classes = 5
+    for _ in range(3):
+        yolo_outputs, y_true = random_batch(rng, anchors, num_classes, counts)
+        args = [K.constant(a) for a in yolo_outputs + y_true]
+        loss, expected = K.get_session().run([
+            yolo_loss(args, anchors, num_classes, ignore_thresh),
+            while_loop_yolo_loss(args, anchors, num_classes, ignore_thresh)])
+        np.testing.assert_allclose(loss, expected, rtol=1e-5)
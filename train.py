@@ -9,8 +9,15 @@ from keras.models import Model
 from keras.optimizers import Adam
 from keras.callbacks import TensorBoard, ModelCheckpoint, ReduceLROnPlateau, EarlyStopping
 
-from yolo3.model import preprocess_true_boxes, yolo_body, tiny_yolo_body, yolo_loss
+from yolo3.model import preprocess_true_boxes, yolo_body, tiny_yolo_body, yolo_loss, \
+    true_boxes_to_y_true
 from yolo3.utils import get_random_data
+from yolo3.annotation import open_annotations
+from yolo3.loader import ParallelDataGenerator, ValidationCache
+from yolo3.image_cache import ImageCache
+from yolo3.shards import ShardedDataset, pack_shards
+from yolo3.optimizers import AccumulatingAdam
+from yolo3.profiler import ProfiledGenerator, ThroughputProfiler
 
 
 def _main():
@@ -23,46 +30,100 @@ def _main():
     anchors = get_anchors(anchors_path)
 
     input_shape = (416,416) # multiple of 32, hw
+    num_workers = 0 # >0 to augment and encode batches in that many processes
+    sparse_targets = False # feed boxes only and build y_true in the graph
+    image_cache_path = None # e.g. 'logs/image_cache' to decode every image only once
+    cache_validation = True # validate on the same un-augmented batches every epoch
+    shard_dir = None # e.g. 'logs/shards' to read training images from a few large files
+    accum_steps = 1 # >1 to split each batch into micro-batches, must divide the batch sizes
+    frozen_batch_size = 32
+    unfrozen_batch_size = 32 # note that more GPU memory is required after unfreezing the body
+    for size in (frozen_batch_size, unfrozen_batch_size):
+        if size % accum_steps:
+            raise ValueError('accum_steps={} does not divide the batch size {}, the effective '
+                             'batch would shrink to {}'.format(
+                                 accum_steps, size, size//accum_steps*accum_steps))
 
     is_tiny_version = len(anchors)==6 # default setting
     if is_tiny_version:
         model = create_tiny_model(input_shape, anchors, num_classes,
-            freeze_body=2, weights_path='model_data/tiny_yolo_weights.h5')
+            freeze_body=2, weights_path='model_data/tiny_yolo_weights.h5',
+            sparse_targets=sparse_targets)
     else:
+        # make sure you know what you freeze
         model = create_model(input_shape, anchors, num_classes,
-            freeze_body=2, weights_path='model_data/yolo_weights.h5') # make sure you know what you freeze
+            freeze_body=2, weights_path='model_data/yolo_weights.h5',
+            sparse_targets=sparse_targets)
 
     logging = TensorBoard(log_dir=log_dir)
-    checkpoint = ModelCheckpoint(log_dir + 'ep{epoch:03d}-loss{loss:.3f}-val_loss{val_loss:.3f}.h5',
+    checkpoint = ModelCheckpoint(
+        log_dir + 'ep{epoch:03d}-loss{loss:.3f}-val_loss{val_loss:.3f}.h5',
         monitor='val_loss', save_weights_only=True, save_best_only=True, period=3)
     reduce_lr = ReduceLROnPlateau(monitor='val_loss', factor=0.1, patience=3, verbose=1)
     early_stopping = EarlyStopping(monitor='val_loss', min_delta=0, patience=10, verbose=1)
 
     val_split = 0.1
-    with open(annotation_path) as f:
-        lines = f.readlines()
+    lines = open_annotations(annotation_path) # compiled to annotation_path.idx once
     np.random.seed(10101)
-    np.random.shuffle(lines)
+    lines = lines[np.random.permutation(len(lines))]
     np.random.seed(None)
     num_val = int(len(lines)*val_split)
     num_train = len(lines) - num_val
 
+    image_cache = None
+    if image_cache_path:
+        image_cache = ImageCache(image_cache_path)
+        num_decoded = image_cache.build(lines.image_paths(), workers=num_workers)
+        print('Decoded {} images into {}.'.format(num_decoded, image_cache_path))
+    train_lines = lines[:num_train]
+    if shard_dir:
+        train_lines = pack_shards(train_lines, shard_dir)
+    val_cache = None
+    if cache_validation and num_val > 0:
+        val_cache = ValidationCache(lines[num_train:], input_shape, cache_dir=log_dir,
+            image_cache=image_cache)
+
+    def optimizer(lr):
+        if accum_steps > 1:
+            return AccumulatingAdam(lr=lr, accum_steps=accum_steps)
+        return Adam(lr=lr)
+
+    def validation_generator(batch_size):
+        # its period is validation_steps, so every epoch sees the same batches
+        if val_cache is not None:
+            return val_cache.generator(batch_size, anchors, num_classes, sparse_targets)
+        return data_generator_wrapper(lines[num_train:], batch_size, input_shape, anchors,
+            num_classes, num_workers, sparse_targets, image_cache)
+
+    def close_generators(*generators):
+        # stop the loader processes of a stage before the next one starts its own
+        for generator in generators:
+            if generator is not None:
+                generator.close()
+
     # Train with frozen layers first, to get a stable loss.
     # Adjust num epochs to your dataset. This step is enough to obtain a not bad model.
     if True:
-        model.compile(optimizer=Adam(lr=1e-3), loss={
+        model.compile(optimizer=optimizer(1e-3), loss={
             # use custom yolo_loss Lambda layer.
             'yolo_loss': lambda y_true, y_pred: y_pred})
 
-        batch_size = 32
-        print('Train on {} samples, val on {} samples, with batch size {}.'.format(num_train, num_val, batch_size))
-        model.fit_generator(data_generator_wrapper(lines[:num_train], batch_size, input_shape, anchors, num_classes),
-                steps_per_epoch=max(1, num_train//batch_size),
-                validation_data=data_generator_wrapper(lines[num_train:], batch_size, input_shape, anchors, num_classes),
-                validation_steps=max(1, num_val//batch_size),
+        batch_size = frozen_batch_size
+        micro_batch_size = batch_size//accum_steps # what has to fit in memory
+        print('Train on {} samples, val on {} samples, with batch size {}.'.format(
+            num_train, num_val, batch_size))
+        train_data = data_generator_wrapper(train_lines, micro_batch_size, input_shape, anchors,
+            num_classes, num_workers, sparse_targets, image_cache)
+        val_data = validation_generator(micro_batch_size)
+        train_generator = ProfiledGenerator(train_data)
+        model.fit_generator(train_generator,
+                steps_per_epoch=max(1, num_train//batch_size)*accum_steps,
+                validation_data=val_data,
+                validation_steps=max(1, num_val//micro_batch_size),
                 epochs=50,
                 initial_epoch=0,
-                callbacks=[logging, checkpoint])
+                callbacks=[logging, checkpoint, ThroughputProfiler(log_dir, train_generator)])
+        close_generators(train_data, val_data)
         model.save_weights(log_dir + 'trained_weights_stage_1.h5')
 
     # Unfreeze and continue training, to fine-tune.
@@ -70,18 +131,27 @@ def _main():
     if True:
         for i in range(len(model.layers)):
             model.layers[i].trainable = True
-        model.compile(optimizer=Adam(lr=1e-4), loss={'yolo_loss': lambda y_true, y_pred: y_pred}) # recompile to apply the change
+        # recompile to apply the change
+        model.compile(optimizer=optimizer(1e-4), loss={'yolo_loss': lambda y_true, y_pred: y_pred})
         print('Unfreeze all of the layers.')
 
-        batch_size = 32 # note that more GPU memory is required after unfreezing the body
-        print('Train on {} samples, val on {} samples, with batch size {}.'.format(num_train, num_val, batch_size))
-        model.fit_generator(data_generator_wrapper(lines[:num_train], batch_size, input_shape, anchors, num_classes),
-            steps_per_epoch=max(1, num_train//batch_size),
-            validation_data=data_generator_wrapper(lines[num_train:], batch_size, input_shape, anchors, num_classes),
-            validation_steps=max(1, num_val//batch_size),
+        batch_size = unfrozen_batch_size
+        micro_batch_size = batch_size//accum_steps # what has to fit in memory
+        print('Train on {} samples, val on {} samples, with batch size {}.'.format(
+            num_train, num_val, batch_size))
+        train_data = data_generator_wrapper(train_lines, micro_batch_size, input_shape, anchors,
+            num_classes, num_workers, sparse_targets, image_cache)
+        val_data = validation_generator(micro_batch_size)
+        train_generator = ProfiledGenerator(train_data)
+        model.fit_generator(train_generator,
+            steps_per_epoch=max(1, num_train//batch_size)*accum_steps,
+            validation_data=val_data,
+            validation_steps=max(1, num_val//micro_batch_size),
             epochs=100,
             initial_epoch=50,
-            callbacks=[logging, checkpoint, reduce_lr, early_stopping])
+            callbacks=[logging, checkpoint, reduce_lr, early_stopping,
+                       ThroughputProfiler(log_dir, train_generator)])
+        close_generators(train_data, val_data)
         model.save_weights(log_dir + 'trained_weights_final.h5')
 
     # Further training if needed.
@@ -102,16 +172,32 @@ def get_anchors(anchors_path):
     return np.array(anchors).reshape(-1, 2)
 
 
+def create_targets(input_shape, anchors, num_classes, sparse_targets=False, max_boxes=20):
+    '''create the target inputs of the training model and the y_true tensors they give
+
+    With sparse_targets only a (max_boxes, 5) box tensor is fed per image and the
+    dense y_true tensors are scattered from it inside the graph.
+    '''
+    h, w = input_shape
+    num_layers = len(anchors)//3 # default setting
+    if sparse_targets:
+        true_boxes = Input(shape=(max_boxes, 5))
+        y_true = Lambda(true_boxes_to_y_true, name='y_true',
+            arguments={'input_shape': input_shape, 'anchors': anchors,
+                       'num_classes': num_classes})(true_boxes)
+        return [true_boxes], y_true
+    y_true = [Input(shape=(h//{0:32, 1:16, 2:8}[l], w//{0:32, 1:16, 2:8}[l], \
+        len(anchors)//num_layers, num_classes+5)) for l in range(num_layers)]
+    return y_true, y_true
+
 def create_model(input_shape, anchors, num_classes, load_pretrained=True, freeze_body=2,
-            weights_path='model_data/yolo_weights.h5'):
+            weights_path='model_data/yolo_weights.h5', sparse_targets=False):
     '''create the training model'''
     K.clear_session() # get a new session
     image_input = Input(shape=(None, None, 3))
-    h, w = input_shape
     num_anchors = len(anchors)
 
-    y_true = [Input(shape=(h//{0:32, 1:16, 2:8}[l], w//{0:32, 1:16, 2:8}[l], \
-        num_anchors//3, num_classes+5)) for l in range(3)]
+    target_inputs, y_true = create_targets(input_shape, anchors, num_classes, sparse_targets)
 
     model_body = yolo_body(image_input, num_anchors//3, num_classes)
     print('Create YOLOv3 model with {} anchors and {} classes.'.format(num_anchors, num_classes))
@@ -123,28 +209,28 @@ def create_model(input_shape, anchors, num_classes, load_pretrained=True, freeze
             # Freeze darknet53 body or freeze all but 3 output layers.
             num = (185, len(model_body.layers)-3)[freeze_body-1]
             for i in range(num): model_body.layers[i].trainable = False
-            print('Freeze the first {} layers of total {} layers.'.format(num, len(model_body.layers)))
+            print('Freeze the first {} layers of total {} layers.'.format(
+                num, len(model_body.layers)))
 
     model_loss = Lambda(yolo_loss, output_shape=(1,), name='yolo_loss',
         arguments={'anchors': anchors, 'num_classes': num_classes, 'ignore_thresh': 0.5})(
         [*model_body.output, *y_true])
-    model = Model([model_body.input, *y_true], model_loss)
+    model = Model([model_body.input, *target_inputs], model_loss)
 
     return model
 
 def create_tiny_model(input_shape, anchors, num_classes, load_pretrained=True, freeze_body=2,
-            weights_path='model_data/tiny_yolo_weights.h5'):
+            weights_path='model_data/tiny_yolo_weights.h5', sparse_targets=False):
     '''create the training model, for Tiny YOLOv3'''
     K.clear_session() # get a new session
     image_input = Input(shape=(None, None, 3))
-    h, w = input_shape
     num_anchors = len(anchors)
 
-    y_true = [Input(shape=(h//{0:32, 1:16}[l], w//{0:32, 1:16}[l], \
-        num_anchors//2, num_classes+5)) for l in range(2)]
+    target_inputs, y_true = create_targets(input_shape, anchors, num_classes, sparse_targets)
 
     model_body = tiny_yolo_body(image_input, num_anchors//2, num_classes)
-    print('Create Tiny YOLOv3 model with {} anchors and {} classes.'.format(num_anchors, num_classes))
+    print('Create Tiny YOLOv3 model with {} anchors and {} classes.'.format(
+        num_anchors, num_classes))
 
     if load_pretrained:
         model_body.load_weights(weights_path, by_name=True, skip_mismatch=True)
@@ -153,38 +239,56 @@ def create_tiny_model(input_shape, anchors, num_classes, load_pretrained=True, f
             # Freeze the darknet body or freeze all but 2 output layers.
             num = (20, len(model_body.layers)-2)[freeze_body-1]
             for i in range(num): model_body.layers[i].trainable = False
-            print('Freeze the first {} layers of total {} layers.'.format(num, len(model_body.layers)))
+            print('Freeze the first {} layers of total {} layers.'.format(
+                num, len(model_body.layers)))
 
     model_loss = Lambda(yolo_loss, output_shape=(1,), name='yolo_loss',
         arguments={'anchors': anchors, 'num_classes': num_classes, 'ignore_thresh': 0.7})(
         [*model_body.output, *y_true])
-    model = Model([model_body.input, *y_true], model_loss)
+    model = Model([model_body.input, *target_inputs], model_loss)
 
     return model
 
-def data_generator(annotation_lines, batch_size, input_shape, anchors, num_classes):
-    '''data generator for fit_generator'''
-    n = len(annotation_lines)
-    i = 0
+def shuffled_records(annotation_lines):
+    '''yield annotation_lines endlessly, in a new random order every pass'''
+    order = np.arange(len(annotation_lines))
+    while True:
+        np.random.shuffle(order)
+        for i in order:
+            yield annotation_lines[i]
+
+def data_generator(annotation_lines, batch_size, input_shape, anchors, num_classes,
+        sparse_targets=False, image_cache=None):
+    '''data generator for fit_generator, annotation_lines may also be a ShardedDataset'''
+    if isinstance(annotation_lines, ShardedDataset):
+        records = annotation_lines.records()
+    else:
+        records = shuffled_records(annotation_lines)
     while True:
         image_data = []
         box_data = []
         for b in range(batch_size):
-            if i==0:
-                np.random.shuffle(annotation_lines)
-            image, box = get_random_data(annotation_lines[i], input_shape, random=True)
+            image, box = get_random_data(next(records), input_shape, random=True,
+                image_cache=image_cache)
             image_data.append(image)
             box_data.append(box)
-            i = (i+1) % n
         image_data = np.array(image_data)
         box_data = np.array(box_data)
+        if sparse_targets:
+            yield [image_data, box_data], np.zeros(batch_size)
+            continue
         y_true = preprocess_true_boxes(box_data, input_shape, anchors, num_classes)
         yield [image_data, *y_true], np.zeros(batch_size)
 
-def data_generator_wrapper(annotation_lines, batch_size, input_shape, anchors, num_classes):
+def data_generator_wrapper(annotation_lines, batch_size, input_shape, anchors, num_classes,
+        workers=0, sparse_targets=False, image_cache=None):
     n = len(annotation_lines)
     if n==0 or batch_size<=0: return None
-    return data_generator(annotation_lines, batch_size, input_shape, anchors, num_classes)
+    if workers > 0:
+        return ParallelDataGenerator(annotation_lines, batch_size, input_shape, anchors,
+            num_classes, workers=workers, sparse_targets=sparse_targets, image_cache=image_cache)
+    return data_generator(annotation_lines, batch_size, input_shape, anchors, num_classes,
+        sparse_targets, image_cache)
 
 if __name__ == '__main__':
     _main()
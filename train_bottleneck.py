@@ -1,7 +1,6 @@
 """
 Retrain the YOLO model for your own dataset.
 """
-import os
 import numpy as np
 import keras.backend as K
 from keras.layers import Input, Lambda
@@ -11,6 +10,7 @@ from keras.callbacks import TensorBoard, ModelCheckpoint, ReduceLROnPlateau, Ear
 
 from yolo3.model import preprocess_true_boxes, yolo_body, tiny_yolo_body, yolo_loss
 from yolo3.utils import get_random_data
+from yolo3.bottleneck_cache import BottleneckCache, bottleneck_key
 
 
 def _main():
@@ -23,9 +23,12 @@ def _main():
     anchors = get_anchors(anchors_path)
 
     input_shape = (416,416) # multiple of 32, hw
+    weights_path = 'model_data/yolo_weights.h5'
+    bottleneck_dir = 'bottlenecks' # one sub directory per weights, annotations and input shape
+    bottleneck_dtype = 'float32' # or 'float16' for half the disk space, features rounded
 
     model, bottleneck_model, last_layer_model = create_model(input_shape, anchors, num_classes,
-            freeze_body=2, weights_path='model_data/yolo_weights.h5') # make sure you know what you freeze
+            freeze_body=2, weights_path=weights_path) # make sure you know what you freeze
 
     logging = TensorBoard(log_dir=log_dir)
     checkpoint = ModelCheckpoint(log_dir + 'ep{epoch:03d}-loss{loss:.3f}-val_loss{val_loss:.3f}.h5',
@@ -46,26 +49,22 @@ def _main():
     # Adjust num epochs to your dataset. This step is enough to obtain a not bad model.
     if True:
         # perform bottleneck training
-        if not os.path.isfile("bottlenecks.npz"):
+        key = bottleneck_key(weights_path, lines, input_shape, bottleneck_dtype)
+        bottlenecks = BottleneckCache(bottleneck_dir, key, bottleneck_dtype)
+        if not bottlenecks.complete:
             print("calculating bottlenecks")
-            batch_size=8
-            bottlenecks=bottleneck_model.predict_generator(data_generator_wrapper(lines, batch_size, input_shape, anchors, num_classes, random=False, verbose=True),
-             steps=(len(lines)//batch_size)+1, max_queue_size=1)
-            np.savez("bottlenecks.npz", bot0=bottlenecks[0], bot1=bottlenecks[1], bot2=bottlenecks[2])
-    
-        # load bottleneck features from file
-        dict_bot=np.load("bottlenecks.npz")
-        bottlenecks_train=[dict_bot["bot0"][:num_train], dict_bot["bot1"][:num_train], dict_bot["bot2"][:num_train]]
-        bottlenecks_val=[dict_bot["bot0"][num_train:], dict_bot["bot1"][num_train:], dict_bot["bot2"][num_train:]]
+            bottlenecks.build(bottleneck_model, lines, input_shape, batch_size=8)
 
         # train last layers with fixed bottleneck features
         batch_size=8
         print("Training last layers with bottleneck features")
         print('with {} samples, val on {} samples and batch size {}.'.format(num_train, num_val, batch_size))
         last_layer_model.compile(optimizer='adam', loss={'yolo_loss': lambda y_true, y_pred: y_pred})
-        last_layer_model.fit_generator(bottleneck_generator(lines[:num_train], batch_size, input_shape, anchors, num_classes, bottlenecks_train),
+        last_layer_model.fit_generator(
+                bottlenecks.generator(0, num_train, batch_size, input_shape, anchors, num_classes),
                 steps_per_epoch=max(1, num_train//batch_size),
-                validation_data=bottleneck_generator(lines[num_train:], batch_size, input_shape, anchors, num_classes, bottlenecks_val),
+                validation_data=bottlenecks.generator(num_train, len(lines), batch_size,
+                    input_shape, anchors, num_classes, shuffle=False),
                 validation_steps=max(1, num_val//batch_size),
                 epochs=30,
                 initial_epoch=0, max_queue_size=1)
@@ -150,7 +149,7 @@ def create_model(input_shape, anchors, num_classes, load_pretrained=True, freeze
     out1=model_body.layers[246].output
     out2=model_body.layers[247].output
     out3=model_body.layers[248].output
-    bottleneck_model = Model([model_body.input, *y_true], [out1, out2, out3])
+    bottleneck_model = Model(model_body.input, [out1, out2, out3])
 
     # create last layer model of last layers from yolo model
     in0 = Input(shape=bottleneck_model.output[0].shape[1:].as_list()) 
@@ -199,24 +198,5 @@ def data_generator_wrapper(annotation_lines, batch_size, input_shape, anchors, n
     if n==0 or batch_size<=0: return None
     return data_generator(annotation_lines, batch_size, input_shape, anchors, num_classes, random, verbose)
 
-def bottleneck_generator(annotation_lines, batch_size, input_shape, anchors, num_classes, bottlenecks):
-    n = len(annotation_lines)
-    i = 0
-    while True:
-        box_data = []
-        b0=np.zeros((batch_size,bottlenecks[0].shape[1],bottlenecks[0].shape[2],bottlenecks[0].shape[3]))
-        b1=np.zeros((batch_size,bottlenecks[1].shape[1],bottlenecks[1].shape[2],bottlenecks[1].shape[3]))
-        b2=np.zeros((batch_size,bottlenecks[2].shape[1],bottlenecks[2].shape[2],bottlenecks[2].shape[3]))
-        for b in range(batch_size):
-            _, box = get_random_data(annotation_lines[i], input_shape, random=False, proc_img=False)
-            box_data.append(box)
-            b0[b]=bottlenecks[0][i]
-            b1[b]=bottlenecks[1][i]
-            b2[b]=bottlenecks[2][i]
-            i = (i+1) % n
-        box_data = np.array(box_data)
-        y_true = preprocess_true_boxes(box_data, input_shape, anchors, num_classes)
-        yield [b0, b1, b2, *y_true], np.zeros(batch_size)
-
 if __name__ == '__main__':
     _main()
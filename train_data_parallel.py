@@ -0,0 +1,180 @@
+"""
+Retrain the YOLO model with data-parallel worker processes averaging their gradients.
+
+Start every rank on its own host with --rank, --world_size and the --address of rank 0,
+or leave out --rank to start all --world_size ranks on this machine. The BatchNormalization
+statistics are averaged over the ranks at the end of every epoch, so all ranks validate and
+save the same weights.
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+from keras.optimizers import Adam
+
+from train import get_classes, get_anchors, create_model, create_tiny_model, \
+    data_generator_wrapper
+from yolo3.distributed import StarAllReduce, DataParallelStep, parse_address, sync_weights, \
+    sync_batch_statistics
+from yolo3.annotation import open_annotations
+from yolo3.loader import ValidationCache
+
+parser = argparse.ArgumentParser(description='Data-parallel YOLOv3 training.')
+parser.add_argument('--annotation_path', default='train.txt',
+    help='annotation file, default train.txt')
+parser.add_argument('--log_dir', default='logs/000/',
+    help='checkpoint directory, default logs/000/')
+parser.add_argument('--classes_path', default='model_data/voc_classes.txt',
+    help='path to class definitions, default model_data/voc_classes.txt')
+parser.add_argument('--anchors_path', default='model_data/yolo_anchors.txt',
+    help='path to anchor definitions, default model_data/yolo_anchors.txt')
+parser.add_argument('--world_size', type=int, default=2, help='number of ranks, default 2')
+parser.add_argument('--rank', type=int, default=None,
+    help='rank of this process, default start all ranks locally')
+parser.add_argument('--address', default='localhost:29500',
+    help='host:port of rank 0, default localhost:29500')
+parser.add_argument('--batch_size', type=int, default=8,
+    help='images per rank and step, default 8, the effective batch is world_size times larger')
+parser.add_argument('--threads', type=int, default=0,
+    help='TensorFlow threads per rank, default cpu count / local ranks')
+parser.add_argument('--workers', type=int, default=0,
+    help='data loader processes per rank, default 0')
+parser.add_argument('--frozen_epochs', type=int, default=50,
+    help='epochs with a frozen body, default 50')
+parser.add_argument('--epochs', type=int, default=100, help='total epochs, default 100')
+parser.add_argument('--steps_per_epoch', type=int, default=0,
+    help='cap the steps per epoch, e.g. to measure scaling, default a full pass')
+
+
+def train_rank(rank, args):
+    os.makedirs(args.log_dir, exist_ok=True)
+    class_names = get_classes(args.classes_path)
+    num_classes = len(class_names)
+    anchors = get_anchors(args.anchors_path)
+    input_shape = (416,416) # multiple of 32, hw
+    world_size = args.world_size
+
+    is_tiny_version = len(anchors)==6 # default setting
+    if is_tiny_version:
+        model = create_tiny_model(input_shape, anchors, num_classes,
+            freeze_body=2, weights_path='model_data/tiny_yolo_weights.h5')
+    else:
+        # make sure you know what you freeze
+        model = create_model(input_shape, anchors, num_classes,
+            freeze_body=2, weights_path='model_data/yolo_weights.h5')
+
+    allreduce = StarAllReduce(rank, world_size, parse_address(args.address))
+    # keep the ranks of one host from oversubscribing its cores
+    threads = args.threads or max(1, mp.cpu_count() // (world_size if args.rank is None else 1))
+    weights = model.get_weights()
+    K.set_session(tf.Session(config=tf.ConfigProto(
+        intra_op_parallelism_threads=threads, inter_op_parallelism_threads=2)))
+    model.set_weights(weights)
+    sync_weights(model, allreduce)
+
+    # every rank shuffles alike, then takes its own shard of the lines
+    val_split = 0.1
+    lines = open_annotations(args.annotation_path)
+    np.random.seed(10101)
+    lines = lines[np.random.permutation(len(lines))]
+    np.random.seed(None)
+    num_val = int(len(lines)*val_split)
+    num_train = len(lines) - num_val
+    train_lines = lines[rank:num_train:world_size]
+    val_lines = lines[num_train+rank::world_size] or lines[num_train:] or train_lines
+    steps = max(1, num_train//world_size//args.batch_size)
+    if args.steps_per_epoch:
+        steps = min(steps, args.steps_per_epoch)
+    val_steps = max(1, len(val_lines)//args.batch_size)
+    val_cache = ValidationCache(val_lines, input_shape)
+    if rank == 0:
+        print('Train on {} samples, val on {} samples, with {} ranks of batch size {}.'.format(
+            num_train, num_val, world_size, args.batch_size))
+
+    generator = data_generator_wrapper(train_lines, args.batch_size, input_shape, anchors,
+        num_classes, args.workers)
+    val_generator = val_cache.generator(args.batch_size, anchors, num_classes)
+    best_val_loss = np.inf
+    train_time = 0
+    train_steps = 0
+    for stage, lr, initial_epoch, epochs, weights_name in [
+            (1, 1e-3, 0, args.frozen_epochs, 'trained_weights_stage_1.h5'),
+            (2, 1e-4, args.frozen_epochs, args.epochs, 'trained_weights_final.h5')]:
+        if stage == 2:
+            for i in range(len(model.layers)):
+                model.layers[i].trainable = True
+            if rank == 0:
+                print('Unfreeze all of the layers.')
+        step = DataParallelStep(model, Adam(lr=lr), allreduce)
+        for epoch in range(initial_epoch, epochs):
+            start = time.time()
+            losses = []
+            for i in range(steps):
+                if i == 1:
+                    # leave graph set-up out of the throughput
+                    start = time.time()
+                losses.append(step.train_on_batch(next(generator)[0]))
+            if steps > 1:
+                train_time += time.time() - start
+                train_steps += steps - 1
+            sync_batch_statistics(model, allreduce)
+            val_loss = step.evaluate(val_generator, val_steps)
+            if rank == 0:
+                print('Epoch {}/{} - loss: {:.4f} - val_loss: {:.4f}'.format(
+                    epoch+1, epochs, np.mean(losses), val_loss))
+                if (epoch+1) % 3 == 0 and val_loss < best_val_loss:
+                    best_val_loss = val_loss
+                    model.save_weights(args.log_dir +
+                        'ep{:03d}-loss{:.3f}-val_loss{:.3f}.h5'.format(
+                            epoch+1, np.mean(losses), val_loss))
+        if rank == 0:
+            model.save_weights(args.log_dir + weights_name)
+
+    if rank == 0 and train_steps:
+        images_per_sec = train_steps * args.batch_size * world_size / train_time
+        report_scaling(args.log_dir, world_size, images_per_sec,
+                       step.reduce_time / (step.compute_time + step.reduce_time))
+    allreduce.close()
+
+
+def report_scaling(log_dir, world_size, images_per_sec, reduce_fraction):
+    '''print the throughput against the last single process run logged in log_dir'''
+    path = os.path.join(log_dir, 'scaling.json')
+    runs = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            runs = json.load(f)
+    runs[str(world_size)] = images_per_sec
+    with open(path, 'w') as f:
+        json.dump(runs, f, indent=2)
+    print('{} ranks: {:.2f} images/sec, {:.0%} of the last stage spent in all-reduce'.format(
+        world_size, images_per_sec, reduce_fraction))
+    if '1' in runs:
+        print('scaling efficiency against 1 process: {:.0%}'.format(
+            images_per_sec / (world_size * runs['1'])))
+    else:
+        print('run with --world_size 1 and the same log_dir to get the scaling efficiency')
+
+
+def _main(args):
+    if args.rank is not None:
+        train_rank(args.rank, args)
+        return
+    # fresh interpreters, so no rank inherits TensorFlow state
+    context = mp.get_context('spawn')
+    ranks = [context.Process(target=train_rank, args=(rank, args))
+             for rank in range(args.world_size)]
+    for process in ranks:
+        process.start()
+    for process in ranks:
+        process.join()
+
+
+if __name__ == '__main__':
+    _main(parser.parse_args())
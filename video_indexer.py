@@ -0,0 +1,198 @@
+"""
+Index the objects in a video file offline, processing time segments in parallel.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+from timeit import default_timer as timer
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from yolo import YOLO
+from yolo3.utils import letterbox_image
+
+parser = argparse.ArgumentParser(description='Offline object detection timeline of a video.')
+parser.add_argument('video', help='video file')
+parser.add_argument('-o', '--output', default=None,
+    help='JSON lines output, default <video>.jsonl')
+parser.add_argument('--npz', default=False, action='store_true',
+    help='also write the detections as columns to the output path with an .npz extension')
+parser.add_argument('--stride', type=int, default=5,
+    help='detect on every stride-th frame, default 5')
+parser.add_argument('--workers', type=int, default=max(1, multiprocessing.cpu_count()//2),
+    help='processes, each with its own model, default half the cpu count')
+parser.add_argument('--segments', type=int, default=None,
+    help='time segments to split the video into, default 4 per worker')
+parser.add_argument('--batch_size', type=int, default=8, help='frames per network run, default 8')
+parser.add_argument('--model_path', default=YOLO.get_defaults('model_path'),
+    help='path to model weight file, default ' + YOLO.get_defaults('model_path'))
+parser.add_argument('--anchors_path', default=YOLO.get_defaults('anchors_path'),
+    help='path to anchor definitions, default ' + YOLO.get_defaults('anchors_path'))
+parser.add_argument('--classes_path', default=YOLO.get_defaults('classes_path'),
+    help='path to class definitions, default ' + YOLO.get_defaults('classes_path'))
+parser.add_argument('--score', type=float, default=YOLO.get_defaults('score'),
+    help='score threshold, default ' + str(YOLO.get_defaults('score')))
+
+_yolo = None
+
+
+def _init_worker(yolo_kwargs, threads):
+    # one model per process, TensorFlow limited to this worker's share of the cores
+    global _yolo
+    import tensorflow as tf
+    from keras import backend as K
+    K.set_session(tf.Session(config=tf.ConfigProto(
+        intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)))
+    _yolo = YOLO(**yolo_kwargs)
+
+
+def _detect(batch, fps, output):
+    h, w = _yolo.model_image_size
+    image_data = np.stack([np.asarray(letterbox_image(Image.fromarray(frame), (w, h)))
+                           for _, frame in batch])
+    image_shapes = [frame.shape[:2] for _, frame in batch]
+    for (index, _), (out_boxes, out_scores, out_classes) in zip(
+            batch, _yolo.run_batch(image_data, image_shapes)):
+        output.write(json.dumps({
+            'frame': index,
+            'time': round(index / fps, 3),
+            'boxes': np.round(out_boxes, 2).tolist(), # top, left, bottom, right
+            'scores': np.round(out_scores, 4).tolist(),
+            'classes': [_yolo.class_names[c] for c in out_classes],
+        }) + '\n')
+
+
+def seek(vid, start, back_off=256):
+    '''position vid at frame start, returning the frame index it is at
+
+    Some codecs only seek to key frames and may land after the requested frame, then
+    the seek is retried further back and the capture grabs forward to start.
+    '''
+    target = start
+    while True:
+        vid.set(cv2.CAP_PROP_POS_FRAMES, target)
+        index = int(vid.get(cv2.CAP_PROP_POS_FRAMES))
+        if 0 <= index <= start or target == 0:
+            break
+        target = max(0, target - back_off)
+    if not 0 <= index <= start:
+        print('warning: could not seek to frame {}, landed on {}, frames in between are skipped'
+              .format(start, index))
+        return max(index, 0)
+    while index < start and vid.grab():
+        index += 1
+    return index
+
+
+def process_segment(video_path, start, end, stride, batch_size, segment_path):
+    '''detect on the frames start <= i < end with i % stride == 0, written to segment_path
+
+    Frames in between are only grabbed, not decoded, and sampling on the global frame
+    index keeps the segments from overlapping when they are merged. With end None the
+    segment runs to the end of the video. Returns the index after the last frame read.
+    '''
+    vid = cv2.VideoCapture(video_path)
+    fps = vid.get(cv2.CAP_PROP_FPS) or 25.
+    index = seek(vid, start)
+    batch = []
+    with open(segment_path, 'w') as output:
+        while end is None or index < end:
+            if index % stride:
+                if not vid.grab():
+                    break
+            else:
+                return_value, frame = vid.read()
+                if not return_value:
+                    break
+                batch.append((index, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+                if len(batch) == batch_size:
+                    _detect(batch, fps, output)
+                    batch = []
+            index += 1
+        if batch:
+            _detect(batch, fps, output)
+    vid.release()
+    return index
+
+
+def write_columns(jsonl_path, npz_path, class_names):
+    '''one row per detection: frame, time, top, left, bottom, right, score, class id'''
+    class_ids = {name: i for i, name in enumerate(class_names)}
+    frames, times, boxes, scores, classes = [], [], [], [], []
+    with open(jsonl_path) as f:
+        for line in f:
+            record = json.loads(line)
+            frames.extend([record['frame']] * len(record['boxes']))
+            times.extend([record['time']] * len(record['boxes']))
+            boxes.extend(record['boxes'])
+            scores.extend(record['scores'])
+            classes.extend(class_ids[c] for c in record['classes'])
+    np.savez(npz_path, frame=np.array(frames, dtype='int64'),
+             time=np.array(times, dtype='float64'),
+             box=np.array(boxes, dtype='float32').reshape(-1, 4),
+             score=np.array(scores, dtype='float32'), cls=np.array(classes, dtype='int32'),
+             class_names=np.array(class_names))
+
+
+def _main(args):
+    video_path = os.path.expanduser(args.video)
+    output_path = os.path.expanduser(args.output or os.path.splitext(video_path)[0] + '.jsonl')
+    vid = cv2.VideoCapture(video_path)
+    if not vid.isOpened():
+        raise IOError("Couldn't open video {}".format(video_path))
+    frame_count = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = vid.get(cv2.CAP_PROP_FPS) or 25.
+    vid.release()
+    if frame_count <= 0:
+        print('warning: {} reports no frame count, indexing it in one segment'.format(
+            video_path))
+
+    # more segments than workers evens out segments that decode slower
+    num_segments = max(1, min(args.segments or 4*args.workers, frame_count // args.stride))
+    bounds = list(np.linspace(0, max(frame_count, 0), num_segments + 1).astype(int))
+    # the frame count is an estimate for some containers, the last segment reads to the end
+    bounds[-1] = None
+    segment_paths = ['{}.seg{:04d}'.format(output_path, i) for i in range(num_segments)]
+    yolo_kwargs = {k: v for k, v in vars(args).items() if k in YOLO._defaults}
+    yolo_kwargs['warmup_batch_sizes'] = (1, args.batch_size)
+    threads = max(1, multiprocessing.cpu_count() // args.workers)
+
+    start = timer()
+    # spawned, so no worker inherits the parent's TensorFlow state
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(args.workers, initializer=_init_worker,
+                      initargs=(yolo_kwargs, threads)) as pool:
+        results = [pool.apply_async(process_segment, (video_path, bounds[i], bounds[i+1],
+                                                      args.stride, args.batch_size,
+                                                      segment_paths[i]))
+                   for i in range(num_segments)]
+        for i, result in enumerate(results):
+            num_frames = result.get()
+            print('segment {}/{} done'.format(i + 1, num_segments))
+    if num_frames != frame_count:
+        print('warning: the video has {} frames, not the {} it reports'.format(
+            num_frames, frame_count))
+
+    # the segments are disjoint and in frame order, so merging is concatenating
+    with open(output_path, 'w') as output:
+        for segment_path in segment_paths:
+            with open(segment_path) as f:
+                for line in f:
+                    output.write(line)
+            os.remove(segment_path)
+    elapsed = timer() - start
+    print('Indexed {} frames in {:.1f}s, {:.1f}x playback speed, to {}'.format(
+        num_frames, elapsed, num_frames / fps / elapsed, output_path))
+
+    if args.npz:
+        with open(os.path.expanduser(args.classes_path)) as f:
+            class_names = [c.strip() for c in f.readlines()]
+        write_columns(output_path, os.path.splitext(output_path)[0] + '.npz', class_names)
+
+
+if __name__ == '__main__':
+    _main(parser.parse_args())
@@ -1,34 +1,106 @@
+import argparse
+import json
+import multiprocessing
+import os
 import xml.etree.ElementTree as ET
 from os import getcwd
 
 sets=[('2007', 'train'), ('2007', 'val'), ('2007', 'test')]
 
 classes = ["aeroplane", "bicycle", "bird", "boat", "bottle", "bus", "car", "cat", "chair", "cow", "diningtable", "dog", "horse", "motorbike", "person", "pottedplant", "sheep", "sofa", "train", "tvmonitor"]
+class_ids = {cls: cls_id for cls_id, cls in enumerate(classes)}
 
 
-def convert_annotation(year, image_id, list_file):
-    in_file = open('VOCdevkit/VOC%s/Annotations/%s.xml'%(year, image_id))
-    tree=ET.parse(in_file)
-    root = tree.getroot()
+def convert_annotation(xml_path):
+    '''the " x_min,y_min,x_max,y_max,class_id" boxes of one VOC xml file, as one string'''
+    root = ET.parse(xml_path).getroot()
 
+    boxes = []
     for obj in root.iter('object'):
         difficult = obj.find('difficult').text
-        cls = obj.find('name').text
-        if cls not in classes or int(difficult)==1:
+        cls_id = class_ids.get(obj.find('name').text)
+        if cls_id is None or int(difficult)==1:
             continue
-        cls_id = classes.index(cls)
         xmlbox = obj.find('bndbox')
         b = (int(xmlbox.find('xmin').text), int(xmlbox.find('ymin').text), int(xmlbox.find('xmax').text), int(xmlbox.find('ymax').text))
-        list_file.write(" " + ",".join([str(a) for a in b]) + ',' + str(cls_id))
+        boxes.append(" " + ",".join([str(a) for a in b]) + ',' + str(cls_id))
+    return ''.join(boxes)
 
-wd = getcwd()
 
-for year, image_set in sets:
-    image_ids = open('VOCdevkit/VOC%s/ImageSets/Main/%s.txt'%(year, image_set)).read().strip().split()
-    list_file = open('%s_%s.txt'%(year, image_set), 'w')
-    for image_id in image_ids:
-        list_file.write('%s/VOCdevkit/VOC%s/JPEGImages/%s.jpg'%(wd, year, image_id))
-        convert_annotation(year, image_id, list_file)
-        list_file.write('\n')
-    list_file.close()
+def load_manifest(manifest_path):
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
 
+
+def save_manifest(manifest_path, manifest, xml_paths):
+    '''atomically write the entries of xml_paths, dropping files no image set lists anymore'''
+    manifest = {xml_path: manifest[xml_path] for xml_path in sorted(xml_paths)}
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def update_manifest(manifest, xml_paths, pool):
+    '''re-parse only the xml files whose mtime or size differ from the manifest
+
+    The manifest maps each xml path to [mtime, size, converted boxes]. Returns the
+    number of files parsed.
+    '''
+    stats = {}
+    stale = []
+    for xml_path in xml_paths:
+        stat = os.stat(xml_path)
+        stats[xml_path] = [stat.st_mtime, stat.st_size]
+        entry = manifest.get(xml_path)
+        if entry is None or entry[:2] != stats[xml_path]:
+            stale.append(xml_path)
+    # imap keeps the order, chunks keep the inter-process traffic low
+    for xml_path, boxes in zip(stale, pool.imap(convert_annotation, stale, chunksize=64)):
+        manifest[xml_path] = stats[xml_path] + [boxes]
+    return len(stale)
+
+
+def _main(args):
+    wd = getcwd()
+    manifests = {}
+    listed = {} # the xml paths of every image set of a year
+    with multiprocessing.Pool(args.workers) as pool:
+        for year, image_set in sets:
+            manifest_path = 'VOCdevkit/VOC%s/annotation_manifest.json'%(year)
+            if year not in manifests:
+                manifests[year] = {} if args.full else load_manifest(manifest_path)
+                listed[year] = set()
+            manifest = manifests[year]
+
+            with open('VOCdevkit/VOC%s/ImageSets/Main/%s.txt'%(year, image_set)) as f:
+                image_ids = f.read().strip().split()
+            xml_paths = ['VOCdevkit/VOC%s/Annotations/%s.xml'%(year, image_id)
+                         for image_id in image_ids]
+            num_parsed = update_manifest(manifest, xml_paths, pool)
+            listed[year].update(xml_paths)
+
+            # every line comes from the manifest, so rewriting the list costs no parsing
+            list_path = '%s_%s.txt'%(year, image_set)
+            with open(list_path + '.tmp', 'w') as list_file:
+                for image_id, xml_path in zip(image_ids, xml_paths):
+                    list_file.write('%s/VOCdevkit/VOC%s/JPEGImages/%s.jpg'%(wd, year, image_id))
+                    list_file.write(manifest[xml_path][2])
+                    list_file.write('\n')
+            os.replace(list_path + '.tmp', list_path)
+            print('%s: %d images, %d annotations parsed'%(list_path, len(image_ids), num_parsed))
+
+    # once all image sets of a year are done, so pruning keeps the entries of every set
+    for year, manifest in manifests.items():
+        save_manifest('VOCdevkit/VOC%s/annotation_manifest.json'%(year), manifest, listed[year])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert VOC annotations to train.txt style lists.')
+    parser.add_argument('--workers', type=int, default=None,
+        help='processes parsing xml files, default cpu count')
+    parser.add_argument('--full', default=False, action='store_true',
+        help='ignore the manifest and parse every xml file again')
+    _main(parser.parse_args())
@@ -5,6 +5,9 @@ Class definition of YOLO_v3 style detection model on image and video
 
 import colorsys
 import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from timeit import default_timer as timer
 
 import numpy as np
@@ -13,8 +16,9 @@ from keras.models import load_model
 from keras.layers import Input
 from PIL import Image, ImageFont, ImageDraw
 
-from yolo3.model import yolo_eval, yolo_body, tiny_yolo_body
-from yolo3.utils import letterbox_image
+from yolo3.model import yolo_eval, yolo_body, tiny_yolo_body, multi_head_yolo_body
+from yolo3.utils import letterbox_image, draft_image
+from yolo3.weights import load_flat_weights, load_darknet_weights, load_shared_backbone
 import os
 from keras.utils import multi_gpu_model
 
@@ -27,6 +31,10 @@ class YOLO(object):
         "iou" : 0.45,
         "model_image_size" : (416, 416),
         "gpu_num" : 1,
+        "pipeline_depth" : 4,
+        "pipeline_workers" : 2,
+        "warmup_shapes" : None,
+        "warmup_batch_sizes" : (1,),
     }
 
     @classmethod
@@ -44,6 +52,11 @@ class YOLO(object):
         self.sess = K.get_session()
         self.graph = self.sess.graph
         self.boxes, self.scores, self.classes = self.generate()
+        self._worker_pool = None
+        self._inference_pool = None
+        self.ready = False
+        self.warmup_time = None
+        self.warmup()
 
     def _get_class(self):
         classes_path = os.path.expanduser(self.classes_path)
@@ -59,24 +72,41 @@ class YOLO(object):
         anchors = [float(x) for x in anchors.split(',')]
         return np.array(anchors).reshape(-1, 2)
 
+    def _create_body(self):
+        num_anchors = len(self.anchors)
+        num_classes = len(self.class_names)
+        is_tiny_version = num_anchors==6 # default setting
+        if is_tiny_version:
+            return tiny_yolo_body(Input(shape=(None,None,3)), num_anchors//2, num_classes)
+        return yolo_body(Input(shape=(None,None,3)), num_anchors//3, num_classes)
+
     def generate(self):
         model_path = os.path.expanduser(self.model_path)
-        assert model_path.endswith('.h5'), 'Keras model or weights must be a .h5 file.'
+        assert model_path.endswith(('.h5', '.flat', '.weights')), \
+            'Keras model or weights must be a .h5, .flat or Darknet .weights file.'
 
         # Load model, or construct model and load weights.
         num_anchors = len(self.anchors)
         num_classes = len(self.class_names)
-        is_tiny_version = num_anchors==6 # default setting
-        try:
-            self.yolo_model = load_model(model_path, compile=False)
-        except:
-            self.yolo_model = tiny_yolo_body(Input(shape=(None,None,3)), num_anchors//2, num_classes) \
-                if is_tiny_version else yolo_body(Input(shape=(None,None,3)), num_anchors//3, num_classes)
-            self.yolo_model.load_weights(self.model_path) # make sure model, anchors and classes match
+        if model_path.endswith('.flat'):
+            # make sure model, anchors and classes match
+            self.yolo_model = self._create_body()
+            load_flat_weights(self.yolo_model, model_path)
+        elif model_path.endswith('.weights'):
+            self.yolo_model = self._create_body()
+            load_darknet_weights(self.yolo_model, model_path)
         else:
-            assert self.yolo_model.layers[-1].output_shape[-1] == \
-                num_anchors/len(self.yolo_model.output) * (num_classes + 5), \
-                'Mismatch between model and given anchor and class sizes'
+            try:
+                self.yolo_model = load_model(model_path, compile=False)
+            except ValueError:
+                # weights only file, it has no model config
+                # make sure model, anchors and classes match
+                self.yolo_model = self._create_body()
+                self.yolo_model.load_weights(model_path)
+            else:
+                assert self.yolo_model.layers[-1].output_shape[-1] == \
+                    num_anchors/len(self.yolo_model.output) * (num_classes + 5), \
+                    'Mismatch between model and given anchor and class sizes'
 
         print('{} model, anchors, and classes loaded.'.format(model_path))
 
@@ -100,77 +130,287 @@ class YOLO(object):
                 score_threshold=self.score, iou_threshold=self.iou)
         return boxes, scores, classes
 
-    def predict(self, image):
+    def warmup(self):
+        """Run synthetic batches for each warm-up shape and batch size, then mark ready.
+
+        TF allocates memory and selects kernels lazily per input shape, so without this
+        the first request for every shape pays that cost. warmup_shapes is a list of
+        (h, w) and defaults to model_image_size; batch size 1 runs the full detection
+        graph, larger batch sizes only the network body.
+        """
         start = timer()
+        shapes = self.warmup_shapes
+        if shapes is None:
+            shapes = [self.model_image_size] if self.model_image_size != (None, None) else []
+        for h, w in shapes:
+            assert h%32 == 0 and w%32 == 0, 'Multiples of 32 required'
+            for batch_size in self.warmup_batch_sizes:
+                image_data = np.full((batch_size, h, w, 3), 0.5, dtype='float32')
+                if batch_size == 1:
+                    self._run(image_data, [h, w])
+                else:
+                    with self.graph.as_default():
+                        self.sess.run(self.yolo_model.output, feed_dict={
+                            self.yolo_model.input: image_data, K.learning_phase(): 0})
+        self.warmup_time = timer() - start
+        self.ready = True
+        print('warm-up of {} shapes done in {:.2f}s'.format(len(shapes), self.warmup_time))
+
+    def _preprocess(self, image, draft=False):
+        # boxes are corrected against the full resolution even if decoding is drafted
+        image_shape = [image.size[1], image.size[0]]
         if self.model_image_size != (None, None):
             assert self.model_image_size[0]%32 == 0, 'Multiples of 32 required'
             assert self.model_image_size[1]%32 == 0, 'Multiples of 32 required'
+            if draft:
+                h, w = self.model_image_size
+                scale = min(w/image.width, h/image.height)
+                draft_image(image, (int(image.width*scale), int(image.height*scale)))
             boxed_image = letterbox_image(image, tuple(reversed(self.model_image_size)))
         else:
             new_image_size = (image.width - (image.width % 32),
                               image.height - (image.height % 32))
             boxed_image = letterbox_image(image, new_image_size)
         image_data = np.array(boxed_image, dtype='float32')
-
-        print(image_data.shape)
         image_data /= 255.
         image_data = np.expand_dims(image_data, 0)  # Add batch dimension.
+        return image_data, image_shape
+
+    def _run(self, image_data, image_shape):
         with self.graph.as_default():
             out_boxes, out_scores, out_classes = self.sess.run(
                 [self.boxes, self.scores, self.classes],
                 feed_dict={
                     self.yolo_model.input: image_data,
-                    self.input_image_shape: [image.size[1], image.size[0]],
+                    self.input_image_shape: image_shape,
                     K.learning_phase(): 0
                 })
+        return (out_boxes, out_scores, out_classes)
+
+    def predict(self, image, draft=False):
+        """Detect objects in a PIL image, boxes are (top, left, bottom, right) in its pixels.
+
+        With draft=True an image that is not loaded yet (a fresh Image.open of a JPEG)
+        is decoded at a reduced DCT scale close to model_image_size. This changes the
+        image object in place, so only use it on images the caller does not reuse.
+        """
+        start = timer()
+        image_data, image_shape = self._preprocess(image, draft)
+        print(image_data.shape)
+        result = self._run(image_data, image_shape)
         end = timer()
         print('detect time :', end - start)
-        return (out_boxes, out_scores, out_classes)
+        return result
+
+    def run_batch(self, image_data, image_shapes):
+        """Detect objects in a batch of letterboxed images, returning predict's result per image.
+
+        image_data is (m, h, w, 3), float in [0, 1] or uint8, and image_shapes the
+        original (h, w) of each image. The network runs once for the whole batch; the
+        box decoding then gets each image's slice of the network output fed in.
+        """
+        if image_data.dtype == np.uint8:
+            image_data = image_data.astype('float32') / 255.
+        outputs = self.yolo_model.output
+        if not isinstance(outputs, list):
+            outputs = [outputs]
+        with self.graph.as_default():
+            feats = self.sess.run(outputs, feed_dict={
+                self.yolo_model.input: image_data, K.learning_phase(): 0})
+            results = []
+            for i, image_shape in enumerate(image_shapes):
+                feed_dict = {output: feat[i:i+1] for output, feat in zip(outputs, feats)}
+                feed_dict[self.input_image_shape] = image_shape
+                results.append(tuple(self.sess.run([self.boxes, self.scores, self.classes],
+                                                   feed_dict=feed_dict)))
+        return results
+
+    def predict_batch(self, images, draft=False):
+        """Detect objects in a list of PIL images with one network run, see predict."""
+        assert self.model_image_size != (None, None), 'Batches need a fixed model_image_size'
+        prepared = [self._preprocess(image, draft) for image in images]
+        return self.run_batch(np.concatenate([image_data for image_data, _ in prepared]),
+                              [image_shape for _, image_shape in prepared])
+
+    def _start_pipeline(self):
+        if self._inference_pool is None:
+            # sess.run is issued from a single thread so results come out in submit order,
+            # preprocessing and postprocessing run on the worker threads around it.
+            self._inference_pool = ThreadPoolExecutor(max_workers=1)
+            self._worker_pool = ThreadPoolExecutor(max_workers=self.pipeline_workers)
+            self._in_flight = threading.BoundedSemaphore(self.pipeline_depth)
+
+    def _run_prepared(self, prepared):
+        return self._run(*prepared.result())
+
+    def _postprocess(self, result, image, postprocess):
+        future = Future()
+        def run(done):
+            try:
+                future.set_result(postprocess(image, done.result()))
+            except Exception as e:
+                future.set_exception(e)
+        result.add_done_callback(lambda done: self._worker_pool.submit(run, done))
+        return future
+
+    def submit(self, image, postprocess=None, draft=False):
+        """Queue image for detection and return a Future of predict's result.
+
+        At most pipeline_depth images are in flight, submit blocks once that many
+        are pending. When postprocess is given, the Future resolves to
+        postprocess(image, (out_boxes, out_scores, out_classes)) instead, computed
+        on a worker thread so rendering overlaps with the next sess.run. draft is as
+        for predict.
+        """
+        self._start_pipeline()
+        self._in_flight.acquire()
+        prepared = self._worker_pool.submit(self._preprocess, image, draft)
+        result = self._inference_pool.submit(self._run_prepared, prepared)
+        if postprocess is not None:
+            result = self._postprocess(result, image, postprocess)
+        result.add_done_callback(lambda _: self._in_flight.release())
+        return result
+
+    def predict_stream(self, images, postprocess=None, draft=False):
+        """Pipelined predict over an iterable of images, yielding results in order."""
+        pending = deque()
+        for image in images:
+            pending.append(self.submit(image, postprocess, draft))
+            while pending and (pending[0].done() or len(pending) >= self.pipeline_depth):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
     def detect_image(self, image):
         (out_boxes, out_scores, out_classes) = self.predict(image)
 
         print('Found {} boxes for {}'.format(len(out_boxes), 'img'))
+        return draw_detections(image, out_boxes, out_scores, out_classes,
+                               self.class_names, self.colors, verbose=True)
 
-        font = ImageFont.truetype(font='font/FiraMono-Medium.otf',
-                    size=np.floor(3e-2 * image.size[1] + 0.5).astype('int32'))
-        thickness = (image.size[0] + image.size[1]) // 300
+    def close_session(self):
+        if self._inference_pool is not None:
+            self._inference_pool.shutdown()
+            self._worker_pool.shutdown()
+            self._inference_pool = self._worker_pool = None
+        self.sess.close()
 
-        for i, c in reversed(list(enumerate(out_classes))):
-            predicted_class = self.class_names[c]
-            box = out_boxes[i]
-            score = out_scores[i]
+class MultiHeadYOLO(YOLO):
+    """Several YOLOv3 models fine-tuned from the same frozen Darknet-53 body, in one pass.
 
-            label = '{} {:.2f}'.format(predicted_class, score)
-            draw = ImageDraw.Draw(image)
-            label_size = draw.textsize(label, font)
+    heads is a list of dicts with the model_path, anchors_path and classes_path of every
+    model, and optionally its own score threshold. The body runs once per image and
+    feeds the output layers of all models; predict, run_batch, submit and
+    predict_stream return a list with one (out_boxes, out_scores, out_classes) per head.
+    class_names, anchors and colors are lists per head as well.
+    """
 
-            top, left, bottom, right = box
-            top = max(0, np.floor(top + 0.5).astype('int32'))
-            left = max(0, np.floor(left + 0.5).astype('int32'))
-            bottom = min(image.size[1], np.floor(bottom + 0.5).astype('int32'))
-            right = min(image.size[0], np.floor(right + 0.5).astype('int32'))
-            print(label, (left, top), (right, bottom))
+    def __init__(self, heads, **kwargs):
+        self.heads = heads
+        super().__init__(**kwargs)
 
-            if top - label_size[1] >= 0:
-                text_origin = np.array([left, top - label_size[1]])
-            else:
-                text_origin = np.array([left, top + 1])
+    def _get_class(self):
+        class_names = []
+        for head in self.heads:
+            with open(os.path.expanduser(head['classes_path'])) as f:
+                class_names.append([c.strip() for c in f.readlines()])
+        return class_names
 
-            # My kingdom for a good redistributable image drawing library.
-            for i in range(thickness):
-                draw.rectangle(
-                    [left + i, top + i, right - i, bottom - i],
-                    outline=self.colors[c])
-            draw.rectangle(
-                [tuple(text_origin), tuple(text_origin + label_size)],
-                fill=self.colors[c])
-            draw.text(text_origin, label, fill=(0, 0, 0), font=font)
-            del draw
+    def _get_anchors(self):
+        anchors = []
+        for head in self.heads:
+            with open(os.path.expanduser(head['anchors_path'])) as f:
+                head_anchors = [float(x) for x in f.readline().split(',')]
+            anchors.append(np.array(head_anchors).reshape(-1, 2))
+        return anchors
+
+    def generate(self):
+        model_paths = [os.path.expanduser(head['model_path']) for head in self.heads]
+        assert all(path.endswith(('.h5', '.flat')) for path in model_paths), \
+            'Shared backbone heads must be .h5 or .flat files.'
+        assert all(len(anchors) == 9 for anchors in self.anchors), \
+            'Shared backbone heads need the Darknet-53 body of full YOLOv3.'
+        self.yolo_model, head_models = multi_head_yolo_body(Input(shape=(None,None,3)), 3,
+            [len(class_names) for class_names in self.class_names])
+        num_backbone = load_shared_backbone(head_models, model_paths)
+        print('{} models loaded, sharing {} backbone layers.'.format(
+            len(model_paths), num_backbone))
+
+        self.colors = []
+        for class_names in self.class_names:
+            hsv_tuples = [(x / len(class_names), 1., 1.) for x in range(len(class_names))]
+            colors = [(int(r * 255), int(g * 255), int(b * 255))
+                      for r, g, b in map(lambda x: colorsys.hsv_to_rgb(*x), hsv_tuples)]
+            np.random.seed(10101)  # Same colors as each model on its own.
+            np.random.shuffle(colors)
+            self.colors.append(colors)
+        np.random.seed(None)
+
+        self.input_image_shape = K.placeholder(shape=(2, ))
+        if self.gpu_num>=2:
+            self.yolo_model = multi_gpu_model(self.yolo_model, gpus=self.gpu_num)
+        boxes, scores, classes = [], [], []
+        for i, head in enumerate(self.heads):
+            head_boxes, head_scores, head_classes = yolo_eval(self.yolo_model.output[3*i:3*i+3],
+                self.anchors[i], len(self.class_names[i]), self.input_image_shape,
+                score_threshold=head.get('score', self.score), iou_threshold=self.iou)
+            boxes.append(head_boxes)
+            scores.append(head_scores)
+            classes.append(head_classes)
+        return boxes, scores, classes
+
+    def _run(self, image_data, image_shape):
+        return list(zip(*super()._run(image_data, image_shape)))
+
+    def run_batch(self, image_data, image_shapes):
+        return [list(zip(*result)) for result in super().run_batch(image_data, image_shapes)]
+
+    def detect_image(self, image):
+        for (out_boxes, out_scores, out_classes), class_names, colors in zip(
+                self.predict(image), self.class_names, self.colors):
+            image = draw_detections(image, out_boxes, out_scores, out_classes,
+                                    class_names, colors, verbose=True)
         return image
 
-    def close_session(self):
-        self.sess.close()
+def draw_detections(image, out_boxes, out_scores, out_classes, class_names, colors, verbose=False):
+    """Draw labelled boxes of predict's result onto the PIL image and return it."""
+    font = ImageFont.truetype(font='font/FiraMono-Medium.otf',
+                size=np.floor(3e-2 * image.size[1] + 0.5).astype('int32'))
+    thickness = (image.size[0] + image.size[1]) // 300
+
+    for i, c in reversed(list(enumerate(out_classes))):
+        predicted_class = class_names[c]
+        box = out_boxes[i]
+        score = out_scores[i]
+
+        label = '{} {:.2f}'.format(predicted_class, score)
+        draw = ImageDraw.Draw(image)
+        label_size = draw.textsize(label, font)
+
+        top, left, bottom, right = box
+        top = max(0, np.floor(top + 0.5).astype('int32'))
+        left = max(0, np.floor(left + 0.5).astype('int32'))
+        bottom = min(image.size[1], np.floor(bottom + 0.5).astype('int32'))
+        right = min(image.size[0], np.floor(right + 0.5).astype('int32'))
+        if verbose:
+            print(label, (left, top), (right, bottom))
+
+        if top - label_size[1] >= 0:
+            text_origin = np.array([left, top - label_size[1]])
+        else:
+            text_origin = np.array([left, top + 1])
+
+        # My kingdom for a good redistributable image drawing library.
+        for i in range(thickness):
+            draw.rectangle(
+                [left + i, top + i, right - i, bottom - i],
+                outline=colors[c])
+        draw.rectangle(
+            [tuple(text_origin), tuple(text_origin + label_size)],
+            fill=colors[c])
+        draw.text(text_origin, label, fill=(0, 0, 0), font=font)
+        del draw
+    return image
 
 def detect_video(yolo, video_path, output_path=""):
     import cv2
@@ -0,0 +1,154 @@
+"""Binary index of train.txt style annotation files."""
+
+import copy
+import hashlib
+import os
+
+import numpy as np
+
+
+def compile_annotations(annotation_path, index_path=None):
+    '''parse an annotation file once into an index directory, by default annotation_path.idx
+
+    images.npy holds one (path, start, count) record per line and boxes.npy the
+    (N_boxes, 5) int32 table of x_min, y_min, x_max, y_max, class_id that the
+    records point into.
+    '''
+    index_path = index_path or annotation_path + '.idx'
+    paths = []
+    counts = []
+    box_tokens = []
+    with open(annotation_path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.split()
+            if not line:
+                continue
+            for token in line[1:]:
+                if token.count(',') != 4:
+                    raise ValueError('{}:{}: box {!r} is not x_min,y_min,x_max,y_max,class_id'
+                                     .format(annotation_path, line_number, token))
+            paths.append(line[0].encode('utf8'))
+            counts.append(len(line) - 1)
+            box_tokens.extend(line[1:])
+    try:
+        boxes = np.array(','.join(box_tokens).split(',') if box_tokens else [], dtype='int32')
+    except ValueError:
+        _raise_field_error(annotation_path)
+        raise
+    return save_annotations(index_path, paths, counts, boxes.reshape(-1, 5))
+
+
+def _raise_field_error(annotation_path):
+    '''name the line of the first box field that is not an integer'''
+    with open(annotation_path) as f:
+        for line_number, line in enumerate(f, 1):
+            for token in line.split()[1:]:
+                for field in token.split(','):
+                    try:
+                        int(field)
+                    except ValueError:
+                        raise ValueError('{}:{}: box {!r} has a field that is not an integer'
+                                         .format(annotation_path, line_number, token)) from None
+
+
+def save_annotations(index_path, paths, counts, boxes):
+    '''write an index of utf8 encoded image paths, their box counts and the boxes in that order'''
+    images = np.zeros(len(paths), dtype=[('path', 'S{}'.format(max(map(len, paths), default=1))),
+                                         ('start', 'int64'), ('count', 'int32')])
+    images['path'] = paths
+    images['count'] = counts
+    images['start'][1:] = np.cumsum(counts)[:-1]
+
+    os.makedirs(index_path, exist_ok=True)
+    # images.npy goes last, so its mtime tells whether the index is complete and current
+    boxes = np.asarray(boxes, dtype='int32').reshape(-1, 5)
+    for name, array in [('boxes', boxes), ('images', images)]:
+        path = os.path.join(index_path, name + '.npy')
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid()) # several ranks may compile at once
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    return AnnotationIndex(index_path)
+
+
+def open_annotations(path):
+    '''open an index directory, or the index of an annotation file, compiling it if stale'''
+    if os.path.isdir(path):
+        return AnnotationIndex(path)
+    images_path = os.path.join(path + '.idx', 'images.npy')
+    if os.path.isfile(images_path) and os.path.getmtime(images_path) >= os.path.getmtime(path):
+        return AnnotationIndex(path + '.idx')
+    return compile_annotations(path)
+
+
+def annotation_records(annotations):
+    '''yield the (image path, (n, 5) int32 boxes) records of annotation lines or an
+    AnnotationIndex'''
+    if isinstance(annotations, AnnotationIndex):
+        for i in range(len(annotations)):
+            yield annotations[i]
+        return
+    for line in annotations:
+        line = line.split()
+        boxes = np.array([list(map(int, box.split(','))) for box in line[1:]], dtype='int32')
+        yield line[0], boxes.reshape(-1, 5)
+
+
+def annotation_digest(annotations):
+    '''sha1 of the samples and their order, for annotation lines or an AnnotationIndex'''
+    if isinstance(annotations, AnnotationIndex):
+        images = annotations.images[annotations.rows]
+        digest = hashlib.sha1(images['path'].tobytes())
+        digest.update(images['count'].tobytes())
+        for start, count in zip(images['start'], images['count']):
+            digest.update(annotations.boxes[start:start+count].tobytes())
+        return digest
+    return hashlib.sha1(''.join(annotations).encode('utf8'))
+
+
+class AnnotationIndex(object):
+    '''Memory-mapped annotation index made by compile_annotations.
+
+    Indexing with an integer gives the (image path, (n, 5) int32 boxes) record that
+    get_random_data accepts in place of an annotation line. Slices and index arrays
+    give a view on those rows, so shuffling and splitting work as on a list of lines.
+    '''
+
+    def __init__(self, index_path, rows=None):
+        self.path = index_path
+        self.images = np.load(os.path.join(index_path, 'images.npy'), mmap_mode='r')
+        self.boxes = np.load(os.path.join(index_path, 'boxes.npy'), mmap_mode='r')
+        self.rows = np.arange(len(self.images)) if rows is None else np.asarray(rows)
+
+    def __getstate__(self):
+        # reopen the memmaps instead of pickling their contents
+        return {'path': self.path, 'rows': self.rows}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['rows'])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            image = self.images[self.rows[i]]
+            start = image['start']
+            return image['path'].decode('utf8'), self.boxes[start:start+image['count']]
+        view = copy.copy(self)
+        view.rows = self.rows[i]
+        return view
+
+    def image_paths(self):
+        return [path.decode('utf8') for path in self.images['path'][self.rows]]
+
+    def box_sizes(self):
+        '''(N_boxes, 2) width and height of every box of the indexed images'''
+        images = self.images[self.rows]
+        if len(self.rows) == len(self.images):
+            boxes = self.boxes
+        else:
+            boxes = np.concatenate([self.boxes[start:start+count]
+                                    for start, count in zip(images['start'], images['count'])] +
+                                   [np.zeros((0, 5), dtype='int32')])
+        return boxes[:, 2:4] - boxes[:, 0:2]
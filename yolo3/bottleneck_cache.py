@@ -0,0 +1,122 @@
+"""Memory-mapped cache of bottleneck features for training the output layers."""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from yolo3.model import preprocess_true_boxes
+from yolo3.utils import get_random_data
+
+
+def bottleneck_key(weights_path, annotation_lines, input_shape, dtype='float32'):
+    '''hash everything the cached features depend on, so a stale cache is never read
+
+    The weights file is identified by its path, size and mtime rather than its
+    contents, which would mean reading hundreds of megabytes on every run.
+    '''
+    key = hashlib.sha1()
+    stat = os.stat(weights_path)
+    key.update('{} {} {}'.format(os.path.abspath(weights_path), stat.st_size,
+                                 stat.st_mtime_ns).encode('utf8'))
+    key.update(''.join(annotation_lines).encode('utf8'))
+    key.update('{}x{} {}'.format(input_shape[0], input_shape[1],
+                                 np.dtype(dtype).name).encode('utf8'))
+    return key.hexdigest()
+
+
+class BottleneckCache(object):
+    '''Bottleneck features of every annotation line, one .npy memmap per output level.
+
+    Features are written batch by batch while the bottleneck model runs, so neither
+    building nor training ever holds more than a batch in memory. The letterboxed
+    boxes are stored alongside, which spares re-reading the annotations per batch.
+    Files live in cache_dir/<key> and only count once meta.json has been written.
+    '''
+
+    def __init__(self, cache_dir, key, dtype='float32'):
+        self.path = os.path.join(cache_dir, key)
+        self.dtype = np.dtype(dtype)
+        self.features = None
+        self.boxes = None
+        if self.complete:
+            self._open()
+
+    @property
+    def complete(self):
+        return os.path.isfile(os.path.join(self.path, 'meta.json'))
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.npy')
+
+    def _open(self):
+        with open(os.path.join(self.path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.features = [np.load(self._file('bot{}'.format(l)), mmap_mode='r')
+                         for l in range(meta['num_levels'])]
+        self.boxes = np.load(self._file('boxes'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def build(self, model, annotation_lines, input_shape, batch_size=8, max_boxes=20,
+              verbose=True):
+        '''run model over the letterboxed images and stream its outputs to disk'''
+        os.makedirs(self.path, exist_ok=True)
+        n = len(annotation_lines)
+        boxes = np.lib.format.open_memmap(self._file('boxes') + '.tmp', mode='w+', dtype='float32',
+                                          shape=(n, max_boxes, 5))
+        features = None
+        # get_random_data shuffles the boxes even with random=False, fix that order
+        state = np.random.get_state()
+        np.random.seed(10101)
+        for start in range(0, n, batch_size):
+            stop = min(start+batch_size, n)
+            image_data = []
+            for i in range(start, stop):
+                image, boxes[i] = get_random_data(annotation_lines[i], input_shape, random=False,
+                                                  max_boxes=max_boxes)
+                image_data.append(image)
+            outputs = model.predict_on_batch(np.array(image_data))
+            if features is None:
+                # the spatial shape is only known once the model has run
+                features = [np.lib.format.open_memmap(self._file('bot{}'.format(l)) + '.tmp',
+                    mode='w+', dtype=self.dtype, shape=(n,) + output.shape[1:])
+                    for l, output in enumerate(outputs)]
+            for feature, output in zip(features, outputs):
+                feature[start:stop] = output
+            if verbose:
+                print('Progress: {}/{}'.format(stop, n))
+        np.random.set_state(state)
+
+        names = ['bot{}'.format(l) for l in range(len(features))] + ['boxes']
+        for name, array in zip(names, features + [boxes]):
+            array.flush()
+            os.replace(self._file(name) + '.tmp', self._file(name))
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'count': n, 'num_levels': len(outputs), 'dtype': self.dtype.name,
+                       'input_shape': list(input_shape)}, f)
+        self._open()
+
+    def generator(self, start, stop, batch_size, input_shape, anchors, num_classes, shuffle=True):
+        '''yield batches of rows start:stop as views into the memmaps
+
+        Every batch is a contiguous block, so it is sliced rather than gathered. With
+        shuffle the block boundaries move by a random offset each epoch and the blocks
+        come in random order, which varies batch composition without copying.
+        '''
+        n = stop - start
+        if n <= 0:
+            raise ValueError('No cached rows in {}:{} of {}'.format(start, stop, self.path))
+        batch_size = min(batch_size, n)
+        while True:
+            offset = np.random.randint(n - n//batch_size*batch_size + 1) if shuffle else 0
+            blocks = start + offset + batch_size*np.arange(n//batch_size)
+            if shuffle:
+                np.random.shuffle(blocks)
+            for i in blocks:
+                features = [feature[i:i+batch_size] for feature in self.features]
+                y_true = preprocess_true_boxes(self.boxes[i:i+batch_size], input_shape,
+                                               anchors, num_classes)
+                yield [*features, *y_true], np.zeros(batch_size)
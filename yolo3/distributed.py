@@ -0,0 +1,184 @@
+"""Data-parallel training over several processes with averaged gradients."""
+
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+from keras import backend as K
+from keras.layers import BatchNormalization
+
+
+def parse_address(address):
+    '''"host:port" to the (host, port) tuple multiprocessing.connection expects'''
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+class StarAllReduce(object):
+    '''Average float32 arrays over world_size processes through rank 0.
+
+    Rank 0 listens on address, every other rank connects to it. An all-reduce sends
+    each array to rank 0, which sums them in rank order and sends the mean back, so
+    every rank ends up with bitwise identical values. Works across hosts, though the
+    traffic through rank 0 grows with world_size.
+    '''
+
+    def __init__(self, rank, world_size, address, authkey=b'yolo3', timeout=60):
+        self.rank = rank
+        self.world_size = world_size
+        self.peers = []
+        if world_size == 1:
+            return
+        if rank == 0:
+            listener = Listener(address, authkey=authkey)
+            peers = {}
+            while len(peers) < world_size-1:
+                conn = listener.accept()
+                peers[conn.recv()] = conn
+            listener.close()
+            self.peers = [peers[r] for r in sorted(peers)]
+        else:
+            deadline = time.time() + timeout
+            while True:
+                try:
+                    conn = Client(address, authkey=authkey)
+                    break
+                except ConnectionRefusedError:
+                    # rank 0 is not listening yet
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(0.5)
+            conn.send(rank)
+            self.peers = [conn]
+        self._buffer = None
+
+    def allreduce(self, array):
+        '''replace the contiguous float32 array with its mean over all ranks'''
+        if self.world_size == 1:
+            return array
+        if self.rank == 0:
+            if self._buffer is None or self._buffer.shape != array.shape:
+                self._buffer = np.empty_like(array)
+            for conn in self.peers:
+                conn.recv_bytes_into(self._buffer)
+                array += self._buffer
+            array /= self.world_size
+            for conn in self.peers:
+                conn.send_bytes(array)
+        else:
+            self.peers[0].send_bytes(array)
+            self.peers[0].recv_bytes_into(array)
+        return array
+
+    def broadcast(self, array):
+        '''replace the contiguous array with the one of rank 0'''
+        if self.rank == 0:
+            for conn in self.peers:
+                conn.send_bytes(array)
+        elif self.world_size > 1:
+            self.peers[0].recv_bytes_into(array)
+        return array
+
+    def close(self):
+        for conn in self.peers:
+            conn.close()
+        self.peers = []
+
+
+def flatten(arrays, out=None):
+    '''concatenate arrays into one float32 vector, reusing out if given'''
+    size = sum(np.size(a) for a in arrays)
+    if out is None or out.size != size:
+        out = np.empty(size, dtype='float32')
+    start = 0
+    for a in arrays:
+        out[start:start+np.size(a)] = np.ravel(a)
+        start += np.size(a)
+    return out
+
+
+def unflatten(flat, shapes):
+    '''split a vector made by flatten back into arrays of the given shapes'''
+    arrays = []
+    start = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        arrays.append(flat[start:start+size].reshape(shape))
+        start += size
+    return arrays
+
+
+def sync_weights(model, allreduce):
+    '''give every rank the weights of rank 0'''
+    shapes = [K.int_shape(w) for w in model.weights]
+    flat = flatten(model.get_weights()) if allreduce.rank == 0 else \
+        np.empty(sum(int(np.prod(s)) for s in shapes), dtype='float32')
+    model.set_weights(unflatten(allreduce.broadcast(flat), shapes))
+
+
+def batch_statistics(model):
+    '''the moving mean and variance variables of every BatchNormalization layer'''
+    variables = []
+    for layer in model.layers:
+        if isinstance(layer, BatchNormalization):
+            variables += [layer.moving_mean, layer.moving_variance]
+        elif hasattr(layer, 'layers'):
+            variables += batch_statistics(layer)
+    return variables
+
+
+def sync_batch_statistics(model, allreduce):
+    '''average the BatchNormalization statistics, which every rank updates from its own batches'''
+    variables = batch_statistics(model)
+    if not variables or allreduce.world_size == 1:
+        return
+    shapes = [K.int_shape(v) for v in variables]
+    flat = allreduce.allreduce(flatten(K.batch_get_value(variables)))
+    K.batch_set_value(list(zip(variables, unflatten(flat, shapes))))
+
+
+class DataParallelStep(object):
+    '''One training step of a model whose output is the yolo_loss, split over ranks.
+
+    Each rank computes the loss and gradients of its own batch, the gradients are
+    averaged with allreduce and every rank applies the same optimizer update, so the
+    trainable weights stay identical. BatchNormalization statistics are updated per
+    rank from its own batches until sync_batch_statistics averages them.
+    Build a new step after changing which layers are trainable.
+    '''
+
+    def __init__(self, model, optimizer, allreduce):
+        self.allreduce = allreduce
+        params = model.trainable_weights
+        self.shapes = [K.int_shape(p) for p in params]
+        loss = K.mean(model.output)
+        grads = K.gradients(loss, params)
+        inputs = model.inputs + [K.learning_phase()]
+        self._compute = K.function(inputs, [loss] + grads, updates=model.updates)
+        self._evaluate = K.function(inputs, [loss])
+
+        # let the optimizer build its update from gradients fed as placeholders
+        self._grads = [K.placeholder(shape=shape) for shape in self.shapes]
+        optimizer.get_gradients = lambda loss, params: self._grads
+        self._apply = K.function(self._grads, [], updates=optimizer.get_updates(loss, params))
+        self._flat = None
+        self.compute_time = 0
+        self.reduce_time = 0
+
+    def train_on_batch(self, inputs):
+        '''return the loss averaged over all ranks'''
+        start = time.time()
+        outputs = self._compute(inputs + [1])
+        # the loss rides along with the gradients
+        self._flat = flatten(outputs, self._flat)
+        self.compute_time += time.time() - start
+        start = time.time()
+        self.allreduce.allreduce(self._flat)
+        self.reduce_time += time.time() - start
+        self._apply(unflatten(self._flat[1:], self.shapes))
+        return float(self._flat[0])
+
+    def evaluate(self, generator, steps):
+        '''return the mean loss over steps batches of every rank'''
+        losses = [self._evaluate(next(generator)[0] + [0])[0] for _ in range(steps)]
+        return float(self.allreduce.allreduce(np.array([np.mean(losses)], dtype='float32'))[0])
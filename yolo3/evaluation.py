@@ -0,0 +1,213 @@
+"""Cached detections and vectorized VOC style average precision."""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from yolo3.annotation import AnnotationIndex, annotation_digest, annotation_records
+
+
+def prediction_key(model_path, annotations, model_image_size, score):
+    '''hash the weights, the evaluated samples and the detection settings the cache depends on'''
+    key = hashlib.sha1()
+    with open(model_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            key.update(chunk)
+    key.update(annotation_digest(annotations).digest())
+    key.update('{}x{} {}'.format(model_image_size[0], model_image_size[1], score).encode('utf8'))
+    return key.hexdigest()
+
+
+class PredictionCache(object):
+    '''Raw detections of every evaluated image, one row per box.
+
+    image.npy holds the position of the image in the annotations, box.npy the
+    x_min, y_min, x_max, y_max boxes in image pixels, score.npy and cls.npy the rest.
+    Files live in cache_dir/<key> and only count once meta.json has been written.
+    '''
+
+    names = ('image', 'box', 'score', 'cls')
+
+    def __init__(self, cache_dir, key):
+        self.path = os.path.join(cache_dir, key)
+        if self.complete:
+            self._open()
+
+    @property
+    def complete(self):
+        return os.path.isfile(os.path.join(self.path, 'meta.json'))
+
+    def _open(self):
+        for name in self.names:
+            setattr(self, name, np.load(os.path.join(self.path, name + '.npy')))
+        with open(os.path.join(self.path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+    def __len__(self):
+        return len(self.score)
+
+    def save(self, image, box, score, cls, **meta):
+        os.makedirs(self.path, exist_ok=True)
+        arrays = [np.asarray(image, dtype='int64'),
+                  np.asarray(box, dtype='float32').reshape(-1, 4),
+                  np.asarray(score, dtype='float32'), np.asarray(cls, dtype='int32')]
+        for name, array in zip(self.names, arrays):
+            np.save(os.path.join(self.path, name + '.npy'), array)
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        self._open()
+
+
+def ground_truth(annotations):
+    '''image position, x_min, y_min, x_max, y_max box and class of every annotated box'''
+    if isinstance(annotations, AnnotationIndex):
+        images = annotations.images[annotations.rows]
+        counts = images['count'].astype('int64')
+        # gather the boxes of the indexed rows without a python loop
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        boxes = annotations.boxes[np.repeat(images['start'], counts) + offsets]
+    else:
+        records = list(annotation_records(annotations))
+        counts = np.array([len(boxes) for _, boxes in records], dtype='int64')
+        boxes = np.concatenate([boxes for _, boxes in records] + [np.zeros((0, 5), dtype='int32')])
+    image = np.repeat(np.arange(len(counts)), counts)
+    return image, boxes[:, :4].astype('float32'), boxes[:, 4].astype('int64')
+
+
+def pairwise_iou(a, b):
+    '''iou of the rows of two (N, 4) pixel box arrays, counting the end pixels as VOC does'''
+    iw = np.maximum(np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0]) + 1, 0)
+    ih = np.maximum(np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1]) + 1, 0)
+    inter = iw * ih
+    area_a = (a[:, 2] - a[:, 0] + 1) * (a[:, 3] - a[:, 1] + 1)
+    area_b = (b[:, 2] - b[:, 0] + 1) * (b[:, 3] - b[:, 1] + 1)
+    return inter / (area_a + area_b - inter)
+
+
+def best_matches(det_image, det_box, det_cls, gt_image, gt_box, gt_cls, num_classes):
+    '''index and iou of the ground truth box of the same image and class that overlaps each
+    detection most, -1 and 0 where there is none
+
+    All detection and ground truth pairs that share an image and class are compared at once.
+    '''
+    det_key = det_image * num_classes + det_cls
+    gt_key = gt_image * num_classes + gt_cls
+    gt_order = np.argsort(gt_key, kind='stable')
+    sorted_keys = gt_key[gt_order]
+    gt_start = np.searchsorted(sorted_keys, det_key, 'left')
+    counts = np.searchsorted(sorted_keys, det_key, 'right') - gt_start
+
+    pair_start = np.cumsum(counts) - counts
+    pair_det = np.repeat(np.arange(len(det_key)), counts)
+    pair_offset = np.arange(counts.sum()) - np.repeat(pair_start, counts)
+    pair_gt = gt_order[np.repeat(gt_start, counts) + pair_offset]
+    iou = pairwise_iou(det_box[pair_det], gt_box[pair_gt])
+
+    # highest iou first within each detection, the first ground truth box on ties
+    order = np.lexsort((-iou, pair_det))
+    matched = counts > 0
+    best_gt = np.full(len(det_key), -1, dtype='int64')
+    best_iou = np.zeros(len(det_key), dtype=iou.dtype)
+    best_gt[matched] = pair_gt[order[pair_start[matched]]]
+    best_iou[matched] = iou[order[pair_start[matched]]]
+    return best_gt, best_iou
+
+
+def match_detections(best_gt, best_iou, iou_thresholds):
+    '''(T, N) true positive flags of detections sorted by descending score, as in the VOC devkit
+
+    A detection is a true positive when its best ground truth box overlaps by more than
+    the threshold and no higher scoring detection took that box before. Since the best box
+    does not depend on what was taken, that is the first detection in score order of each
+    box among those over the threshold.
+    '''
+    tp = np.zeros((len(iou_thresholds), len(best_gt)), dtype=bool)
+    for t, threshold in enumerate(iou_thresholds):
+        candidates = np.flatnonzero(best_iou > threshold)
+        _, first = np.unique(best_gt[candidates], return_index=True)
+        tp[t, candidates[first]] = True
+    return tp
+
+
+def average_precision(recall, precision, metric='voc07'):
+    '''(T,) area under (T, N) precision recall curves, by 11 point interpolation for voc07
+    or under the precision envelope for area'''
+    # precision envelope, the highest precision at this recall or beyond
+    envelope = np.maximum.accumulate(precision[:, ::-1], axis=1)[:, ::-1]
+    if metric == 'voc07':
+        points = np.linspace(0, 1, 11)
+        ap = np.zeros(len(recall))
+        for t in range(len(recall)):
+            i = np.searchsorted(recall[t], points, 'left')
+            ap[t] = np.where(i < recall.shape[1], np.append(envelope[t], 0)[i], 0).sum()
+        return ap / len(points)
+    if metric == 'area':
+        recall = np.concatenate([np.zeros((len(recall), 1)), recall], axis=1)
+        return (np.diff(recall, axis=1) * envelope).sum(axis=1)
+    raise ValueError('unknown metric {}'.format(metric))
+
+
+class DetectionEvaluator(object):
+    '''Matching of cached detections against the annotations, done once per iou threshold.
+
+    Matching in score order does not depend on the lower scoring detections, so every
+    score threshold is a prefix of the same matched list; AP, precision recall curves and
+    threshold sweeps are cumulative sums over it.
+    '''
+
+    def __init__(self, annotations, predictions, num_classes, iou_thresholds=(0.5,)):
+        self.num_classes = num_classes
+        self.iou_thresholds = np.asarray(iou_thresholds, dtype='float64').reshape(-1)
+        gt_image, gt_box, gt_cls = ground_truth(annotations)
+        self.num_positives = np.bincount(gt_cls, minlength=num_classes)
+        best_gt, best_iou = best_matches(predictions.image, predictions.box, predictions.cls,
+                                         gt_image, gt_box, gt_cls, num_classes)
+        # by class, then by descending score
+        order = np.lexsort((-predictions.score, predictions.cls))
+        self.scores = predictions.score[order]
+        cls = predictions.cls[order]
+        self.class_start = np.searchsorted(cls, np.arange(num_classes + 1))
+        tp = match_detections(best_gt[order], best_iou[order], self.iou_thresholds)
+        self.cum_tp = np.cumsum(tp, axis=1)
+
+    def _class_slice(self, c):
+        return slice(self.class_start[c], self.class_start[c+1])
+
+    def pr_curve(self, c):
+        '''(T, N) recall and precision of class c at each of its detections, and their scores'''
+        s = self._class_slice(c)
+        cum_tp = self.cum_tp[:, s] - (self.cum_tp[:, s.start-1:s.start] if s.start else 0)
+        num_detections = np.arange(1, cum_tp.shape[1] + 1)
+        recall = cum_tp / max(self.num_positives[c], 1)
+        precision = cum_tp / num_detections
+        return recall, precision, self.scores[s]
+
+    def average_precision(self, metric='voc07'):
+        '''(T, num_classes) AP, nan for classes without annotated boxes'''
+        ap = np.full((len(self.iou_thresholds), self.num_classes), np.nan)
+        for c in range(self.num_classes):
+            if self.num_positives[c]:
+                recall, precision, _ = self.pr_curve(c)
+                ap[:, c] = average_precision(recall, precision, metric) if recall.shape[1] else 0
+        return ap
+
+    def mean_average_precision(self, metric='voc07'):
+        '''(T,) mAP over the classes that have annotated boxes'''
+        return np.nanmean(self.average_precision(metric), axis=1)
+
+    def threshold_sweep(self, score_thresholds):
+        '''(T, num_classes, S) precision and recall keeping the detections scored at least
+        each threshold'''
+        score_thresholds = np.asarray(score_thresholds, dtype='float64')
+        shape = (len(self.iou_thresholds), self.num_classes, len(score_thresholds))
+        precision, recall = np.ones(shape), np.zeros(shape)
+        for c in range(self.num_classes):
+            recall_c, precision_c, scores = self.pr_curve(c)
+            # scores descend, so the kept detections are a prefix
+            n = np.searchsorted(-scores, -score_thresholds, 'right')
+            kept = n > 0
+            precision[:, c, kept] = precision_c[:, n[kept] - 1]
+            recall[:, c, kept] = recall_c[:, n[kept] - 1]
+        return precision, recall
@@ -0,0 +1,156 @@
+"""Decoded image cache for training."""
+
+import json
+import multiprocessing as mp
+import os
+
+import numpy as np
+from PIL import Image
+
+from yolo3.utils import draft_image
+
+CACHE_VERSION = 1
+
+
+def _decode(args):
+    path, max_size = args
+    with Image.open(path) as image:
+        iw, ih = image.size
+        scale = min(1., max_size/max(iw, ih))
+        size = (max(1, int(iw*scale)), max(1, int(ih*scale)))
+        image = draft_image(image, size).convert('RGB')
+    if image.size != size:
+        image = image.resize(size, Image.BICUBIC)
+    return np.asarray(image, dtype='uint8'), (iw, ih)
+
+
+class ImageCache(object):
+    '''Decoded uint8 images in one memory-mapped file, shared across processes and runs.
+
+    <cache_path>.bin holds the pixels back to back, <cache_path>.json maps every image
+    path to its offset, cached shape, original size and the file mtime/size it was
+    decoded from. Images are shrunk so the long side is at most max_size, which should
+    cover the largest size get_random_data resizes to (2x the input for random scaling).
+
+    Call build() once in the main process, workers then only read. get() returns None
+    for images that are missing from the cache or changed since, so callers fall back
+    to decoding the file. Whether an image changed is checked once per process, by
+    build() for the paths it is given and on the first get() for others, so files
+    replaced during a run are only noticed by the next one.
+
+    Changed images are appended again, which leaves their old pixels as dead bytes in
+    the .bin file. build() rewrites the file without them once they are more than
+    max_dead_fraction of it.
+    '''
+
+    def __init__(self, cache_path, max_size=832, max_dead_fraction=0.5):
+        self.cache_path = cache_path
+        self.max_size = max_size
+        self.max_dead_fraction = max_dead_fraction
+        self.data_path = cache_path + '.bin'
+        self.index_path = cache_path + '.json'
+        self.entries = {}
+        self._fresh = {}
+        self._data = None
+        if os.path.isfile(self.index_path) and os.path.isfile(self.data_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index['version'] == CACHE_VERSION and index['max_size'] == max_size:
+                self.entries = index['entries']
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None # every process maps the file itself
+        return state
+
+    @staticmethod
+    def _stat(path):
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+
+    def _is_fresh(self, path, entry):
+        try:
+            return tuple(entry[5:7]) == self._stat(path)
+        except OSError:
+            return False
+
+    def _write_index(self, entries):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'max_size': self.max_size,
+                       'entries': entries}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def dead_bytes(self):
+        '''bytes of the .bin file that no entry points to'''
+        if not os.path.isfile(self.data_path):
+            return 0
+        live = sum(h*w*3 for _, h, w in (entry[:3] for entry in self.entries.values()))
+        return os.path.getsize(self.data_path) - live
+
+    def compact(self):
+        '''rewrite the .bin file with only the pixels the entries point to'''
+        data = np.memmap(self.data_path, dtype='uint8', mode='r')
+        entries = {}
+        tmp_path = self.data_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for path, entry in sorted(self.entries.items(), key=lambda item: item[1][0]):
+                offset, h, w = entry[:3]
+                entries[path] = [f.tell()] + entry[1:]
+                f.write(data[offset:offset + h*w*3].tobytes())
+        del data
+        # an empty index first, so a crash before the new one is written means a rebuild
+        # rather than offsets into the wrong file
+        self._write_index({})
+        os.replace(tmp_path, self.data_path)
+        self._write_index(entries)
+        self.entries = entries
+        self._data = None
+
+    def build(self, paths, workers=0):
+        '''decode every image in paths that is not cached or has changed, return how many'''
+        paths = set(paths)
+        for path in paths:
+            self._fresh[path] = path in self.entries and \
+                self._is_fresh(path, self.entries[path])
+        stale = sorted(path for path in paths if not self._fresh[path])
+        if not stale:
+            return 0
+        if not self.entries and os.path.isfile(self.data_path):
+            os.remove(self.data_path) # index was invalid, start over
+        tasks = [(path, self.max_size) for path in stale]
+        pool = mp.Pool(workers) if workers > 0 else None
+        decoded = pool.imap(_decode, tasks, chunksize=16) if pool else map(_decode, tasks)
+        try:
+            with open(self.data_path, 'ab') as f:
+                for path, (pixels, (iw, ih)) in zip(stale, decoded):
+                    offset = f.tell()
+                    f.write(pixels.tobytes())
+                    h, w = pixels.shape[:2]
+                    self.entries[path] = [offset, h, w, iw, ih, *self._stat(path)]
+                    self._fresh[path] = True
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        self._write_index(self.entries)
+        self._data = None
+        if self.dead_bytes() > self.max_dead_fraction * os.path.getsize(self.data_path):
+            self.compact()
+        return len(stale)
+
+    def get(self, path):
+        '''return (image, (original_w, original_h)) or None if path is not cached fresh'''
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+        fresh = self._fresh.get(path)
+        if fresh is None:
+            fresh = self._fresh[path] = self._is_fresh(path, entry)
+        if not fresh:
+            return None
+        offset, h, w, iw, ih = entry[:5]
+        if self._data is None or offset + h*w*3 > len(self._data):
+            self._data = np.memmap(self.data_path, dtype='uint8', mode='r')
+        pixels = self._data[offset:offset + h*w*3].reshape(h, w, 3)
+        return Image.fromarray(pixels), (iw, ih)
@@ -0,0 +1,284 @@
+"""Parallel data loading for training."""
+
+import multiprocessing as mp
+import os
+import queue
+import traceback
+
+import numpy as np
+
+from yolo3.annotation import annotation_digest
+from yolo3.model import preprocess_true_boxes
+from yolo3.shards import ShardedDataset
+from yolo3.utils import get_random_data
+
+
+def _batch_shapes(batch_size, input_shape, anchors, num_classes, sparse_targets, max_boxes=20):
+    h, w = input_shape
+    num_layers = len(anchors)//3 # default setting
+    shapes = [(batch_size, h, w, 3)]
+    if sparse_targets:
+        return shapes + [(batch_size, max_boxes, 5)]
+    shapes += [(batch_size, h//{0:32, 1:16, 2:8}[l], w//{0:32, 1:16, 2:8}[l], 3, 5+num_classes)
+               for l in range(num_layers)]
+    return shapes
+
+
+def _slot_arrays(buffers, shapes):
+    return [np.frombuffer(buffer, dtype='float32').reshape(shape)
+            for buffer, shape in zip(buffers, shapes)]
+
+
+def _worker(annotation_lines, slot_buffers, shapes, task_queue, done_queue,
+            input_shape, anchors, num_classes, random, sparse_targets, image_cache, seeded,
+            part, parts):
+    if not seeded:
+        np.random.seed() # forked workers would otherwise share the parent's random state
+    slots = [_slot_arrays(buffers, shapes) for buffers in slot_buffers]
+    records = None
+    if isinstance(annotation_lines, ShardedDataset):
+        # shards are read in sequence, so every worker streams its own part of them
+        records = annotation_lines.records(part=part, parts=parts)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        batch_id, slot, indices, seed = task
+        try:
+            if seed is not None:
+                np.random.seed(seed)
+            image_data, *y_true = slots[slot]
+            box_data = []
+            for b, i in enumerate(indices):
+                record = annotation_lines[i] if records is None else next(records)
+                image, box = get_random_data(record, input_shape, random=random,
+                                             image_cache=image_cache)
+                image_data[b] = image
+                box_data.append(box)
+            box_data = np.array(box_data)
+            if sparse_targets:
+                y_true[0][...] = box_data
+            else:
+                for y, target in zip(y_true, preprocess_true_boxes(
+                        box_data, input_shape, anchors, num_classes)):
+                    y[...] = target
+            done_queue.put((batch_id, slot, None))
+        except Exception:
+            done_queue.put((batch_id, slot, traceback.format_exc()))
+
+
+class ParallelDataGenerator(object):
+    '''Training batches built by worker processes into shared memory slots.
+
+    Yields the same ([image_data, *y_true], zeros) batches as train.data_generator,
+    or ([image_data, box_data], zeros) with sparse_targets,
+    in order, while up to `prefetch` batches are augmented and encoded ahead by
+    `workers` processes. With a fixed seed the epoch order and the augmentation
+    of every batch do not depend on which worker builds it, so runs are
+    reproducible. Batches are copied out of their slot before being yielded, as
+    Keras keeps several of them queued. Call close() (or use it as a context
+    manager) to stop the workers; it cannot be restarted after that.
+
+    annotation_lines may also be a ShardedDataset. Every worker then reads its own
+    part of the shards in sequence, so which images make up a batch depends on the
+    worker that builds it and a fixed seed no longer makes runs reproducible.
+    '''
+
+    def __init__(self, annotation_lines, batch_size, input_shape, anchors, num_classes,
+                 random=True, shuffle=True, workers=4, prefetch=4, seed=None,
+                 sparse_targets=False, image_cache=None):
+        self.annotation_lines = annotation_lines
+        self.batch_size = batch_size
+        self.input_shape = input_shape
+        self.anchors = anchors
+        self.num_classes = num_classes
+        self.random = random
+        self.shuffle = shuffle
+        self.workers = workers
+        self.prefetch = max(prefetch, 1)
+        self.seed = seed
+        self.sparse_targets = sparse_targets
+        self.image_cache = image_cache
+        self.shapes = _batch_shapes(batch_size, input_shape, anchors, num_classes, sparse_targets)
+        self._rng = np.random.RandomState(seed)
+        self._order = np.arange(len(annotation_lines))
+        self._cursor = 0
+        self._processes = None
+        self._closed = False
+
+    def _start(self):
+        ctx = mp.get_context()
+        self._slot_buffers = [[mp.RawArray('f', int(np.prod(shape))) for shape in self.shapes]
+                              for _ in range(self.prefetch)]
+        self._slots = [_slot_arrays(buffers, self.shapes) for buffers in self._slot_buffers]
+        self._task_queue = ctx.Queue()
+        self._done_queue = ctx.Queue()
+        self._processes = [ctx.Process(
+            target=_worker,
+            args=(self.annotation_lines, self._slot_buffers, self.shapes, self._task_queue,
+                  self._done_queue, self.input_shape, self.anchors, self.num_classes,
+                  self.random, self.sparse_targets, self.image_cache, self.seed is not None,
+                  part, self.workers),
+            daemon=True) for part in range(self.workers)]
+        for process in self._processes:
+            process.start()
+        self._free_slots = list(range(self.prefetch))
+        self._scheduled = 0
+        self._yielded = 0
+        self._done = {}
+        while self._free_slots:
+            self._schedule()
+
+    def _next_indices(self):
+        indices = []
+        for _ in range(self.batch_size):
+            if self._cursor == 0 and self.shuffle:
+                self._rng.shuffle(self._order)
+            indices.append(self._order[self._cursor])
+            self._cursor = (self._cursor + 1) % len(self._order)
+        return indices
+
+    def _schedule(self):
+        seed = None
+        if self.seed is not None:
+            seed = (self.seed * 1000003 + self._scheduled) % 2**32
+        self._task_queue.put((self._scheduled, self._free_slots.pop(), self._next_indices(), seed))
+        self._scheduled += 1
+
+    def _wait(self, batch_id):
+        while batch_id not in self._done:
+            try:
+                done_id, slot, error = self._done_queue.get(timeout=1)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self._processes):
+                    self.close()
+                    raise RuntimeError('A data loader worker exited unexpectedly')
+                continue
+            if error is not None:
+                self.close()
+                raise RuntimeError('Data loader worker failed:\n' + error)
+            self._done[done_id] = slot
+        return self._done.pop(batch_id)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise RuntimeError('ParallelDataGenerator is closed')
+        if self._processes is None:
+            self._start()
+        slot = self._wait(self._yielded)
+        self._yielded += 1
+        image_data, *y_true = [np.array(a) for a in self._slots[slot]]
+        self._free_slots.append(slot)
+        self._schedule()
+        return [image_data, *y_true], np.zeros(self.batch_size)
+
+    next = __next__
+
+    def close(self):
+        self._closed = True
+        if self._processes is None:
+            return
+        for _ in self._processes:
+            self._task_queue.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._processes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+class ValidationCache(object):
+    '''Deterministic (random=False) validation samples, built once and reused every epoch.
+
+    Letterboxed images are kept as uint8 and boxes as (n, max_boxes, 5) float32, in
+    memory or, with cache_dir, in .npy files that later runs with the same annotation
+    lines and input shape load memory-mapped. The images file is written last, so a
+    run interrupted while building leaves no cache that looks complete.
+    '''
+
+    def __init__(self, annotation_lines, input_shape, cache_dir=None, image_cache=None,
+                 max_boxes=20):
+        self.input_shape = input_shape
+        h, w = input_shape
+        key = annotation_digest(annotation_lines)
+        key.update('{}x{}x{}'.format(h, w, max_boxes).encode('utf8'))
+        if cache_dir is not None:
+            images_path = os.path.join(cache_dir, 'val_{}_images.npy'.format(key.hexdigest()))
+            boxes_path = os.path.join(cache_dir, 'val_{}_boxes.npy'.format(key.hexdigest()))
+            if os.path.isfile(images_path) and os.path.isfile(boxes_path):
+                self.images = np.load(images_path, mmap_mode='r')
+                self.boxes = np.load(boxes_path, mmap_mode='r')
+                return
+            os.makedirs(cache_dir, exist_ok=True)
+            images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype='uint8',
+                                               shape=(len(annotation_lines), h, w, 3))
+        else:
+            images = np.empty((len(annotation_lines), h, w, 3), dtype='uint8')
+        boxes = np.zeros((len(annotation_lines), max_boxes, 5), dtype='float32')
+
+        # get_random_data shuffles the boxes even with random=False, fix that order too
+        state = np.random.get_state()
+        np.random.seed(10101)
+        for i, annotation_line in enumerate(annotation_lines):
+            image, box = get_random_data(annotation_line, input_shape, random=False,
+                                         max_boxes=max_boxes, image_cache=image_cache)
+            images[i] = np.rint(image*255)
+            boxes[i] = box
+        np.random.set_state(state)
+
+        if cache_dir is not None:
+            with open(boxes_path + '.tmp', 'wb') as f:
+                np.save(f, boxes)
+            os.replace(boxes_path + '.tmp', boxes_path)
+            images.flush()
+            del images
+            os.replace(images_path + '.tmp', images_path)
+            self.images = np.load(images_path, mmap_mode='r')
+        else:
+            self.images = images
+        self.boxes = boxes
+
+    def __len__(self):
+        return len(self.images)
+
+    def generator(self, batch_size, anchors, num_classes, sparse_targets=False,
+                  max_target_bytes=1 << 30):
+        '''yield the same max(1, n//batch_size) batches in the same order every epoch
+
+        The encoded y_true of every batch is kept from the first epoch on when all of
+        them fit in max_target_bytes. The dense targets are several times larger than
+        the images, so for bigger validation sets they are encoded again per batch.
+        '''
+        n = len(self)
+        steps = max(1, n//batch_size)
+        targets = {}
+        keep_targets = None
+        while True:
+            for step in range(steps):
+                index = (np.arange(batch_size) + step*batch_size) % n
+                image_data = self.images[index].astype('float32') / 255.
+                box_data = self.boxes[index]
+                if sparse_targets:
+                    yield [image_data, box_data], np.zeros(batch_size)
+                    continue
+                y_true = targets.get(step)
+                if y_true is None:
+                    y_true = preprocess_true_boxes(box_data, self.input_shape, anchors,
+                                                   num_classes)
+                    if keep_targets is None:
+                        keep_targets = sum(a.nbytes for a in y_true)*steps <= max_target_bytes
+                    if keep_targets:
+                        targets[step] = y_true
+                yield [image_data, *y_true], np.zeros(batch_size)
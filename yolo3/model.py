@@ -67,9 +67,8 @@ def make_last_layers(x, num_filters, out_filters):
     return x, y
 
 
-def yolo_body(inputs, num_anchors, num_classes):
-    """Create YOLO_V3 model CNN body in Keras."""
-    darknet = Model(inputs, darknet_body(inputs))
+def yolo_last_layers(darknet, num_anchors, num_classes):
+    '''The three YOLO_V3 outputs on top of a darknet_body Model'''
     x, y1 = make_last_layers(darknet.output, 512, num_anchors*(num_classes+5))
 
     x = compose(
@@ -84,7 +83,24 @@ def yolo_body(inputs, num_anchors, num_classes):
     x = Concatenate()([x,darknet.layers[92].output])
     x, y3 = make_last_layers(x, 128, num_anchors*(num_classes+5))
 
-    return Model(inputs, [y1,y2,y3])
+    return [y1,y2,y3]
+
+def yolo_body(inputs, num_anchors, num_classes):
+    """Create YOLO_V3 model CNN body in Keras."""
+    darknet = Model(inputs, darknet_body(inputs))
+    return Model(inputs, yolo_last_layers(darknet, num_anchors, num_classes))
+
+def multi_head_yolo_body(inputs, num_anchors, num_classes_list):
+    '''One darknet_body shared by a set of YOLO_V3 output layers per entry of num_classes_list.
+
+    Returns the model with the 3 outputs of every head in turn, and a model per head that
+    has the layers of yolo_body in the same order, for loading that head's weights.
+    '''
+    darknet = Model(inputs, darknet_body(inputs))
+    head_outputs = [yolo_last_layers(darknet, num_anchors, num_classes)
+                    for num_classes in num_classes_list]
+    head_models = [Model(inputs, outputs) for outputs in head_outputs]
+    return Model(inputs, sum(head_outputs, [])), head_models
 
 def tiny_yolo_body(inputs, num_anchors, num_classes):
     '''Create Tiny YOLO_v3 model CNN body in keras.'''
@@ -261,70 +277,128 @@ def preprocess_true_boxes(true_boxes, input_shape, anchors, num_classes):
     y_true = [np.zeros((m,grid_shapes[l][0],grid_shapes[l][1],len(anchor_mask[l]),5+num_classes),
         dtype='float32') for l in range(num_layers)]
 
-    # Expand dim to apply broadcasting.
-    anchors = np.expand_dims(anchors, 0)
-    anchor_maxes = anchors / 2.
-    anchor_mins = -anchor_maxes
+    # IoU of every box against every anchor, both centered at the origin.
     valid_mask = boxes_wh[..., 0]>0
+    b, t = np.nonzero(valid_mask)
+    wh = np.expand_dims(boxes_wh[b, t], -2)
+    intersect_wh = np.minimum(wh, anchors)
+    intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
+    box_area = wh[..., 0] * wh[..., 1]
+    anchor_area = anchors[..., 0] * anchors[..., 1]
+    iou = intersect_area / (box_area + anchor_area - intersect_area)
 
-    for b in range(m):
-        # Discard zero rows.
-        wh = boxes_wh[b, valid_mask[b]]
-        if len(wh)==0: continue
-        # Expand dim to apply broadcasting.
-        wh = np.expand_dims(wh, -2)
-        box_maxes = wh / 2.
-        box_mins = -box_maxes
-
-        intersect_mins = np.maximum(box_mins, anchor_mins)
-        intersect_maxes = np.minimum(box_maxes, anchor_maxes)
-        intersect_wh = np.maximum(intersect_maxes - intersect_mins, 0.)
-        intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
-        box_area = wh[..., 0] * wh[..., 1]
-        anchor_area = anchors[..., 0] * anchors[..., 1]
-        iou = intersect_area / (box_area + anchor_area - intersect_area)
-
-        # Find best anchor for each true box
-        best_anchor = np.argmax(iou, axis=-1)
-
-        for t, n in enumerate(best_anchor):
-            for l in range(num_layers):
-                if n in anchor_mask[l]:
-                    i = np.floor(true_boxes[b,t,0]*grid_shapes[l][1]).astype('int32')
-                    j = np.floor(true_boxes[b,t,1]*grid_shapes[l][0]).astype('int32')
-                    k = anchor_mask[l].index(n)
-                    c = true_boxes[b,t, 4].astype('int32')
-                    y_true[l][b, j, i, k, 0:4] = true_boxes[b,t, 0:4]
-                    y_true[l][b, j, i, k, 4] = 1
-                    y_true[l][b, j, i, k, 5+c] = 1
+    # Find best anchor for each true box
+    best_anchor = np.argmax(iou, axis=-1)
+    c = true_boxes[b, t, 4].astype('int32')
+
+    for l in range(num_layers):
+        # Position of each anchor within this layer's mask, -1 if it is not in it.
+        anchor_index = np.full(len(anchors), -1, dtype='int32')
+        anchor_index[anchor_mask[l]] = np.arange(len(anchor_mask[l]))
+        k = anchor_index[best_anchor]
+        in_layer = k>=0
+        bl, tl, cl, k = b[in_layer], t[in_layer], c[in_layer], k[in_layer]
+        # float64 like the scalar products of the per-box loop this replaced
+        i = np.floor(true_boxes[bl,tl,0].astype('float64')*grid_shapes[l][1]).astype('int32')
+        j = np.floor(true_boxes[bl,tl,1].astype('float64')*grid_shapes[l][0]).astype('int32')
+        if ((i<0) | (i>=grid_shapes[l][1]) | (j<0) | (j>=grid_shapes[l][0])).any():
+            raise IndexError('box center outside input_shape {}'.format(tuple(input_shape)))
+        # Where boxes share a cell and anchor the last one wins the coordinates,
+        # class flags accumulate over all of them.
+        cell = np.ravel_multi_index((bl, j, i, k), y_true[l].shape[:4])
+        _, last = np.unique(cell[::-1], return_index=True)
+        last = len(cell) - 1 - last
+        y_true[l][bl[last], j[last], i[last], k[last], 0:4] = true_boxes[bl[last], tl[last], 0:4]
+        y_true[l][bl, j, i, k, 4] = 1
+        y_true[l][bl, j, i, k, 5+cl] = 1
 
     return y_true
 
 
-def box_iou(b1, b2):
-    '''Return iou tensor
+def true_boxes_to_y_true(true_boxes, input_shape, anchors, num_classes):
+    '''Build the y_true tensors of preprocess_true_boxes inside the graph
 
     Parameters
     ----------
-    b1: tensor, shape=(i1,...,iN, 4), xywh
-    b2: tensor, shape=(j, 4), xywh
+    true_boxes: tensor, shape=(m, T, 5)
+        Absolute x_min, y_min, x_max, y_max, class_id relative to input_shape,
+        zero rows are padding.
+    input_shape: tuple of int, hw, multiples of 32
+    anchors: array, shape=(N, 2), wh
+    num_classes: integer
 
     Returns
     -------
-    iou: tensor, shape=(i1,...,iN, j)
+    y_true: list of tensor, same values as preprocess_true_boxes
 
     '''
+    num_layers = len(anchors)//3 # default setting
+    anchor_mask = [[6,7,8], [3,4,5], [0,1,2]] if num_layers==3 else [[3,4,5], [1,2,3]]
+    h, w = input_shape
 
-    # Expand dim to apply broadcasting.
-    b1 = K.expand_dims(b1, -2)
+    # Grid positions and best anchors are computed in float64 like the numpy version,
+    # so boxes on a cell border land in the same cell.
+    true_boxes = K.cast(true_boxes, 'float32')
+    boxes_xy = tf.floor((true_boxes[..., 0:2] + true_boxes[..., 2:4]) / 2.)
+    boxes_wh = true_boxes[..., 2:4] - true_boxes[..., 0:2]
+    input_wh = K.constant([w, h], dtype='float32')
+    boxes = K.concatenate([boxes_xy/input_wh, boxes_wh/input_wh, K.ones_like(boxes_xy[..., :1])])
+
+    # Only the valid boxes, as (b, t) indices in row-major order.
+    box_index = K.cast(tf.where(boxes_wh[..., 0]>0), 'int32')
+    boxes = tf.gather_nd(boxes, box_index)
+    classes = K.cast(tf.gather_nd(true_boxes[..., 4], box_index), 'int32')
+    wh = K.expand_dims(tf.gather_nd(boxes_wh, box_index), -2)
+    anchors_tensor = K.constant(anchors, dtype='float64')
+    intersect_wh = K.minimum(K.cast(wh, 'float64'), anchors_tensor)
+    intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
+    box_area = K.cast(wh[..., 0] * wh[..., 1], 'float64')
+    anchor_area = anchors_tensor[..., 0] * anchors_tensor[..., 1]
+    iou = intersect_area / (box_area + anchor_area - intersect_area)
+    best_anchor = K.cast(K.argmax(iou, axis=-1), 'int32')
+
+    m = K.shape(true_boxes)[0]
+    y_true = []
+    for l in range(num_layers):
+        grid_h, grid_w = h//{0:32, 1:16, 2:8}[l], w//{0:32, 1:16, 2:8}[l]
+        num_anchors = len(anchor_mask[l])
+        anchor_index = np.full(len(anchors), -1, dtype='int32')
+        anchor_index[anchor_mask[l]] = np.arange(num_anchors)
+        k = K.gather(K.constant(anchor_index, dtype='int32'), best_anchor)
+        in_layer = k>=0
+        k = tf.boolean_mask(k, in_layer)
+        b = tf.boolean_mask(box_index[:, 0], in_layer)
+        layer_boxes = tf.boolean_mask(boxes, in_layer)
+        layer_classes = tf.boolean_mask(classes, in_layer)
+        i = K.cast(tf.floor(K.cast(layer_boxes[:, 0], 'float64')*grid_w), 'int32')
+        j = K.cast(tf.floor(K.cast(layer_boxes[:, 1], 'float64')*grid_h), 'int32')
+
+        # scatter_nd sums duplicates, so the coordinates are only scattered from the
+        # last box of every cell, while the class flags are summed and clipped.
+        num_cells = m*grid_h*grid_w*num_anchors
+        cell = ((b*grid_h + j)*grid_w + i)*num_anchors + k
+        order = tf.range(K.shape(cell)[0])
+        is_last = K.equal(K.gather(tf.unsorted_segment_max(order, cell, num_cells), cell), order)
+        box_part = tf.scatter_nd(K.expand_dims(tf.boolean_mask(cell, is_last), -1),
+                                 tf.boolean_mask(layer_boxes, is_last), K.stack([num_cells, 5]))
+        class_part = tf.scatter_nd(K.stack([cell, layer_classes], axis=-1),
+                                   K.ones_like(layer_boxes[:, 0]),
+                                   K.stack([num_cells, num_classes]))
+        class_part = K.minimum(class_part, 1.)
+        y_true.append(K.reshape(K.concatenate([box_part, class_part]),
+                                [-1, grid_h, grid_w, num_anchors, 5+num_classes]))
+
+    return y_true
+
+
+def _broadcast_iou(b1, b2):
+    '''iou of xywh boxes b1 and b2, already expanded to broadcast against each other'''
     b1_xy = b1[..., :2]
     b1_wh = b1[..., 2:4]
     b1_wh_half = b1_wh/2.
     b1_mins = b1_xy - b1_wh_half
     b1_maxes = b1_xy + b1_wh_half
 
-    # Expand dim to apply broadcasting.
-    b2 = K.expand_dims(b2, 0)
     b2_xy = b2[..., :2]
     b2_wh = b2[..., 2:4]
     b2_wh_half = b2_wh/2.
@@ -342,6 +416,45 @@ def box_iou(b1, b2):
     return iou
 
 
+def box_iou(b1, b2):
+    '''Return iou tensor
+
+    Parameters
+    ----------
+    b1: tensor, shape=(i1,...,iN, 4), xywh
+    b2: tensor, shape=(j, 4), xywh
+
+    Returns
+    -------
+    iou: tensor, shape=(i1,...,iN, j)
+
+    '''
+    # Expand dim to apply broadcasting.
+    b1 = K.expand_dims(b1, -2)
+    b2 = K.expand_dims(b2, 0)
+    return _broadcast_iou(b1, b2)
+
+
+def batch_box_iou(b1, b2):
+    '''Return iou tensor between the boxes of the same image
+
+    Parameters
+    ----------
+    b1: tensor, shape=(m, i1,...,iN, 4), xywh
+    b2: tensor, shape=(m, j, 4), xywh
+
+    Returns
+    -------
+    iou: tensor, shape=(m, i1,...,iN, j)
+
+    '''
+    # Expand dims to (m, i1,...,iN, 1, 4) and (m, 1,...,1, j, 4) to apply broadcasting.
+    for _ in range(K.ndim(b1)-2):
+        b2 = K.expand_dims(b2, 1)
+    b1 = K.expand_dims(b1, -2)
+    return _broadcast_iou(b1, b2)
+
+
 def yolo_loss(args, anchors, num_classes, ignore_thresh=.5, print_loss=False):
     '''Return yolo_loss tensor
 
@@ -382,17 +495,18 @@ def yolo_loss(args, anchors, num_classes, ignore_thresh=.5, print_loss=False):
         raw_true_wh = K.switch(object_mask, raw_true_wh, K.zeros_like(raw_true_wh)) # avoid log(0)=-inf
         box_loss_scale = 2 - y_true[l][...,2:3]*y_true[l][...,3:4]
 
-        # Find ignore mask, iterate over each of batch.
-        ignore_mask = tf.TensorArray(K.dtype(y_true[0]), size=1, dynamic_size=True)
-        object_mask_bool = K.cast(object_mask, 'bool')
-        def loop_body(b, ignore_mask):
-            true_box = tf.boolean_mask(y_true[l][b,...,0:4], object_mask_bool[b,...,0])
-            iou = box_iou(pred_box[b], true_box)
-            best_iou = K.max(iou, axis=-1)
-            ignore_mask = ignore_mask.write(b, K.cast(best_iou<ignore_thresh, K.dtype(true_box)))
-            return b+1, ignore_mask
-        _, ignore_mask = K.control_flow_ops.while_loop(lambda b,*args: b<m, loop_body, [0, ignore_mask])
-        ignore_mask = ignore_mask.stack()
+        # Find ignore mask for the whole batch at once: gather each image's true boxes
+        # into a (m, max_true, 4) tensor, padded with invalid boxes, and keep the best
+        # iou of every prediction against the valid ones.
+        object_mask_flat = K.reshape(object_mask, [m, -1])
+        true_box_flat = K.reshape(y_true[l][..., 0:4], [m, -1, 4])
+        max_true = K.max(K.cast(K.sum(object_mask_flat, axis=-1), 'int32'))
+        valid_true, true_index = tf.nn.top_k(object_mask_flat, k=max_true)
+        batch_index = K.tile(K.expand_dims(tf.range(m), -1), [1, max_true])
+        true_box = tf.gather_nd(true_box_flat, K.stack([batch_index, true_index], axis=-1))
+        iou = batch_box_iou(pred_box, true_box) * K.reshape(valid_true, [m, 1, 1, 1, -1])
+        best_iou = K.max(iou, axis=-1)
+        ignore_mask = K.cast(best_iou<ignore_thresh, K.dtype(true_box))
         ignore_mask = K.expand_dims(ignore_mask, -1)
 
         # K.binary_crossentropy is helpful to avoid exp overflow.
@@ -0,0 +1,76 @@
+"""Optimizers for training with limited memory."""
+
+from keras import backend as K
+from keras.legacy import interfaces
+from keras.optimizers import Adam
+
+
+class AccumulatingAdam(Adam):
+    '''Adam that applies one update per accum_steps micro-batches
+
+    The gradients of the micro-batches are summed and their mean is fed to Adam, which
+    equals the gradient of one batch accum_steps times larger because yolo_loss is a
+    per-image mean. Only BatchNormalization statistics still see the micro-batch.
+    iterations keeps counting micro-batches; lr decay and bias correction use the
+    number of applied updates.
+    '''
+
+    def __init__(self, accum_steps=1, **kwargs):
+        super(AccumulatingAdam, self).__init__(**kwargs)
+        self.accum_steps = accum_steps
+
+    @interfaces.legacy_get_updates_support
+    def get_updates(self, loss, params):
+        grads = self.get_gradients(loss, params)
+        self.updates = [K.update_add(self.iterations, 1)]
+
+        accum_steps = K.cast(self.accum_steps, K.dtype(self.iterations))
+        # 1. on the last micro-batch of a group, 0. otherwise
+        apply = K.cast(K.equal((self.iterations + 1) % accum_steps, 0), K.floatx())
+        num_updates = K.cast(self.iterations // accum_steps, K.floatx())
+
+        lr = self.lr
+        if self.initial_decay > 0:
+            lr *= (1. / (1. + self.decay * num_updates))
+
+        t = num_updates + 1
+        lr_t = lr * (K.sqrt(1. - K.pow(self.beta_2, t)) /
+                     (1. - K.pow(self.beta_1, t)))
+
+        ms = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        vs = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        accums = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        if self.amsgrad:
+            vhats = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        else:
+            vhats = [K.zeros(1) for _ in params]
+        self.weights = [self.iterations] + ms + vs + vhats + accums
+
+        for p, g, m, v, vhat, accum in zip(params, grads, ms, vs, vhats, accums):
+            accum_t = accum + g
+            g = accum_t / self.accum_steps
+            m_t = (self.beta_1 * m) + (1. - self.beta_1) * g
+            v_t = (self.beta_2 * v) + (1. - self.beta_2) * K.square(g)
+            if self.amsgrad:
+                vhat_t = K.maximum(vhat, v_t)
+                p_t = p - lr_t * m_t / (K.sqrt(vhat_t) + self.epsilon)
+                self.updates.append(K.update(vhat, apply*vhat_t + (1. - apply)*vhat))
+            else:
+                p_t = p - lr_t * m_t / (K.sqrt(v_t) + self.epsilon)
+
+            self.updates.append(K.update(m, apply*m_t + (1. - apply)*m))
+            self.updates.append(K.update(v, apply*v_t + (1. - apply)*v))
+            self.updates.append(K.update(accum, (1. - apply)*accum_t))
+            new_p = p_t
+
+            # Apply constraints.
+            if getattr(p, 'constraint', None) is not None:
+                new_p = p.constraint(new_p)
+
+            self.updates.append(K.update(p, apply*new_p + (1. - apply)*p))
+        return self.updates
+
+    def get_config(self):
+        config = {'accum_steps': self.accum_steps}
+        base_config = super(AccumulatingAdam, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
@@ -0,0 +1,127 @@
+"""Training throughput profiling, separating waiting for data from computing."""
+
+import json
+import os
+import threading
+from timeit import default_timer as timer
+
+import numpy as np
+import tensorflow as tf
+from keras.callbacks import Callback
+
+
+class ProfiledGenerator(object):
+    '''Wrap a training generator to time how long each batch takes to produce.
+
+    fit_generator pulls batches from a background thread, so this runs off the
+    training thread; it only counts batches and keeps their production times.
+    '''
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.produced = 0
+        self._times = []
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = timer()
+        batch = next(self.generator)
+        elapsed = timer() - start
+        with self._lock:
+            self._times.append(elapsed)
+            self.produced += 1
+        return batch
+
+    next = __next__
+
+    def pop_times(self):
+        '''return and forget the production times recorded so far'''
+        with self._lock:
+            times, self._times = self._times, []
+        return times
+
+
+class ThroughputProfiler(Callback):
+    '''Per epoch, split training step time into waiting for the next batch and computing.
+
+    The wait is the time from the end of one train step to the start of the next,
+    which fit_generator spends taking the batch off its queue. The queue depth is
+    the number of batches the generator had produced ahead of the step. The first
+    step of each epoch includes set-up and is left out. The summary goes to
+    TensorBoard under log_dir and is appended to log_dir/profile.json, with a
+    data-bound verdict when more than data_bound_fraction of the time is waiting.
+    '''
+
+    def __init__(self, log_dir, generator, data_bound_fraction=0.2):
+        super(ThroughputProfiler, self).__init__()
+        self.log_dir = log_dir
+        self.generator = generator
+        self.data_bound_fraction = data_bound_fraction
+        self.json_path = os.path.join(log_dir, 'profile.json')
+        self.writer = tf.summary.FileWriter(log_dir)
+        self.consumed = 0
+        self.history = []
+        if os.path.isfile(self.json_path):
+            with open(self.json_path) as f:
+                self.history = json.load(f)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.waits = []
+        self.computes = []
+        self.depths = []
+        self.images = 0
+        self.generator.pop_times()
+        self.batch_end = None
+
+    def on_batch_begin(self, batch, logs=None):
+        self.consumed += 1
+        self.batch_begin = timer()
+        if self.batch_end is not None:
+            self.waits.append(self.batch_begin - self.batch_end)
+            self.depths.append(self.generator.produced - self.consumed)
+
+    def on_batch_end(self, batch, logs=None):
+        self.batch_end = timer()
+        if batch > 0:
+            self.computes.append(self.batch_end - self.batch_begin)
+            self.images += (logs or {}).get('size', 0)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if not self.computes:
+            return
+        wait = float(np.sum(self.waits))
+        compute = float(np.sum(self.computes))
+        produce = self.generator.pop_times()
+        wait_fraction = wait / (wait + compute)
+        stats = {
+            'epoch': epoch + 1,
+            'images_per_sec': self.images / (wait + compute),
+            'wait_ms': 1000 * wait / len(self.waits),
+            'compute_ms': 1000 * compute / len(self.computes),
+            'produce_ms': 1000 * float(np.mean(produce)) if produce else 0.,
+            'queue_depth': float(np.mean(self.depths)),
+            'min_queue_depth': int(np.min(self.depths)),
+            'wait_fraction': wait_fraction,
+        }
+        for name, value in stats.items():
+            if name != 'epoch':
+                summary = tf.Summary(value=[tf.Summary.Value(tag='profile/' + name,
+                                                             simple_value=value)])
+                self.writer.add_summary(summary, epoch)
+        self.writer.flush()
+
+        data_bound = wait_fraction > self.data_bound_fraction
+        stats['verdict'] = 'data-bound' if data_bound else 'compute-bound'
+        self.history.append(stats)
+        with open(self.json_path, 'w') as f:
+            json.dump(self.history, f, indent=2)
+        print('Epoch {}: {:.1f} images/sec, {:.0f} ms waiting for data and {:.0f} ms computing '
+              'per step, queue depth {:.1f}: {}'.format(
+                  epoch + 1, stats['images_per_sec'], stats['wait_ms'], stats['compute_ms'],
+                  stats['queue_depth'], stats['verdict']))
+
+    def on_train_end(self, logs=None):
+        self.writer.close()
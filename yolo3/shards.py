@@ -0,0 +1,110 @@
+"""Training images and boxes packed into a few large files for sequential reading."""
+
+import io
+import json
+import os
+
+import numpy as np
+
+from yolo3.annotation import annotation_digest, annotation_records
+
+
+def pack_shards(annotations, shard_dir, shard_bytes=256 << 20):
+    '''copy the encoded images and boxes of annotations into shards of about shard_bytes
+
+    Each shard_NNNNN.bin holds the image files back to back, unchanged, and its
+    shard_NNNNN.npz the (path, offset, size, box_start, box_count) records and the
+    box table. shards.json lists the shards; if it was written for the same
+    annotations the existing shards are reused. Pack in shuffled order, reading only
+    shuffles across shards and within the shuffle buffer.
+    '''
+    manifest_path = os.path.join(shard_dir, 'shards.json')
+    digest = annotation_digest(annotations).hexdigest()
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f)['digest'] == digest:
+                return ShardedDataset(shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+
+    shards = []
+    records = iter(annotation_records(annotations))
+    record = next(records, None)
+    while record is not None:
+        name = 'shard_{:05d}'.format(len(shards))
+        paths, sizes, box_counts, boxes = [], [], [], []
+        with open(os.path.join(shard_dir, name + '.bin'), 'wb') as f:
+            while record is not None and f.tell() < shard_bytes:
+                path, box = record
+                with open(path, 'rb') as image_file:
+                    sizes.append(f.write(image_file.read()))
+                paths.append(path.encode('utf8'))
+                box_counts.append(len(box))
+                boxes.append(box)
+                record = next(records, None)
+        index = np.zeros(len(paths), dtype=[
+            ('path', 'S{}'.format(max(map(len, paths)))), ('offset', 'int64'), ('size', 'int64'),
+            ('box_start', 'int64'), ('box_count', 'int32')])
+        index['path'] = paths
+        index['size'] = sizes
+        index['offset'][1:] = np.cumsum(sizes)[:-1]
+        index['box_count'] = box_counts
+        index['box_start'][1:] = np.cumsum(box_counts)[:-1]
+        np.savez(os.path.join(shard_dir, name + '.npz'), index=index,
+                 boxes=np.concatenate(boxes).reshape(-1, 5))
+        shards.append({'name': name, 'count': len(paths)})
+
+    # written last, an interrupted packing is never mistaken for a complete one
+    with open(manifest_path, 'w') as f:
+        json.dump({'digest': digest, 'shards': shards}, f, indent=2)
+    return ShardedDataset(shard_dir)
+
+
+class ShardedDataset(object):
+    '''Reader of shards written by pack_shards.
+
+    records() yields (file object, boxes) records that get_random_data accepts like
+    annotation lines. Every pass visits the shards in random order and reads each
+    from start to end; a buffer of shuffle_buffer records mixes neighbouring images.
+    Loader processes each read their own part of the shards.
+    '''
+
+    def __init__(self, shard_dir, shuffle_buffer=256):
+        self.shard_dir = shard_dir
+        self.shuffle_buffer = shuffle_buffer
+        with open(os.path.join(shard_dir, 'shards.json')) as f:
+            self.shards = json.load(f)['shards']
+
+    def __len__(self):
+        return sum(shard['count'] for shard in self.shards)
+
+    def read_shard(self, name):
+        '''yield the records of one shard in the order they were packed'''
+        with np.load(os.path.join(self.shard_dir, name + '.npz')) as npz:
+            index = npz['index']
+            boxes = npz['boxes']
+        with open(os.path.join(self.shard_dir, name + '.bin'), 'rb') as f:
+            for size, start, count in zip(index['size'].tolist(), index['box_start'].tolist(),
+                                          index['box_count'].tolist()):
+                # records are contiguous, so this never seeks
+                yield io.BytesIO(f.read(size)), boxes[start:start+count]
+
+    def records(self, shuffle=True, part=0, parts=1):
+        '''yield records endlessly, pass after pass, of every parts-th shard from part on
+
+        With fewer shards than parts every part reads all of them.
+        '''
+        shards = self.shards[part::parts] if len(self.shards) >= parts else self.shards
+        buffer = []
+        buffer_size = min(self.shuffle_buffer, sum(shard['count'] for shard in shards))
+        while True:
+            order = np.random.permutation(len(shards)) if shuffle else range(len(shards))
+            for i in order:
+                for record in self.read_shard(shards[i]['name']):
+                    if not shuffle:
+                        yield record
+                    elif len(buffer) < buffer_size:
+                        buffer.append(record)
+                    else:
+                        j = np.random.randint(len(buffer))
+                        yield buffer[j]
+                        buffer[j] = record
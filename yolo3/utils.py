@@ -4,7 +4,7 @@ from functools import reduce
 
 from PIL import Image
 import numpy as np
-from matplotlib.colors import rgb_to_hsv, hsv_to_rgb
+import cv2
 
 def compose(*funcs):
     """Compose arbitrarily many functions, evaluated left to right.
@@ -30,16 +30,75 @@ def letterbox_image(image, size):
     new_image.paste(image, ((w-nw)//2, (h-nh)//2))
     return new_image
 
+def draft_image(image, size):
+    '''let an unloaded JPEG decode at the smallest DCT scale still covering size
+
+    PIL only honours this before the pixels are loaded and keeps the aspect ratio,
+    so read image.size for box scaling before calling it and resize the result.
+    '''
+    image.draft('RGB', (max(1, size[0]), max(1, size[1])))
+    return image
+
+def open_image(path, image_cache=None):
+    '''open an image from image_cache if it holds it, else from disk
+
+    Returns the image and the (w, h) of the original file, which is what box
+    coordinates refer to even when the cached copy is smaller.
+    '''
+    if image_cache is not None:
+        cached = image_cache.get(path)
+        if cached is not None:
+            return cached
+    image = Image.open(path)
+    return image, image.size
+
+def warp_image(image_data, size, offset, flip, out_size):
+    '''resize a uint8 image to size, place it at offset on a grey out_size canvas
+    and optionally flip it horizontally, all in one affine warp'''
+    nw, nh = size
+    dx, dy = offset
+    w, h = out_size
+    sx = nw/image_data.shape[1]
+    sy = nh/image_data.shape[0]
+    # map pixel centers to pixel centers, like PIL resize and paste do
+    M = np.array([[sx, 0, dx + (sx-1)/2],
+                  [0, sy, dy + (sy-1)/2]])
+    if flip:
+        M[0] = [-sx, 0, w - 1 - M[0, 2]]
+    return cv2.warpAffine(image_data, M, (w, h), flags=cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=(128,128,128))
+
+def distort_hsv(image_data, hue, sat, val):
+    '''shift hue by a fraction of a turn and scale saturation and value of a uint8 RGB image
+
+    Works on OpenCV's 8 bit HSV (hue in [0, 180)) through one lookup table per channel.
+    '''
+    x = np.arange(256, dtype='float32')
+    lut_hue = np.mod(np.rint(x + hue*180), 180).astype('uint8')
+    lut_sat = np.clip(np.rint(x*sat), 0, 255).astype('uint8')
+    lut_val = np.clip(np.rint(x*val), 0, 255).astype('uint8')
+    h, s, v = cv2.split(cv2.cvtColor(image_data, cv2.COLOR_RGB2HSV))
+    hsv = cv2.merge((cv2.LUT(h, lut_hue), cv2.LUT(s, lut_sat), cv2.LUT(v, lut_val)))
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
+
 def rand(a=0, b=1):
     return np.random.rand()*(b-a) + a
 
-def get_random_data(annotation_line, input_shape, random=True, max_boxes=20, jitter=.3, hue=.1, sat=1.5, val=1.5, proc_img=True):
-    '''random preprocessing for real-time data augmentation'''
-    line = annotation_line.split()
-    image = Image.open(line[0])
-    iw, ih = image.size
+def get_random_data(annotation_line, input_shape, random=True, max_boxes=20, jitter=.3, hue=.1,
+        sat=1.5, val=1.5, proc_img=True, image_cache=None):
+    '''random preprocessing for real-time data augmentation
+
+    annotation_line is a train.txt line or an (image path, boxes) record of an AnnotationIndex.
+    '''
+    if isinstance(annotation_line, str):
+        line = annotation_line.split()
+        path = line[0]
+        box = np.array([np.array(list(map(int,box.split(',')))) for box in line[1:]])
+    else:
+        path, box = annotation_line
+        box = np.array(box) # a copy, the boxes are corrected in place
+    image, (iw, ih) = open_image(path, image_cache)
     h, w = input_shape
-    box = np.array([np.array(list(map(int,box.split(',')))) for box in line[1:]])
 
     if not random:
         # resize image
@@ -50,6 +109,7 @@ def get_random_data(annotation_line, input_shape, random=True, max_boxes=20, jit
         dy = (h-nh)//2
         image_data=0
         if proc_img:
+            image = draft_image(image, (nw,nh))
             image = image.resize((nw,nh), Image.BICUBIC)
             new_image = Image.new('RGB', (w,h), (128,128,128))
             new_image.paste(image, (dx, dy))
@@ -75,32 +135,28 @@ def get_random_data(annotation_line, input_shape, random=True, max_boxes=20, jit
     else:
         nw = int(scale*w)
         nh = int(nw/new_ar)
-    image = image.resize((nw,nh), Image.BICUBIC)
 
     # place image
     dx = int(rand(0, w-nw))
     dy = int(rand(0, h-nh))
-    new_image = Image.new('RGB', (w,h), (128,128,128))
-    new_image.paste(image, (dx, dy))
-    image = new_image
 
     # flip image or not
     flip = rand()<.5
-    if flip: image = image.transpose(Image.FLIP_LEFT_RIGHT)
+
+    # resize, place and flip in a single affine warp
+    image = draft_image(image, (nw,nh))
+    image_data = np.asarray(image.convert('RGB'))
+    if image_data.shape[1] > 2*nw and image_data.shape[0] > 2*nh:
+        # warpAffine does not average over large reductions, so shrink first
+        image_data = cv2.resize(image_data, (2*nw, 2*nh), interpolation=cv2.INTER_AREA)
+    image_data = warp_image(image_data, (nw,nh), (dx,dy), flip, (w,h))
 
     # distort image
     hue = rand(-hue, hue)
     sat = rand(1, sat) if rand()<.5 else 1/rand(1, sat)
     val = rand(1, val) if rand()<.5 else 1/rand(1, val)
-    x = rgb_to_hsv(np.array(image)/255.)
-    x[..., 0] += hue
-    x[..., 0][x[..., 0]>1] -= 1
-    x[..., 0][x[..., 0]<0] += 1
-    x[..., 1] *= sat
-    x[..., 2] *= val
-    x[x>1] = 1
-    x[x<0] = 0
-    image_data = hsv_to_rgb(x) # numpy array, 0 to 1
+    image_data = distort_hsv(image_data, hue, sat, val)
+    image_data = image_data.astype('float32') / 255. # numpy array, 0 to 1
 
     # correct boxes
     box_data = np.zeros((max_boxes,5))
@@ -0,0 +1,225 @@
+"""Weight file readers and writers for YOLO models."""
+
+import json
+
+import numpy as np
+from keras import backend as K
+from keras.layers import Conv2D
+from keras.layers.normalization import BatchNormalization
+
+FLAT_MAGIC = b'YOLOFLAT'
+FLAT_VERSION = 1
+FLAT_ALIGN = 64
+
+
+def _align(offset):
+    return (offset + FLAT_ALIGN - 1) // FLAT_ALIGN * FLAT_ALIGN
+
+
+def model_weights(model):
+    '''Return [(layer_name, [arrays])] for the layers of model that hold weights'''
+    return [(layer.name, layer.get_weights()) for layer in model.layers if layer.weights]
+
+
+def read_h5_weights(h5_path):
+    '''Read [(layer_name, [arrays])] in saved order from a Keras .h5 model or weights file
+
+    This is the order Keras' topological load_weights assigns them in.
+    '''
+    import h5py
+    weights = []
+    with h5py.File(h5_path, mode='r') as f:
+        if 'layer_names' not in f.attrs and 'model_weights' in f:
+            f = f['model_weights']
+        for name in f.attrs['layer_names']:
+            name = name.decode('utf8') if isinstance(name, bytes) else name
+            g = f[name]
+            weight_names = [n.decode('utf8') if isinstance(n, bytes) else n
+                            for n in g.attrs['weight_names']]
+            if weight_names:
+                weights.append((name, [np.asarray(g[n]) for n in weight_names]))
+    return weights
+
+
+def save_flat_weights(weights, flat_path, dtype='float32'):
+    '''Write [(layer_name, [arrays])] to a flat weight file
+
+    Layout: 8 byte magic, uint32 version, uint32 header length, a JSON header
+    listing every layer's arrays with shape, dtype and byte offset into the data
+    section, then the data section, which starts at the next 64 byte boundary and
+    holds the arrays contiguously, each aligned to 64 bytes.
+    '''
+    dtype = np.dtype(dtype)
+    assert dtype in (np.float16, np.float32), 'flat weights are float16 or float32'
+    layers = []
+    offset = 0
+    for name, arrays in weights:
+        entries = []
+        for array in arrays:
+            entries.append({'shape': list(array.shape), 'dtype': dtype.name, 'offset': offset})
+            offset = _align(offset + array.size * dtype.itemsize)
+        layers.append({'name': name, 'weights': entries})
+    header = json.dumps({'layers': layers}).encode('utf8')
+    data_start = _align(len(FLAT_MAGIC) + 8 + len(header))
+
+    with open(flat_path, 'wb') as f:
+        f.write(FLAT_MAGIC)
+        f.write(np.array([FLAT_VERSION, len(header)], dtype='<u4').tobytes())
+        f.write(header)
+        for (name, arrays), layer in zip(weights, layers):
+            for array, entry in zip(arrays, layer['weights']):
+                f.seek(data_start + entry['offset'])
+                f.write(np.ascontiguousarray(array, dtype=dtype.newbyteorder('<')).tobytes())
+        f.truncate(data_start + offset)
+
+
+def read_flat_weights(flat_path):
+    '''Memory-map a flat weight file, return [(layer_name, [arrays])] of read-only views'''
+    data = np.memmap(flat_path, dtype='uint8', mode='r')
+    if bytes(data[:len(FLAT_MAGIC)]) != FLAT_MAGIC:
+        raise ValueError('{} is not a flat weight file'.format(flat_path))
+    version, header_len = np.frombuffer(data, dtype='<u4', count=2, offset=len(FLAT_MAGIC))
+    if version != FLAT_VERSION:
+        raise ValueError('Unsupported flat weight version {} in {}'.format(version, flat_path))
+    header_start = len(FLAT_MAGIC) + 8
+    header = json.loads(bytes(data[header_start:header_start + header_len]).decode('utf8'))
+    data_start = _align(header_start + int(header_len))
+    weights = []
+    for layer in header['layers']:
+        arrays = [np.ndarray(shape=entry['shape'],
+                             dtype=np.dtype(entry['dtype']).newbyteorder('<'),
+                             buffer=data, offset=data_start + entry['offset'])
+                  for entry in layer['weights']]
+        weights.append((layer['name'], arrays))
+    return weights
+
+
+def _weight_value_tuples(layers, weights, source):
+    weight_value_tuples = []
+    for layer, (name, arrays) in zip(layers, weights):
+        if len(layer.weights) != len(arrays):
+            raise ValueError('Layer {} expects {} weights, {} provides {} for {}'.format(
+                layer.name, len(layer.weights), source, len(arrays), name))
+        for variable, array in zip(layer.weights, arrays):
+            if K.int_shape(variable) != tuple(array.shape):
+                raise ValueError('Shape mismatch for layer {}: {} vs {} from {}'.format(
+                    layer.name, K.int_shape(variable), array.shape, source))
+            weight_value_tuples.append((variable, array))
+    return weight_value_tuples
+
+
+def assign_weights(model, weights, source=''):
+    '''Assign [(layer_name, [arrays])] to the weighted layers of model in order, in one batch'''
+    layers = [layer for layer in model.layers if layer.weights]
+    if len(layers) != len(weights):
+        raise ValueError('{} has weights for {} layers but the model has {} layers with weights'
+                         .format(source, len(weights), len(layers)))
+    K.batch_set_value(_weight_value_tuples(layers, weights, source))
+
+
+def load_flat_weights(model, flat_path):
+    '''Load a flat weight file into model, straight from the memory map'''
+    assign_weights(model, read_flat_weights(flat_path), flat_path)
+
+
+def read_weights(path):
+    '''[(layer_name, [arrays])] of a .h5 or .flat weight file'''
+    return read_flat_weights(path) if path.endswith('.flat') else read_h5_weights(path)
+
+
+def load_shared_backbone(head_models, weight_paths):
+    '''Load models fine-tuned from one frozen backbone into head models that share it
+
+    head_models are the per head models of multi_head_yolo_body, weight_paths the .h5
+    or .flat file of each. The leading weighted layers common to all head models are
+    the backbone; every file must hold the same values for them, as it does when the
+    models were trained with those layers frozen on the same pretrained weights.
+    '''
+    head_layers = [[layer for layer in model.layers if layer.weights] for model in head_models]
+    num_backbone = 0
+    while num_backbone < len(head_layers[0]) and all(
+            num_backbone < len(layers) and layers[num_backbone] is head_layers[0][num_backbone]
+            for layers in head_layers[1:]):
+        num_backbone += 1
+
+    weight_value_tuples = []
+    backbone = None
+    for layers, path in zip(head_layers, weight_paths):
+        weights = read_weights(path)
+        if len(layers) != len(weights):
+            raise ValueError('{} has weights for {} layers but the model has {} layers with '
+                             'weights'.format(path, len(weights), len(layers)))
+        if backbone is None:
+            backbone = weights[:num_backbone]
+            weight_value_tuples += _weight_value_tuples(layers, weights, path)
+            continue
+        for l, ((name, arrays), (_, backbone_arrays)) in enumerate(zip(weights, backbone)):
+            if len(arrays) != len(backbone_arrays) or not all(
+                    np.array_equal(a, b) for a, b in zip(arrays, backbone_arrays)):
+                raise ValueError('{} and {} differ in backbone layer {} ({}), they do not share '
+                                 'a frozen backbone'.format(path, weight_paths[0], l, name))
+        weight_value_tuples += _weight_value_tuples(layers[num_backbone:],
+                                                    weights[num_backbone:], path)
+    K.batch_set_value(weight_value_tuples)
+    return num_backbone
+
+
+def read_darknet_weights(weights_path):
+    '''Memory-map a Darknet .weights file, return its float32 values after the header'''
+    data = np.memmap(weights_path, dtype='uint8', mode='r')
+    major, minor, revision = np.frombuffer(data, dtype='<i4', count=3)
+    if (major*10+minor)>=2 and major<1000 and minor<1000:
+        header_size = 12 + 8 # int64 images seen
+    else:
+        header_size = 12 + 4 # int32 images seen
+    return np.frombuffer(data, dtype='<f4', offset=header_size)
+
+
+def _creation_index(layer):
+    # Keras names layers <prefix>_<uid> with a per-prefix counter, which follows the
+    # order yolo_body and tiny_yolo_body create them in, and that is the cfg order.
+    return int(layer.name.rsplit('_', 1)[-1])
+
+
+def load_darknet_weights(model, weights_path):
+    '''Load a Darknet .weights file straight into yolo_body or tiny_yolo_body
+
+    Darknet serializes every convolutional layer as
+    [bias/beta, [gamma, mean, variance], conv_weights (out, in, h, w)].
+    The offsets of all layers are computed up front and every array is a view
+    into the memory map, transposed to Keras (h, w, in, out) order.
+    '''
+    convs = sorted([l for l in model.layers if isinstance(l, Conv2D)], key=_creation_index)
+    bns = sorted([l for l in model.layers if isinstance(l, BatchNormalization)],
+                 key=_creation_index)
+    batch_normalize = np.array([not conv.use_bias for conv in convs])
+    if batch_normalize.sum() != len(bns):
+        raise ValueError('{} convolutions without bias but {} batch normalizations'.format(
+            batch_normalize.sum(), len(bns)))
+    kernel_shapes = [K.int_shape(conv.kernel) for conv in convs]
+    filters = np.array([shape[3] for shape in kernel_shapes])
+    kernel_sizes = np.array([np.prod(shape) for shape in kernel_shapes])
+    sizes = filters + 3*filters*batch_normalize + kernel_sizes
+    ends = np.cumsum(sizes)
+    starts = ends - sizes
+
+    values = read_darknet_weights(weights_path)
+    if ends[-1] != len(values):
+        raise ValueError('Model needs {} weights but {} holds {}, make sure model, anchors '
+                         'and classes match'.format(ends[-1], weights_path, len(values)))
+
+    weight_value_tuples = []
+    bn_layers = iter(bns)
+    for conv, shape, n, bn, start in zip(convs, kernel_shapes, filters, batch_normalize, starts):
+        bias = values[start:start+n]
+        start += n
+        if bn:
+            gamma, mean, variance = values[start:start+3*n].reshape(3, n)
+            start += 3*n
+            bn_layer = next(bn_layers)
+            weight_value_tuples += zip(bn_layer.weights, [gamma, bias, mean, variance])
+        kernel = values[start:start+np.prod(shape)].reshape(shape[3], shape[2], shape[0], shape[1])
+        weight_value_tuples.append((conv.kernel, kernel.transpose([2, 3, 1, 0])))
+        if not bn:
+            weight_value_tuples.append((conv.bias, bias))
+    K.batch_set_value(weight_value_tuples)